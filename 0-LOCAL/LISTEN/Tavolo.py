@@ -3,6 +3,7 @@
 
 import os
 import sys
+import json
 import pyaudio
 import wave
 import time
@@ -130,6 +131,26 @@ except OSError as e:
 LOG_FILE = os.path.join(PROJECT_DIRECTORY, LOG_FILE_BASE)
 SCRIPT_PATH = os.path.join(PROJECT_DIRECTORY, SCRIPT_PATH_BASE)
 
+# ---------------------------------------------------
+# CONTROPRESSIONE DAL PRODUCER
+# ---------------------------------------------------
+# Il Producer pubblica pressure.json in FROM_TABLES. Sul Mac è la cartella di destinazione;
+# su Raspberry serve una copia raggiungibile (es. cartella montata) indicata in PRESSURE_FILE.
+# Senza file, o con un segnale scaduto, il tavolo si comporta come sempre. La scadenza del
+# segnale la decide il Producer (campo max_age del file); questa vale solo per file senza il campo.
+DEFAULT_PRESSURE_FILE = os.path.join(MAC_DESTINATION_DIR, "pressure.json") if MAC_DESTINATION_DIR else ""
+PRESSURE_FILE = os.getenv("PRESSURE_FILE", DEFAULT_PRESSURE_FILE)
+try:
+    PRESSURE_HIGH = float(os.getenv("PRESSURE_HIGH", 0.8))
+    PRESSURE_MAX_AGE = float(os.getenv("PRESSURE_MAX_AGE", 60))
+    # Sotto pressione soglia di energia e durata minima vengono moltiplicate per questo fattore
+    PRESSURE_THRESHOLD_FACTOR = float(os.getenv("PRESSURE_THRESHOLD_FACTOR", 1.5))
+    SPOOL_MAX_FILES = int(os.getenv("SPOOL_MAX_FILES", 20))
+except (ValueError, TypeError) as e:
+    print(f"ERRORE: Valore non valido nel .env per la contropressione: {e}. Uso i default.")
+    PRESSURE_HIGH, PRESSURE_MAX_AGE, PRESSURE_THRESHOLD_FACTOR, SPOOL_MAX_FILES = 0.8, 60, 1.5, 20
+SPOOL_DIR = os.path.join(PROJECT_DIRECTORY, "spool")
+
 log_file_handle = None
 try:
     log_file_handle = open(LOG_FILE, "a", encoding="utf-8")
@@ -216,6 +237,41 @@ def invia_o_sposta_audio(file_path_to_send):
             print_colored(f"ERRORE inatteso durante l'esecuzione dello script: {e_subproc}", RED)
             return False
 
+def leggi_pressione():
+    """Livello di pressione del Producer (0-1). 0 se il file manca o è scaduto."""
+    if not PRESSURE_FILE:
+        return 0.0
+    try:
+        with open(PRESSURE_FILE, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if time.time() - data["updated"] > data.get("max_age", PRESSURE_MAX_AGE):
+            return 0.0
+        return float(data["level"])
+    except (OSError, ValueError, KeyError, TypeError, AttributeError):
+        return 0.0
+
+def metti_in_spool(file_path):
+    """Tiene la registrazione in locale. Oltre SPOOL_MAX_FILES si scartano le più vecchie (ormai superate)."""
+    os.makedirs(SPOOL_DIR, exist_ok=True)
+    shutil.move(file_path, os.path.join(SPOOL_DIR, os.path.basename(file_path)))
+    spooled = sorted(os.listdir(SPOOL_DIR))
+    for old_name in spooled[:-SPOOL_MAX_FILES]:
+        os.remove(os.path.join(SPOOL_DIR, old_name))
+        print_colored(f"Spool pieno: scartata la registrazione più vecchia {old_name}.", GRAY)
+    print_colored(f"Producer sotto pressione: registrazione tenuta in locale ({min(len(spooled), SPOOL_MAX_FILES)} in spool).", BLUE)
+
+def svuota_spool():
+    """Invia le registrazioni in spool, in ordine cronologico, quando la pressione è scesa."""
+    if not os.path.isdir(SPOOL_DIR):
+        return
+    spooled = sorted(os.listdir(SPOOL_DIR))
+    if not spooled or leggi_pressione() >= PRESSURE_HIGH:
+        return
+    print_colored(f"Pressione rientrata: invio {len(spooled)} registrazioni dallo spool.", BLUE)
+    for name in spooled:
+        if not invia_o_sposta_audio(os.path.join(SPOOL_DIR, name)):
+            break # Si riprova al prossimo ciclo
+
 # ---------------------------------------------------
 # FUNZIONI REGISTRAZIONE AUDIO
 # ---------------------------------------------------
@@ -228,7 +284,14 @@ def is_audio_loud_enough(audio_frame, energy_thresh):
 # --- VERSIONE FINALE CON ADATTAMENTO DI RATE E CHUNK ---
 def record_audio_vad():
     global last_timestamp
-    print_colored(f"Inizio ciclo di ascolto (Energy: {ENERGY_THRESHOLD}, Silence: {SILENCE_THRESHOLD_SECONDS}s, MaxRec: {MAX_RECORD_SECONDS}s, MinDur: {DURATA_MINIMA}s)", GRAY)
+    # Con il Producer sotto pressione servono voci più forti e registrazioni più lunghe
+    pressione = leggi_pressione()
+    factor = PRESSURE_THRESHOLD_FACTOR if pressione >= PRESSURE_HIGH else 1.0
+    energy_threshold = ENERGY_THRESHOLD * factor
+    durata_minima = DURATA_MINIMA * factor
+    if factor > 1.0:
+        print_colored(f"Producer sotto pressione ({pressione:.2f}): soglie alzate di x{factor:g}.", BLUE)
+    print_colored(f"Inizio ciclo di ascolto (Energy: {energy_threshold:g}, Silence: {SILENCE_THRESHOLD_SECONDS}s, MaxRec: {MAX_RECORD_SECONDS}s, MinDur: {durata_minima:g}s)", GRAY)
     FORMAT = pyaudio.paInt16
     
     p_audio = None
@@ -291,7 +354,7 @@ def record_audio_vad():
                 if len(frame) != CHUNK * sample_width_bytes:
                     continue
 
-                loud = is_audio_loud_enough(frame, ENERGY_THRESHOLD)
+                loud = is_audio_loud_enough(frame, energy_threshold)
                 
                 try:
                     speech = loud and vad_processor.is_speech(frame, RATE)
@@ -346,7 +409,9 @@ def record_audio_vad():
             print_colored(f"File audio salvato: {os.path.basename(output_filepath)} (Durata: {duration:.1f}s).", GRAY)
             time.sleep(0.2)
 
-            if duration >= DURATA_MINIMA:
+            if duration >= durata_minima and leggi_pressione() >= PRESSURE_HIGH:
+                metti_in_spool(output_filepath)
+            elif duration >= durata_minima:
                 print_colored(f"Durata ok ({duration:.1f}s). Avvio invio/spostamento...", GRAY) 
                 invia_o_sposta_audio(output_filepath)
             else:
@@ -378,6 +443,7 @@ if __name__ == "__main__":
 
         last_timestamp = time.time()
         while True:
+            svuota_spool()
             record_audio_vad()
             time.sleep(1)
     except KeyboardInterrupt:
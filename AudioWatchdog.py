@@ -39,6 +39,7 @@ os.chdir(PROJECT_ROOT)
 import time
 import shutil
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 try:
     import openai
@@ -89,11 +90,48 @@ if not OPENAI_API_KEY:
     sys.exit(1)
 
 try:
-    client = openai.OpenAI(api_key=OPENAI_API_KEY)
+    # I retry li gestisce RateLimiter, coordinati con gli altri processi
+    client = openai.OpenAI(api_key=OPENAI_API_KEY, max_retries=0)
 except Exception as e:
     print(f"{ERROR_COLOR}{get_timestamp()} ERRORE CRITICO: Impossibile inizializzare il client OpenAI: {e}")
     sys.exit(1)
 
+from RateLimiter import call_with_retry
+from Pressure import PRESSURE_HIGH, read_pressure
+from IngestIndex import is_table_id, record_ingest
+
+# --- CONTROPRESSIONE ---
+# Con la pressione del Producer oltre PRESSURE_HIGH le registrazioni restano in FROM_TABLES:
+# si trascrivono quando la coda si libera, o comunque dopo PRESSURE_MAX_DEFER_SECONDS.
+PRESSURE_MAX_DEFER_SECONDS = float(os.getenv("PRESSURE_MAX_DEFER_SECONDS", "900"))
+last_deferred_count = 0
+
+def transcribe(audio_path: Path) -> str:
+    """Trascrive con Whisper; il file viene riaperto a ogni tentativo."""
+    def request():
+        with open(audio_path, "rb") as audio_file:
+            return client.audio.transcriptions.create(
+                model="whisper-1",
+                file=audio_file,
+                language="it"
+            )
+    on_retry = lambda message: print(f" {WARNING_COLOR}{message}...", end="", flush=True)
+    return call_with_retry(request, "openai", "whisper-1", on_retry=on_retry).text.strip()
+
+# --- RIASSUNTI IN BACKGROUND ---
+# Ogni trascrizione viene riassunta appena salvata, così al momento del job
+# GenerateSong trova il riassunto già in cache.
+from TranscriptSummaries import summarize_transcript
+PRESUMMARIZE = os.getenv("INCREMENTAL_SUMMARIES", "True").lower() in ("true", "1", "yes")
+summary_executor = ThreadPoolExecutor(max_workers=2)
+
+def presummarize(prefix: str, filename: str, text: str):
+    """Riassume una trascrizione in background. Un errore qui non blocca nulla: il job la riassumerà."""
+    try:
+        summarize_transcript(client, text)
+    except Exception as e:
+        print(f"{WARNING_COLOR}{get_timestamp()} AVVISO: riassunto anticipato fallito per {filename} (tavolo {prefix}): {e}")
+
 
 def process_audio_files():
     """
@@ -111,6 +149,24 @@ def process_audio_files():
     if not wav_files:
         return
 
+    global last_deferred_count
+    pressure = read_pressure()
+    if pressure >= PRESSURE_HIGH:
+        now = time.time()
+        deferred = []
+        for wav_path in wav_files:
+            try:
+                if now - wav_path.stat().st_mtime < PRESSURE_MAX_DEFER_SECONDS:
+                    deferred.append(wav_path)
+            except FileNotFoundError:
+                deferred.append(wav_path) # Sparito nel frattempo: non c'è niente da trascrivere
+        wav_files = [p for p in wav_files if p not in deferred]
+        if deferred and len(deferred) != last_deferred_count:
+            print(f"{WARNING_COLOR}{get_timestamp()} Pressione {pressure:.2f}: rimando {len(deferred)} registrazioni finché la coda non si libera.")
+        last_deferred_count = len(deferred)
+    else:
+        last_deferred_count = 0
+
     for audio_path in wav_files:
         try:
             last_size = -1
@@ -126,8 +182,8 @@ def process_audio_files():
 
         try:
             prefix = filename.split('-')[0]
-            if not prefix.isdigit():
-                print(f"{ERROR_COLOR}{get_timestamp()} Formato file non valido, prefisso non numerico: {filename}")
+            if not is_table_id(prefix):
+                print(f"{ERROR_COLOR}{get_timestamp()} Formato file non valido, prefisso non è un tavolo (es. 12 o locale.12): {filename}")
                 print(SEPARATOR + "\n")
                 continue
             filename_base = audio_path.stem
@@ -140,13 +196,7 @@ def process_audio_files():
         transcribed_text = ""
         print(f"{get_timestamp()} {INFO_COLOR}Mando a Whisper...", end="", flush=True)
         try:
-            with open(audio_path, "rb") as audio_file:
-                transcript_result = client.audio.transcriptions.create(
-                    model="whisper-1",
-                    file=audio_file,
-                    language="it"
-                )
-            transcribed_text = transcript_result.text.strip()
+            transcribed_text = transcribe(audio_path)
             print(f" {SUCCESS_COLOR}Trascritto!")
         except Exception as e:
             print(f" {ERROR_COLOR}FALLITO!")
@@ -191,6 +241,9 @@ def process_audio_files():
             transcription_file_path = table_work_dir / f"{filename_base}.txt"
             transcription_file_path.write_text(transcribed_text, encoding="utf-8")
             print(f"{get_timestamp()} SALVATO IN: {PATH_COLOR}{transcription_file_path}")
+            record_ingest(prefix, transcription_file_path) # Avvisa il Producer senza che debba riscandire
+            if PRESUMMARIZE:
+                summary_executor.submit(presummarize, prefix, filename, transcribed_text)
 
             audio_archive_dir = ARCHIVE_DIR / prefix / "Recordings"
             audio_archive_dir.mkdir(parents=True, exist_ok=True)
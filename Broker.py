@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# ____    _    ____   ____    _    ____  ____
+#| __ )  / \  |  _ \ | __ )  / \  |  _ \|  _ \
+#|  _ \ / _ \ | |_) ||  _ \ / _ \ | |_) | | | |
+#| |_) / ___ \|  _ < | |_) / ___ \|  _ <| |_| |
+#|____/_/   \_\_| \_\|____/_/   \_\_| \_\____/
+
+"""
+Broker.py: Coda di lavoro condivisa tra il Producer e i worker (Worker.py) su altre macchine.
+Protocollo JSON-lines su TCP: una richiesta per riga, una risposta per riga.
+
+  submit    {job}                      il Producer affida un job (id, table, text)
+  lease     {worker, wait}             un worker prende un job in prestito per BROKER_LEASE_SECONDS
+  heartbeat {id, worker, state}        il worker rinnova il prestito e salva l'avanzamento (job.json)
+  event     {id, worker, event}        eventi del job (progress, log, song) per il Producer
+  complete  {id, worker, ok, error}    fine del job
+  fetch     {id, after, wait}          il Producer legge gli eventi del job, fino al `result`
+  ack       {id}                       il Producer ha salvato il risultato: il job si può dimenticare
+  status    {}                         job in coda, in prestito e worker attivi
+
+Se un worker smette di mandare heartbeat il job torna in coda e viene riconsegnato a un altro,
+insieme all'ultimo avanzamento salvato (nessun task KieAI pagato due volte); dopo
+BROKER_MAX_ATTEMPTS consegne il job fallisce. I job non conclusi, e quelli conclusi il cui
+risultato il Producer non ha ancora confermato con `ack`, sopravvivono a un riavvio del broker
+in `.tmp_player/broker_state.json`: un Producer che riparte e rimanda `submit` di un job già
+concluso ne riceve il risultato invece di farlo generare (e pagare) una seconda volta.
+
+Avvio: python Broker.py [--listen HOST:PORTA]      Stato: python Broker.py --status
+Con GENERATOR_MODE=broker il Producer affida qui i job; i worker si avviano con Worker.py.
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import threading
+import uuid
+import socketserver
+from collections import deque
+from pathlib import Path
+from typing import Optional
+
+try:
+    PROJECT_ROOT = Path(__file__).parent.resolve()
+except NameError:
+    PROJECT_ROOT = Path('.').resolve()
+
+from dotenv import load_dotenv
+load_dotenv(PROJECT_ROOT / ".env")
+
+# --- CONFIGURAZIONE ---
+TMP_DIR = PROJECT_ROOT / ".tmp_player"
+BROKER_STATE_FILE = TMP_DIR / "broker_state.json"
+# Indirizzo del broker per Producer e worker (e di ascolto per il broker stesso)
+WORK_BROKER = os.getenv("WORK_BROKER", "127.0.0.1:8765")
+BROKER_LEASE_SECONDS = float(os.getenv("BROKER_LEASE_SECONDS", "60"))
+BROKER_HEARTBEAT_SECONDS = float(os.getenv("BROKER_HEARTBEAT_SECONDS", "15"))
+BROKER_MAX_ATTEMPTS = int(os.getenv("BROKER_MAX_ATTEMPTS", "3"))
+# Quanto a lungo restano leggibili gli eventi di un job concluso, dopo l'`ack` del Producer
+BROKER_DONE_TTL = 600
+# Senza `ack` (Producer fermo) il risultato si tiene per una serata intera
+BROKER_RESULT_TTL = 24 * 3600
+# Attesa massima di una richiesta `lease` o `fetch` senza novità (long polling)
+BROKER_MAX_WAIT = 30
+
+
+class BrokerError(Exception):
+    """Broker irraggiungibile o risposta non valida."""
+
+
+def parse_address(address: str) -> tuple[str, int]:
+    host, _, port = address.rpartition(":")
+    return host or "127.0.0.1", int(port)
+
+
+class WorkBroker:
+    """
+    Stato della coda, protetto da un'unica Condition. Per ogni job:
+      status: "queued" | "leased" | "done"
+      worker, deadline (monotonic) del prestito, attempts (consegne fatte),
+      state (ultimo job.json ricevuto), events (per il Producer), done_at, acked
+    Gli eventi valgono per una sola consegna: a ogni nuovo prestito il registro riparte da zero
+    (il worker che riprende il job rimanda quelli che servono) e `epoch` cambia a ogni avvio
+    del broker, così il Producer sa quando il suo cursore non vale più.
+    """
+
+    def __init__(self, state_file: Optional[Path] = BROKER_STATE_FILE, lease_seconds: float = BROKER_LEASE_SECONDS):
+        self.state_file = state_file
+        self.lease_seconds = lease_seconds
+        self.cond = threading.Condition()
+        self.epoch = uuid.uuid4().hex[:8]
+        self.jobs: dict[str, dict] = {}
+        self.queue: deque[str] = deque()
+        self.workers: dict[str, float] = {} # worker -> ultimo contatto (time.time)
+        self._load()
+
+    # --- Persistenza ---
+    def _load(self):
+        if not self.state_file or not self.state_file.exists():
+            return
+        try:
+            saved = json.loads(self.state_file.read_text(encoding="utf-8"))
+        except json.JSONDecodeError:
+            return
+        for job_id, entry in saved.items():
+            if entry.get("status") == "done":
+                # Risultato non ancora confermato dal Producer: resta leggibile
+                self.jobs[job_id] = {"job": entry["job"], "status": "done", "attempts": entry.get("attempts", 0),
+                                     "state": entry.get("state"), "events": entry.get("events", []),
+                                     "done_at": time.monotonic()}
+                continue
+            # I prestiti in corso al riavvio non sono più validi: il job torna in coda
+            self.jobs[job_id] = {"job": entry["job"], "status": "queued", "attempts": entry.get("attempts", 0),
+                                 "state": entry.get("state"), "events": []}
+            self.queue.append(job_id)
+
+    def _save(self):
+        if not self.state_file:
+            return
+        pending = {job_id: {"job": e["job"], "attempts": e["attempts"], "state": e.get("state")}
+                   for job_id, e in self.jobs.items() if e["status"] != "done"}
+        for job_id, e in self.jobs.items():
+            if e["status"] == "done" and not e.get("acked"):
+                pending[job_id] = {"job": e["job"], "attempts": e["attempts"], "state": e.get("state"),
+                                   "status": "done", "events": e["events"]}
+        self.state_file.parent.mkdir(exist_ok=True)
+        tmp_file = self.state_file.with_suffix(".tmp")
+        tmp_file.write_text(json.dumps(pending), encoding="utf-8")
+        os.replace(tmp_file, self.state_file)
+
+    # --- Operazioni del protocollo ---
+    def handle(self, request: dict) -> dict:
+        op = request.get("op")
+        handler = getattr(self, f"op_{op}", None)
+        if handler is None:
+            return {"ok": False, "error": f"operazione sconosciuta: {op}"}
+        try:
+            return handler(request)
+        except (KeyError, TypeError, ValueError) as e:
+            return {"ok": False, "error": f"richiesta non valida: {e}"}
+
+    def op_submit(self, request: dict) -> dict:
+        job = request["job"]
+        with self.cond:
+            if job["id"] in self.jobs:
+                # Producer riavviato: il job è già in corso, o concluso e con il risultato da leggere
+                return {"ok": True, "duplicate": True}
+            self.jobs[job["id"]] = {"job": job, "status": "queued", "attempts": 0, "state": None, "events": []}
+            self.queue.append(job["id"])
+            self._save()
+            self.cond.notify_all()
+        return {"ok": True}
+
+    def op_lease(self, request: dict) -> dict:
+        worker = request["worker"]
+        deadline = time.monotonic() + min(float(request.get("wait", 0)), BROKER_MAX_WAIT)
+        with self.cond:
+            self.workers[worker] = time.time()
+            while not self.queue:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return {"ok": True, "job": None}
+                self.cond.wait(remaining)
+            job_id = self.queue.popleft()
+            entry = self.jobs[job_id]
+            entry.update(status="leased", worker=worker, deadline=time.monotonic() + self.lease_seconds, events=[])
+            entry["attempts"] += 1
+            self.cond.notify_all() # Chi attende con `fetch` deve ripartire dal nuovo registro
+            self._save()
+            return {"ok": True, "job": entry["job"], "state": entry.get("state"),
+                    "attempt": entry["attempts"], "lease_seconds": self.lease_seconds}
+
+    def _owned(self, request: dict) -> Optional[dict]:
+        """Il job, solo se è ancora in prestito al worker che scrive."""
+        entry = self.jobs.get(request["id"])
+        self.workers[request["worker"]] = time.time()
+        if entry and entry["status"] == "leased" and entry.get("worker") == request["worker"]:
+            return entry
+        return None
+
+    def op_heartbeat(self, request: dict) -> dict:
+        with self.cond:
+            entry = self._owned(request)
+            if entry is None:
+                return {"ok": False, "error": "prestito scaduto o job riassegnato"}
+            entry["deadline"] = time.monotonic() + self.lease_seconds
+            if request.get("state") and request["state"] != entry.get("state"):
+                entry["state"] = request["state"]
+                self._save()
+        return {"ok": True}
+
+    def op_event(self, request: dict) -> dict:
+        with self.cond:
+            entry = self._owned(request)
+            if entry is None:
+                return {"ok": False, "error": "prestito scaduto o job riassegnato"}
+            entry["events"].append(request["event"])
+            self.cond.notify_all()
+        return {"ok": True}
+
+    def op_complete(self, request: dict) -> dict:
+        with self.cond:
+            entry = self._owned(request)
+            if entry is None:
+                return {"ok": False, "error": "prestito scaduto o job riassegnato"}
+            self._finish(entry, bool(request.get("ok")), request.get("error"))
+        return {"ok": True}
+
+    def op_ack(self, request: dict) -> dict:
+        with self.cond:
+            entry = self.jobs.get(request["id"])
+            if entry and entry["status"] == "done" and not entry.get("acked"):
+                entry.update(acked=True, done_at=time.monotonic())
+                self._save()
+        return {"ok": True}
+
+    def _finish(self, entry: dict, ok: bool, error: Optional[str] = None):
+        result = {"event": "result", "ok": ok}
+        if error:
+            result["error"] = error
+        entry["events"].append(result)
+        entry.update(status="done", done_at=time.monotonic())
+        self._save()
+        self.cond.notify_all()
+
+    def op_fetch(self, request: dict) -> dict:
+        """
+        Eventi successivi al cursore (`epoch`, `attempt`, `after`) del Producer. Se il broker è
+        ripartito o il job è stato riconsegnato, il cursore riparte da zero nel nuovo registro.
+        """
+        after = int(request.get("after", 0))
+        deadline = time.monotonic() + min(float(request.get("wait", 0)), BROKER_MAX_WAIT)
+        with self.cond:
+            while True:
+                entry = self.jobs.get(request["id"])
+                if entry is None:
+                    return {"ok": False, "error": "job sconosciuto"}
+                start = after
+                if (request.get("epoch") != self.epoch or request.get("attempt") != entry["attempts"]
+                        or after > len(entry["events"])):
+                    start = 0
+                remaining = deadline - time.monotonic()
+                if len(entry["events"]) > start or start != after or remaining <= 0:
+                    return {"ok": True, "events": entry["events"][start:], "next": len(entry["events"]),
+                            "epoch": self.epoch, "attempt": entry["attempts"]}
+                self.cond.wait(remaining)
+
+    def op_status(self, request: dict) -> dict:
+        with self.cond:
+            counts = {"queued": 0, "leased": 0, "done": 0}
+            for entry in self.jobs.values():
+                counts[entry["status"]] += 1
+            now = time.time()
+            workers = {w: round(now - seen) for w, seen in self.workers.items() if now - seen < 3 * BROKER_LEASE_SECONDS}
+        return {"ok": True, "jobs": counts, "workers": workers}
+
+    # --- Manutenzione ---
+    def expire_leases(self):
+        """Riconsegna i job dei worker spariti e dimentica i job conclusi da tempo."""
+        now = time.monotonic()
+        with self.cond:
+            for job_id, entry in list(self.jobs.items()):
+                if entry["status"] == "leased" and now > entry["deadline"]:
+                    worker = entry.pop("worker")
+                    if entry["attempts"] >= BROKER_MAX_ATTEMPTS:
+                        self._finish(entry, False, f"nessun worker ha completato il job in {entry['attempts']} tentativi")
+                        continue
+                    entry["status"] = "queued"
+                    entry["events"].append({"event": "log", "level": "info",
+                                            "message": f"Il worker {worker} non risponde: job rimesso in coda"})
+                    self.queue.appendleft(job_id) # Il più vecchio, quindi davanti agli altri
+                    self._save()
+                    self.cond.notify_all()
+                elif entry["status"] == "done":
+                    ttl = BROKER_DONE_TTL if entry.get("acked") else BROKER_RESULT_TTL
+                    if now - entry["done_at"] > ttl:
+                        del self.jobs[job_id]
+                        if not entry.get("acked"):
+                            self._save()
+
+
+class BrokerRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for raw_line in self.rfile:
+            if not raw_line.strip():
+                continue
+            try:
+                response = self.server.broker.handle(json.loads(raw_line))
+            except json.JSONDecodeError as e:
+                response = {"ok": False, "error": f"JSON non valido: {e}"}
+            self.wfile.write((json.dumps(response) + "\n").encode("utf-8"))
+            self.wfile.flush()
+
+
+class BrokerServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address: tuple[str, int], broker: WorkBroker):
+        super().__init__(address, BrokerRequestHandler)
+        self.broker = broker
+        threading.Thread(target=self._reaper, daemon=True).start()
+
+    def _reaper(self):
+        while True:
+            time.sleep(1)
+            self.broker.expire_leases()
+
+
+class BrokerClient:
+    """Una connessione persistente al broker. Non condividerla tra thread che fanno long polling."""
+
+    def __init__(self, address: str = WORK_BROKER):
+        self.address = parse_address(address)
+        self.sock = None
+        self.reader = None
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        self.sock = socket.create_connection(self.address, timeout=10)
+        self.sock.settimeout(BROKER_MAX_WAIT + 15)
+        self.reader = self.sock.makefile("r", encoding="utf-8")
+
+    def close(self):
+        if self.sock:
+            self.sock.close()
+        self.sock = self.reader = None
+
+    def call(self, op: str, **fields) -> dict:
+        """Una richiesta e la sua risposta; in caso di connessione caduta si ritenta una volta."""
+        line = (json.dumps({"op": op, **fields}) + "\n").encode("utf-8")
+        with self.lock:
+            for attempt in range(2):
+                try:
+                    if self.sock is None:
+                        self._connect()
+                    self.sock.sendall(line)
+                    response = self.reader.readline()
+                    if not response:
+                        raise ConnectionError("connessione chiusa dal broker")
+                    return json.loads(response)
+                except (OSError, json.JSONDecodeError) as e:
+                    self.close()
+                    if attempt:
+                        raise BrokerError(f"broker {self.address[0]}:{self.address[1]} non raggiungibile: {e}") from e
+
+
+def serve_broker(address: str = WORK_BROKER):
+    host, port = parse_address(address)
+    broker = WorkBroker()
+    with BrokerServer((host, port), broker) as server:
+        print(f"Broker in ascolto su {host}:{port} ({len(broker.queue)} job ripresi dal disco). CTRL+C per terminare.")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            print("\nBroker terminato.")
+
+
+if __name__ == "__main__":
+    if "--status" in sys.argv:
+        print(json.dumps(BrokerClient().call("status"), indent=2))
+        sys.exit(0)
+    listen = sys.argv[sys.argv.index("--listen") + 1] if "--listen" in sys.argv else WORK_BROKER
+    serve_broker(listen)
@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# ____    _    ____   ____    _    ____  ____
+#| __ )  / \  |  _ \ | __ )  / \  |  _ \|  _ \
+#|  _ \ / _ \ | |_) ||  _ \ / _ \ | |_) | | | |
+#| |_) / ___ \|  _ < | |_) / ___ \|  _ <| |_| |
+#|____/_/   \_\_| \_\|____/_/   \_\_| \_\____/
+
+"""
+Downloader.py: Download robusto dei file audio generati.
+Riprende i trasferimenti interrotti con HTTP Range, usa range paralleli quando
+il server li accetta, ritenta un numero limitato di volte, scrive su un file
+`.part` rinominato in modo atomico solo a download completo e ne verifica la lunghezza.
+Con i range paralleli l'avanzamento di ogni range è salvato in `.part.json`: un download
+interrotto (anche da un riavvio) riparte da lì invece che da zero.
+
+Verifica rapida contro un server locale che interrompe le connessioni:
+    python Downloader.py --selftest
+"""
+
+import os
+import re
+import json
+import sys
+import time
+import random
+import threading
+from pathlib import Path
+from typing import Callable, Optional
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+# --- CONFIGURAZIONE ---
+MAX_DOWNLOAD_ATTEMPTS = int(os.getenv("MAX_DOWNLOAD_ATTEMPTS", "10"))
+DOWNLOAD_CONNECT_TIMEOUT = float(os.getenv("DOWNLOAD_CONNECT_TIMEOUT", "10"))
+# Timeout di lettura: una connessione ferma per più di così viene ritentata
+DOWNLOAD_READ_TIMEOUT = float(os.getenv("DOWNLOAD_READ_TIMEOUT", "30"))
+DOWNLOAD_PARALLEL_RANGES = int(os.getenv("DOWNLOAD_PARALLEL_RANGES", "4"))
+DOWNLOAD_MIN_RANGE_BYTES = int(os.getenv("DOWNLOAD_MIN_RANGE_BYTES", str(256 * 1024)))
+DOWNLOAD_BACKOFF_SECONDS = float(os.getenv("DOWNLOAD_BACKOFF_SECONDS", "1"))
+CHUNK_SIZE = 64 * 1024
+PROGRESS_SAVE_SECONDS = 0.5 # Ogni quanto si aggiorna il `.part.json` dei range paralleli
+
+CONTENT_RANGE_RE = re.compile(r"bytes\s+(\d+)-(\d+)/(\d+|\*)")
+
+
+class DownloadError(Exception):
+    """Download non riuscito dopo tutti i tentativi, o file di lunghezza errata."""
+
+
+class RangesRejected(DownloadError):
+    """Il server ha smesso di accettare i Range: si ripiega sul download sequenziale."""
+
+
+def part_path_for(dest: Path) -> Path:
+    """Percorso del file temporaneo usato durante il download."""
+    return dest.with_name(dest.name + ".part")
+
+
+def progress_path_for(part: Path) -> Path:
+    """Avanzamento dei range paralleli: {"total": byte, "ranges": [[inizio, fine, posizione], ...]}."""
+    return part.with_name(part.name + ".json")
+
+
+def _backoff(attempt: int):
+    """Attesa esponenziale con jitter tra un tentativo e l'altro."""
+    delay = min(DOWNLOAD_BACKOFF_SECONDS * (2 ** (attempt - 1)), 30)
+    time.sleep(delay * random.uniform(0.5, 1.0))
+
+
+def probe(session: requests.Session, url: str) -> tuple[Optional[int], bool]:
+    """
+    Chiede il primo byte per scoprire la lunghezza totale e se il server accetta i Range.
+    Ritorna (lunghezza o None, range supportati).
+    """
+    for attempt in range(1, MAX_DOWNLOAD_ATTEMPTS + 1):
+        try:
+            with session.get(url, headers={"Range": "bytes=0-0"}, stream=True,
+                             timeout=(DOWNLOAD_CONNECT_TIMEOUT, DOWNLOAD_READ_TIMEOUT)) as r:
+                r.raise_for_status()
+                match = CONTENT_RANGE_RE.match(r.headers.get("Content-Range", ""))
+                if r.status_code == 206 and match and match.group(3) != "*":
+                    return int(match.group(3)), True
+                length = r.headers.get("Content-Length")
+                return (int(length) if length and length.isdigit() else None), False
+        except requests.exceptions.RequestException:
+            if attempt == MAX_DOWNLOAD_ATTEMPTS:
+                raise
+            _backoff(attempt)
+    return None, False
+
+
+def _download_stream(session: requests.Session, url: str, part: Path, total: Optional[int],
+                     ranges_ok: bool, on_first_bytes: Optional[Callable[[Path], None]]):
+    """Download sequenziale, ripreso con Range dal punto in cui si era interrotto."""
+    for attempt in range(1, MAX_DOWNLOAD_ATTEMPTS + 1):
+        offset = part.stat().st_size if (ranges_ok and part.exists()) else 0
+        if total is not None and offset >= total:
+            return
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        try:
+            with session.get(url, headers=headers, stream=True,
+                             timeout=(DOWNLOAD_CONNECT_TIMEOUT, DOWNLOAD_READ_TIMEOUT)) as r:
+                r.raise_for_status()
+                if offset and r.status_code != 206:
+                    offset = 0  # Il server ha ignorato il Range: si riparte da capo
+                with open(part, "ab" if offset else "wb") as f:
+                    for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                        f.write(chunk)
+                        if on_first_bytes:
+                            f.flush()
+                            on_first_bytes(part)
+                            on_first_bytes = None
+            if total is None or part.stat().st_size >= total:
+                return
+        except requests.exceptions.RequestException:
+            pass
+        if attempt < MAX_DOWNLOAD_ATTEMPTS:
+            _backoff(attempt)
+    raise DownloadError(f"Download interrotto dopo {MAX_DOWNLOAD_ATTEMPTS} tentativi: {url}")
+
+
+class RangeProgress:
+    """Posizioni raggiunte dai range, salvate in `.part.json` solo dopo che i dati sono su disco."""
+
+    def __init__(self, part: Path, total: int, ranges: list[list[int]]):
+        self.path = progress_path_for(part)
+        self.total = total
+        self.ranges = ranges
+        self.lock = threading.Lock()
+        self.saved_at = 0.0
+
+    @classmethod
+    def load(cls, part: Path, total: int) -> Optional["RangeProgress"]:
+        """Avanzamento di un download precedente dello stesso file, se ancora valido."""
+        try:
+            saved = json.loads(progress_path_for(part).read_text(encoding="utf-8"))
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        if saved.get("total") != total or not part.exists() or part.stat().st_size != total:
+            return None
+        return cls(part, total, saved["ranges"])
+
+    def advance(self, index: int, position: int):
+        with self.lock:
+            self.ranges[index][2] = position
+            if time.monotonic() - self.saved_at >= PROGRESS_SAVE_SECONDS:
+                self.save()
+
+    def save(self):
+        tmp_file = self.path.with_suffix(".tmp")
+        tmp_file.write_text(json.dumps({"total": self.total, "ranges": self.ranges}), encoding="utf-8")
+        os.replace(tmp_file, self.path)
+        self.saved_at = time.monotonic()
+
+
+def _download_range(session: requests.Session, url: str, part: Path, index: int, progress: RangeProgress):
+    """Scarica il range `index` nel file `.part`, riprendendo dal punto raggiunto."""
+    start, end, position = progress.ranges[index]
+    for attempt in range(1, MAX_DOWNLOAD_ATTEMPTS + 1):
+        try:
+            with session.get(url, headers={"Range": f"bytes={position}-{end}"}, stream=True,
+                             timeout=(DOWNLOAD_CONNECT_TIMEOUT, DOWNLOAD_READ_TIMEOUT)) as r:
+                r.raise_for_status()
+                if r.status_code != 206:
+                    raise RangesRejected("Il server ha smesso di accettare i Range")
+                with open(part, "r+b") as f:
+                    f.seek(position)
+                    for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                        chunk = chunk[:end + 1 - position]
+                        f.write(chunk)
+                        f.flush() # Su disco prima che l'avanzamento lo dichiari scaricato
+                        position += len(chunk)
+                        progress.advance(index, position)
+            if position > end:
+                return
+        except requests.exceptions.RequestException:
+            pass
+        if attempt < MAX_DOWNLOAD_ATTEMPTS:
+            _backoff(attempt)
+    raise DownloadError(f"Range {start}-{end} interrotto dopo {MAX_DOWNLOAD_ATTEMPTS} tentativi: {url}")
+
+
+def _download_ranges(session: requests.Session, url: str, part: Path, total: int):
+    """
+    Divide il file in range e li scarica in parallelo nello stesso `.part`. Se un download
+    precedente ha lasciato `.part` e `.part.json`, ogni range riparte dalla sua posizione.
+    """
+    progress = RangeProgress.load(part, total)
+    if progress is None:
+        count = max(1, min(DOWNLOAD_PARALLEL_RANGES, total // DOWNLOAD_MIN_RANGE_BYTES))
+        size = -(-total // count)
+        with open(part, "wb") as f:
+            f.truncate(total)
+        progress = RangeProgress(part, total, [[start, min(start + size, total) - 1, start]
+                                               for start in range(0, total, size)])
+        progress.save()
+    pending = [i for i, (_, end, position) in enumerate(progress.ranges) if position <= end]
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, len(pending))) as executor:
+            futures = [executor.submit(_download_range, session, url, part, i, progress) for i in pending]
+            for future in futures:
+                future.result()
+    finally:
+        with progress.lock:
+            progress.save() # Anche in caso di errore: il prossimo tentativo riparte da qui
+
+
+def download_file(url: str, dest: Path, session: Optional[requests.Session] = None,
+                  on_first_bytes: Optional[Callable[[Path], None]] = None) -> Path:
+    """
+    Scarica `url` in `dest`. Durante il trasferimento i dati stanno in `dest.part`,
+    che diventa `dest` solo se la lunghezza corrisponde a quella dichiarata dal server.
+    Con `on_first_bytes` il download resta sequenziale, così il `.part` cresce in ordine
+    e può essere letto mentre arriva (la callback riceve il percorso del `.part`).
+    """
+    session = session or requests.Session()
+    part = part_path_for(dest)
+    total, ranges_ok = probe(session, url)
+
+    progress_file = progress_path_for(part)
+    use_ranges = (ranges_ok and total is not None and on_first_bytes is None
+                  and DOWNLOAD_PARALLEL_RANGES > 1 and total >= 2 * DOWNLOAD_MIN_RANGE_BYTES)
+    if use_ranges:
+        try:
+            _download_ranges(session, url, part, total)
+        except RangesRejected:
+            part.unlink(missing_ok=True)
+            progress_file.unlink(missing_ok=True)
+            _download_stream(session, url, part, total, ranges_ok, None)
+    else:
+        if progress_file.exists():
+            # `.part` preallocato da range paralleli: la sua dimensione non indica i byte già scaricati
+            part.unlink(missing_ok=True)
+            progress_file.unlink()
+        _download_stream(session, url, part, total, ranges_ok, on_first_bytes)
+
+    size = part.stat().st_size
+    if size == 0 or (total is not None and size != total):
+        raise DownloadError(f"Lunghezza non valida per {dest.name}: {size} byte, attesi {total}")
+    os.replace(part, dest)
+    progress_file.unlink(missing_ok=True)
+    return dest
+
+
+# --- VERIFICA LOCALE ---
+
+def _selftest() -> int:
+    """Scarica da un server locale che tronca le prime risposte e controlla il risultato."""
+    import tempfile
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    global MAX_DOWNLOAD_ATTEMPTS
+    payload = os.urandom(3 * 1024 * 1024 + 123)
+    state = {"requests": 0, "bytes": 0}
+    state_lock = threading.Lock() # ThreadingHTTPServer serve ogni richiesta in un thread diverso
+
+    class FlakyHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            with state_lock:
+                state["requests"] += 1
+                request_number = state["requests"]
+            start, end = 0, len(payload) - 1
+            match = re.match(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+            if match and self.server.ranges:
+                start = int(match.group(1))
+                end = int(match.group(2)) if match.group(2) else end
+                self.send_response(206)
+                self.send_header("Content-Range", f"bytes {start}-{end}/{len(payload)}")
+            else:
+                self.send_response(200)
+            body = payload[start:end + 1]
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            # Una risposta su due (o tutte) viene troncata a metà, come una connessione caduta
+            if len(body) > 1 and (self.server.truncate_all or request_number % 2 == 0):
+                body = body[:len(body) // 2]
+                self.close_connection = True
+            self.wfile.write(body)
+            self.wfile.flush()
+            with state_lock:
+                state["bytes"] += len(body)
+
+    def serve(ranges: bool) -> tuple[ThreadingHTTPServer, str]:
+        server = ThreadingHTTPServer(("127.0.0.1", 0), FlakyHandler)
+        server.ranges = ranges
+        server.truncate_all = False
+        server.handle_error = lambda request, client_address: None  # Le connessioni troncate sono volute
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        with state_lock:
+            state["requests"] = state["bytes"] = 0
+        return server, f"http://127.0.0.1:{server.server_address[1]}/song.mp3"
+
+    failures = 0
+    for ranges, parallel in ((True, True), (True, False), (False, False)):
+        server, url = serve(ranges)
+        with tempfile.TemporaryDirectory() as tmp:
+            dest = Path(tmp) / "song.mp3"
+            callback = None if parallel else (lambda part: None)
+            try:
+                download_file(url, dest, on_first_bytes=callback)
+                ok = dest.read_bytes() == payload and not part_path_for(dest).exists()
+            except DownloadError as e:
+                print(f"  errore: {e}")
+                ok = False
+        server.shutdown()
+        failures += not ok
+        mode = "range paralleli" if parallel else ("ripresa sequenziale" if ranges else "senza Range")
+        print(f"{'OK  ' if ok else 'FAIL'} {mode:<20} richieste: {state['requests']}")
+
+    # Range paralleli interrotti (come da un riavvio): la seconda chiamata riparte dal .part.json
+    server, url = serve(True)
+    with tempfile.TemporaryDirectory() as tmp:
+        dest = Path(tmp) / "song.mp3"
+        server.truncate_all, attempts = True, MAX_DOWNLOAD_ATTEMPTS
+        MAX_DOWNLOAD_ATTEMPTS = 1
+        try:
+            download_file(url, dest)
+            ok = False
+        except DownloadError:
+            ok = progress_path_for(part_path_for(dest)).exists()
+        MAX_DOWNLOAD_ATTEMPTS = attempts
+        server.truncate_all = False
+        with state_lock:
+            state["requests"] = state["bytes"] = 0
+        try:
+            download_file(url, dest)
+            ok = (ok and dest.read_bytes() == payload and state["bytes"] < len(payload)
+                  and not progress_path_for(part_path_for(dest)).exists())
+        except DownloadError as e:
+            print(f"  errore: {e}")
+            ok = False
+    server.shutdown()
+    failures += not ok
+    print(f"{'OK  ' if ok else 'FAIL'} {'ripresa dei range':<20} byte riscaricati: {state['bytes']}/{len(payload)}")
+    return failures
+
+
+if __name__ == "__main__":
+    if "--selftest" in sys.argv:
+        DOWNLOAD_BACKOFF_SECONDS = 0.01
+        sys.exit(1 if _selftest() else 0)
+    print("Uso: python Downloader.py --selftest")
@@ -36,12 +36,15 @@ except NameError:
 os.chdir(PROJECT_ROOT)
 # --- FINE BLOCCO UNIVERSALE ---
 
+import re
 import json
 import time
 import random
+import threading
 import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
-from typing import Tuple, Optional
+from typing import Callable, Tuple, Optional
 
 try:
     from dotenv import load_dotenv
@@ -50,6 +53,15 @@ try:
 except ImportError:
     print("AVVISO: Libreria python-dotenv non trovata. Continuo con le variabili di sistema.", file=sys.stderr)
 
+# Moduli del progetto: importati dopo il .env perché leggono la loro configurazione all'import
+from Downloader import download_file
+from JobState import JobState
+from KieLatency import AdaptivePoller, HEDGE_MAX_PER_HOUR, HEDGE_PERCENTILE, hedge_after, reserve_hedge_slot
+from RateLimiter import call_with_retry
+from SongMeta import analyse_song, write_meta
+from TextCache import DiskCache, content_hash
+from TranscriptSummaries import summarize_batch
+
 # --- CONFIGURAZIONE CON PERCORSI PORTABILI ---
 OUTPUT_DIR = PROJECT_ROOT / "SONGS"
 ARCHIVE_BASE_DIR = PROJECT_ROOT / "FROM_TABLES" / "Archive"
@@ -63,12 +75,44 @@ CALLBACK_URL = os.getenv("CALLBACK_URL", "")
 POLL_INTERVAL = int(os.getenv("POLL_INTERVAL", 10))
 MAX_POLL_ATTEMPTS = int(os.getenv("MAX_POLL_ATTEMPTS", "80"))
 IS_INSTRUMENTAL = os.getenv("INSTRUMENTAL", "False").lower() in ("true", "1", "yes")
+# Pubblicazione anticipata della prima traccia: "off", "stream" (appena l'API fornisce
+# lo streamAudioUrl) oppure "file" (appena i primi byte del download sono su disco)
+EARLY_PUBLISH = os.getenv("EARLY_PUBLISH", "off").strip().lower()
+# Duplica i task KieAI rimasti in coda lunga (soglia e tetto orario in KieLatency.py)
+HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "False").lower() in ("true", "1", "yes")
 SUMMARY_MODEL = os.getenv("SUMMARY_MODEL", "gpt-3.5-turbo")
 SUMMARY_MAX_TOKENS = int(os.getenv("MAX_TOKENS_SUMMARY", "150"))
 SUMMARY_TEMPERATURE = float(os.getenv("TEMPERATURE_SUMMARY", "0.5"))
 LYRICS_MODEL = os.getenv("LYRICS_MODEL", "gpt-4o")
 SUMMARY_SYSTEM_PROMPT = os.getenv("SYSTEM_PROMPT", "Riassumi la conversazione seguente in modo conciso, catturandone l'argomento e l'umore.")
+# Riassunti per trascrizione (in cache, preparati da AudioWatchdog) invece di un unico riassunto del batch
+INCREMENTAL_SUMMARIES = os.getenv("INCREMENTAL_SUMMARIES", "True").lower() in ("true", "1", "yes")
 LYRICS_MASTER_PROMPT = os.getenv("STILE_LYRICS", "Sei un cantautore. Usa il riassunto seguente per scrivere il testo completo di una canzone, con strofe e ritornello.")
+# "two_step" (riassunto, poi lyrics) oppure "fused" (un'unica richiesta con output strutturato)
+LYRICS_MODE = os.getenv("LYRICS_MODE", "two_step").strip().lower()
+LLM_STREAM = os.getenv("LLM_STREAM", "False").lower() in ("true", "1", "yes")
+# Cache dei risultati della fase testo: un job ritentato riparte direttamente dalla musica
+LYRICS_CACHE_TTL_HOURS = float(os.getenv("LYRICS_CACHE_TTL_HOURS", "24"))
+LYRICS_CACHE_MAX_ENTRIES = int(os.getenv("LYRICS_CACHE_MAX_ENTRIES", "500"))
+
+FUSED_SYSTEM_PROMPT = (
+    f"{SUMMARY_SYSTEM_PROMPT}\n\n"
+    f"Poi, a partire dal riassunto: {LYRICS_MASTER_PROMPT}\n\n"
+    "Rispondi in JSON con i campi 'summary' (il riassunto) e 'lyrics' (il testo della canzone), in quest'ordine."
+)
+FUSED_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "song_text",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {"summary": {"type": "string"}, "lyrics": {"type": "string"}},
+            "required": ["summary", "lyrics"],
+            "additionalProperties": False
+        }
+    }
+}
 
 def load_env_list(prefix: str) -> list[str]:
     """Carica variabili d'ambiente che iniziano con un dato prefisso in una lista."""
@@ -77,27 +121,65 @@ def load_env_list(prefix: str) -> list[str]:
 STYLE_OPTIONS = load_env_list("DEFAULT_STYLE")
 
 # --- FUNZIONI DI LOGGING ---
+# In modalità --serve stdout è riservato al protocollo JSON-lines: i messaggi per il
+# processo padre diventano eventi inviati tramite questa funzione.
+event_sink: Optional[Callable[[dict], None]] = None
+
 def log_error(msg: str):
     print(f"ERROR: {msg}", file=sys.stderr)
     sys.stderr.flush()
+    if event_sink:
+        event_sink({"event": "log", "level": "error", "message": msg})
 
 def log_debug(msg: str):
     print(f"DEBUG: {msg}", file=sys.stderr)
     sys.stderr.flush()
 
+def log_info(msg: str):
+    """Messaggio informativo per il log del processo padre."""
+    if event_sink:
+        event_sink({"event": "log", "level": "info", "message": msg})
+    else:
+        print(msg)
+        sys.stdout.flush()
+
 def log_milestone(msg: str):
     """Stampa un messaggio di stato formattato per essere catturato dal processo padre."""
+    if event_sink:
+        event_sink({"event": "progress", "message": msg})
+        return
     print(f"MILESTONE: {msg}", file=sys.stdout)
     sys.stdout.flush()
 
+def log_stream(stage: str, delta: str):
+    """Frammento di testo in streaming dal modello: inoltrato solo in modalità --serve."""
+    if event_sink:
+        event_sink({"event": "stream", "stage": stage, "delta": delta})
+
+def emit_song(song_data: dict):
+    """Consegna al processo padre la riga JSON di una canzone pronta (o anticipata)."""
+    if event_sink:
+        event_sink({"event": "song", "data": song_data})
+        return
+    print(json.dumps(song_data))
+    sys.stdout.flush()
+
 # --- INIZIALIZZAZIONE CLIENTS ---
 try:
     import openai
-    openai_client = openai.OpenAI(api_key=OPENAI_API_KEY)
+    # I retry li gestisce RateLimiter, coordinati con gli altri processi
+    openai_client = openai.OpenAI(api_key=OPENAI_API_KEY, max_retries=0)
 except Exception as e:
     log_error(f"Impossibile inizializzare client OpenAI: {e}")
     sys.exit(1)
 
+# Sessioni HTTP condivise: in modalità --serve restano calde tra un job e l'altro
+kieai_session = requests.Session()
+kieai_session.headers.update({"Authorization": f"Bearer {KIEAI_API_KEY}", "Content-Type": "application/json"})
+download_session = requests.Session() # Senza l'header di autorizzazione di KieAI
+
+lyrics_cache = DiskCache("lyrics", ttl_seconds=LYRICS_CACHE_TTL_HOURS * 3600, max_entries=LYRICS_CACHE_MAX_ENTRIES)
+
 # --- LOGICA PRINCIPALE ---
 
 def choose_random_style() -> str:
@@ -106,55 +188,179 @@ def choose_random_style() -> str:
         return "epic cinematic" # Fallback
     return random.choice(STYLE_OPTIONS)
 
-def generate_lyrics(text: str) -> Optional[Tuple[str, str]]:
-    """Genera prima un riassunto e poi i testi della canzone usando OpenAI."""
+def kieai_request(method: str, url: str, **kwargs) -> requests.Response:
+    """
+    Richiesta a KieAI che fallisce anche quando l'errore arriva nel corpo JSON
+    (`code` 429 o 5xx con HTTP 200), così RateLimiter può ritentarla.
+    """
+    resp = kieai_session.request(method, url, **kwargs)
+    resp.raise_for_status()
+    try:
+        code = resp.json().get("code")
+    except ValueError:
+        code = None
+    if isinstance(code, int) and (code == 429 or code >= 500):
+        resp.status_code = code
+        raise requests.exceptions.HTTPError(f"KieAI code {code}: {resp.text[:200]}", response=resp)
+    return resp
+
+def chat_completion(model: str, messages: list[dict], stage: str, on_text: Optional[Callable[[str], None]] = None,
+                    stream: Optional[bool] = None, **kwargs) -> str:
+    """
+    Una chat completion OpenAI. In streaming i frammenti vengono inoltrati come eventi
+    `stream` e `on_text` riceve il testo accumulato dopo ogni frammento.
+    """
+    stream = LLM_STREAM if stream is None else stream
+    if not stream:
+        response = call_with_retry(
+            lambda: openai_client.chat.completions.create(model=model, messages=messages, **kwargs),
+            "openai", model, on_retry=log_debug)
+        return response.choices[0].message.content.strip()
+
+    # Si ritenta solo l'apertura dello stream: un errore a metà risposta risale al chiamante
+    parts = []
+    chunks = call_with_retry(
+        lambda: openai_client.chat.completions.create(model=model, messages=messages, stream=True, **kwargs),
+        "openai", model, on_retry=log_debug)
+    for chunk in chunks:
+        delta = chunk.choices[0].delta.content if chunk.choices else None
+        if not delta:
+            continue
+        parts.append(delta)
+        log_stream(stage, delta)
+        if on_text:
+            on_text("".join(parts))
+    return "".join(parts).strip()
+
+def extract_json_string_field(buffer: str, field: str) -> Optional[str]:
+    """Valore di un campo stringa di un JSON ancora incompleto, se quel campo è già chiuso."""
+    match = re.search(r'"%s"\s*:\s*"' % re.escape(field), buffer)
+    if not match:
+        return None
+    try:
+        value, _ = json.JSONDecoder().raw_decode(buffer, match.end() - 1)
+        return value
+    except json.JSONDecodeError:
+        return None
+
+def generate_lyrics(text: str, on_summary: Optional[Callable[[str], None]] = None,
+                    mode: Optional[str] = None, stream: Optional[bool] = None) -> Optional[Tuple[str, str]]:
+    """
+    Genera riassunto e testi della canzone usando OpenAI.
+    "two_step": riassunto con SUMMARY_MODEL, poi lyrics con LYRICS_MODEL (due richieste);
+    "fused": una sola richiesta a LYRICS_MODEL con output strutturato {summary, lyrics}.
+    `on_summary` viene chiamata una volta, appena il riassunto è completo.
+    """
+    mode = mode or LYRICS_MODE
+    summary_sent = False
+
+    def deliver_summary(summary: str):
+        nonlocal summary_sent
+        if on_summary and not summary_sent:
+            summary_sent = True
+            on_summary(summary)
+
     log_milestone("Genero riassunto & lyrics...")
     try:
-        # 1. Genera riassunto
-        summary_response = openai_client.chat.completions.create(
-            model=SUMMARY_MODEL,
-            messages=[
-                {"role": "system", "content": SUMMARY_SYSTEM_PROMPT},
-                {"role": "user", "content": text}
-            ],
-            max_tokens=SUMMARY_MAX_TOKENS,
-            temperature=SUMMARY_TEMPERATURE
-        )
-        summary = summary_response.choices[0].message.content.strip()
-
-        # 2. Genera testi basati sul riassunto
-        final_lyrics_prompt = f"{LYRICS_MASTER_PROMPT}\n\n---\n\n{summary}"
-        lyrics_response = openai_client.chat.completions.create(
-            model=LYRICS_MODEL,
-            messages=[{"role": "user", "content": final_lyrics_prompt}]
-        )
-        lyrics = lyrics_response.choices[0].message.content.strip()
+        source = text
+        if INCREMENTAL_SUMMARIES:
+            source, hits, dropped = summarize_batch(openai_client, text)
+            log_milestone(f"Riassunti per trascrizione: {hits} dalla cache, {dropped} esclusi dal budget")
+
+        if mode == "fused":
+            def watch_summary(partial: str):
+                # Il riassunto precede le lyrics nello schema: appena è chiuso lo si consegna
+                if summary_sent:
+                    return
+                summary = extract_json_string_field(partial, "summary")
+                if summary is not None:
+                    deliver_summary(summary.strip())
+
+            raw = chat_completion(
+                LYRICS_MODEL,
+                [
+                    {"role": "system", "content": FUSED_SYSTEM_PROMPT},
+                    {"role": "user", "content": source}
+                ],
+                stage="fused",
+                on_text=watch_summary,
+                stream=stream,
+                response_format=FUSED_RESPONSE_FORMAT
+            )
+            result = json.loads(raw)
+            summary, lyrics = result["summary"].strip(), result["lyrics"].strip()
+            deliver_summary(summary)
+        else:
+            # 1. Genera riassunto (già pronto se i riassunti sono incrementali)
+            if INCREMENTAL_SUMMARIES:
+                summary = source
+            else:
+                summary = chat_completion(
+                    SUMMARY_MODEL,
+                    [
+                        {"role": "system", "content": SUMMARY_SYSTEM_PROMPT},
+                        {"role": "user", "content": text}
+                    ],
+                    stage="summary",
+                    stream=stream,
+                    max_tokens=SUMMARY_MAX_TOKENS,
+                    temperature=SUMMARY_TEMPERATURE
+                )
+            deliver_summary(summary)
+
+            # 2. Genera testi basati sul riassunto
+            final_lyrics_prompt = f"{LYRICS_MASTER_PROMPT}\n\n---\n\n{summary}"
+            lyrics = chat_completion(
+                LYRICS_MODEL,
+                [{"role": "user", "content": final_lyrics_prompt}],
+                stage="lyrics",
+                stream=stream
+            )
         log_milestone("Testo della canzone ricevuto da OpenAI")
         return lyrics, summary
     except Exception as e:
         log_error(f"Errore durante la generazione del testo con OpenAI: {e}")
         return None
 
-def generate_music(lyrics: str, style: str) -> Optional[Path]:
-    """Invia i testi all'API musicale, esegue il polling e scarica il file audio."""
-    session = requests.Session()
-    session.headers.update({"Authorization": f"Bearer {KIEAI_API_KEY}", "Content-Type": "application/json"})
-    payload = {
-        "prompt": lyrics,
-        "customMode": True,
-        "model": MUSIC_MODEL,
-        "style": style,
-        "instrumental": IS_INSTRUMENTAL,
-        "callBackUrl": CALLBACK_URL
-    }
-    
-    # Stampa i dettagli per il log del processo padre e poi invia la richiesta
-    print(f"Modello: {MUSIC_MODEL}, Stile: {style}") # Catturato da Producer.py
-    log_milestone("INVIO ALL'API")
-    
+def lyrics_cache_key(text: str) -> str:
+    """Hash di trascrizioni, modalità, modelli e prompt: cambiare uno di questi invalida la voce."""
+    return content_hash(text.strip(), LYRICS_MODE, str(INCREMENTAL_SUMMARIES), SUMMARY_MODEL,
+                        SUMMARY_SYSTEM_PROMPT, LYRICS_MODEL, LYRICS_MASTER_PROMPT)
+
+# Stati finali di un task che non produrrà audio ("NETWORK_ERROR" è locale: troppi polling falliti)
+FAILED_STATUSES = ("FAILURE", "SENSITIVE_WORD_ERROR", "GENERATE_AUDIO_FAILED", "NETWORK_ERROR")
+MAX_POLLING_NETWORK_ERRORS = 3
+
+class KieTask:
+    """Un task di generazione KieAI: identificativo, ultimo stato visto e calendario di polling."""
+
+    def __init__(self, task_id: str, status: str, submitted_at: Optional[float] = None):
+        self.task_id = task_id
+        self.status = status
+        self.data: dict = {}
+        # `submitted_at` (epoch) arriva dallo stato del job quando il task viene ripreso dopo un riavvio
+        self.resumed = submitted_at is not None
+        self.submitted_wall = submitted_at if submitted_at is not None else time.time()
+        self.submitted_at = time.monotonic() - (time.time() - self.submitted_wall)
+        self.poller = AdaptivePoller(MUSIC_MODEL, base_interval=POLL_INTERVAL)
+        self.network_errors = 0
+
+    def to_state(self) -> dict:
+        return {"task_id": self.task_id, "submitted_at": self.submitted_wall}
+
+    def tracks(self) -> list[dict]:
+        """Tracce scaricabili presenti nell'ultima risposta."""
+        tracks = [t for t in (self.data.get("response", {}).get("sunoData") or []) if t.get("audioUrl")]
+        if not tracks and self.data.get("audio_url"):
+            tracks = [{"audioUrl": self.data["audio_url"]}]
+        return tracks
+
+def submit_generation(payload: dict) -> Optional[KieTask]:
+    """Invia una richiesta di generazione. Ritorna il task creato, o None in caso di errore."""
     try:
-        resp = session.post("https://kieai.erweima.ai/api/v1/generate", json=payload)
-        resp.raise_for_status()
+        resp = call_with_retry(
+            lambda: kieai_request("POST", "https://kieai.erweima.ai/api/v1/generate", json=payload),
+            "kieai", MUSIC_MODEL, on_retry=log_info)
         data = resp.json().get("data")
         if data is None:
             log_error(f"La risposta dell'API musicale non contiene il campo 'data'. Risposta: {resp.json()}")
@@ -162,74 +368,404 @@ def generate_music(lyrics: str, style: str) -> Optional[Path]:
     except requests.exceptions.RequestException as e:
         log_error(f"Errore nella richiesta iniziale all'API musicale: {e}")
         return None
-    
+
     task_id = data.get("taskId")
     if not task_id:
         log_error("Nessun taskId ricevuto dall'API musicale.")
         return None
-    
-    log_milestone(f"Richiesta accettata. Task ID: {task_id}. Inizio polling...")
-    status = data.get("status", "PENDING")
-    
-    MAX_POLLING_NETWORK_ERRORS = 3
-    network_error_count = 0
-    for attempt in range(MAX_POLL_ATTEMPTS):
-        if status in ("FAILURE", "SENSITIVE_WORD_ERROR", "GENERATE_AUDIO_FAILED"):
-            log_error(f"La generazione musicale è fallita. Stato API: {status}")
+    return KieTask(task_id, data.get("status", "PENDING"))
+
+def poll_task(task: KieTask):
+    """Aggiorna stato e dati di un task. Dopo troppi errori di rete consecutivi il task è dato per perso."""
+    try:
+        # Un solo tentativo: i retry del polling restano quelli qui sotto,
+        # ma il limitatore e l'eventuale Retry-After valgono anche qui
+        r = call_with_retry(
+            lambda: kieai_request("GET", f"https://kieai.erweima.ai/api/v1/generate/record-info?taskId={task.task_id}"),
+            "kieai", MUSIC_MODEL, max_attempts=1)
+        task.data = r.json().get("data") or {}
+        task.status = task.data.get("status", "UNKNOWN")
+        task.poller.observe(time.monotonic() - task.submitted_at, task.status)
+        task.network_errors = 0 # Reset su successo
+    except requests.exceptions.RequestException as e:
+        task.network_errors += 1
+        log_debug(f"Errore di rete durante il polling di {task.task_id} (tentativo {task.network_errors}/{MAX_POLLING_NETWORK_ERRORS}): {e}")
+        if task.network_errors >= MAX_POLLING_NETWORK_ERRORS:
+            log_error(f"Troppi errori di rete consecutivi durante il polling di {task.task_id}. Interrompo.")
+            task.status = "NETWORK_ERROR"
+            return
+        # Backoff esponenziale per non sovraccaricare l'API
+        time.sleep(POLL_INTERVAL * (2 ** (task.network_errors - 1)))
+
+def wait_for_tracks(payload: dict, state: JobState,
+                    on_stream: Optional[Callable[[str, str], None]] = None) -> Optional[list[dict]]:
+    """
+    Invia la generazione (o riprende i task salvati nello stato del job) ed esegue il
+    polling fino alla prima riuscita. Ritorna le tracce da scaricare, o None.
+    `on_stream(url, stato)` riceve lo streamAudioUrl della prima traccia appena compare.
+    """
+    saved_tasks = state.get("tasks") or []
+    if saved_tasks:
+        # Task già inviati (e pagati) prima di un riavvio: si riprende il polling
+        tasks = [KieTask(t["task_id"], "PENDING", submitted_at=t["submitted_at"]) for t in saved_tasks]
+        log_milestone(f"Riprendo il polling del task {tasks[0].task_id}")
+        for task in tasks:
+            poll_task(task)
+    else:
+        log_info(f"Modello: {MUSIC_MODEL}, Stile: {payload['style']}") # Catturato da Producer.py
+        log_milestone("INVIO ALL'API")
+        task = submit_generation(payload)
+        if task is None:
+            return None
+        tasks = [task]
+        state.update(stage="submitted", tasks=[task.to_state()])
+        log_milestone(f"Richiesta accettata. Task ID: {task.task_id}. Inizio polling...")
+    primary = tasks[0]
+
+    # Il budget di attesa resta quello storico (MAX_POLL_ATTEMPTS x POLL_INTERVAL),
+    # ma il ritmo dei polling segue le latenze osservate per questo modello.
+    poll_deadline = MAX_POLL_ATTEMPTS * POLL_INTERVAL
+    # Con l'hedging attivo, oltre un percentile alto della latenza storica parte un duplicato
+    hedge_at = hedge_after(MUSIC_MODEL) if HEDGE_ENABLED and len(tasks) == 1 else None
+    winner = None
+    while winner is None:
+        active = [t for t in tasks if t.status not in FAILED_STATUSES]
+        if not active:
+            log_error(f"La generazione musicale è fallita. Stato API: {tasks[-1].status}")
             return None
-        if status == "SUCCESS":
-            log_milestone("API musicale ha terminato la generazione con successo")
+        winner = next((t for t in active if t.status == "SUCCESS"), None)
+        if winner:
             break
-            
-        time.sleep(POLL_INTERVAL)
-        
-        try:
-            r = session.get(f"https://kieai.erweima.ai/api/v1/generate/record-info?taskId={task_id}")
-            r.raise_for_status()
-            data = r.json().get("data", {})
-            status = data.get("status", "UNKNOWN")
-            network_error_count = 0 # Reset su successo
-        except requests.exceptions.RequestException as e:
-            network_error_count += 1
-            log_debug(f"Errore di rete durante il polling (tentativo {network_error_count}/{MAX_POLLING_NETWORK_ERRORS}): {e}")
-            if network_error_count >= MAX_POLLING_NETWORK_ERRORS:
-                log_error(f"Troppi errori di rete consecutivi durante il polling. Interrompo.")
-                return None
-            # Backoff esponenziale per non sovraccaricare l'API
-            wait_time = POLL_INTERVAL * (2 ** (network_error_count - 1))
-            time.sleep(wait_time)
-            continue
-    else: # Questo `else` si attiva solo se il loop `for` finisce senza `break`
-        log_error(f"Timeout durante la generazione della musica. Ultimo stato noto: {status}")
+
+        elapsed = time.monotonic() - primary.submitted_at
+        if elapsed >= poll_deadline:
+            log_error(f"Timeout durante la generazione della musica. Ultimo stato noto: {primary.status}")
+            return None
+        if hedge_at is not None and elapsed >= hedge_at:
+            hedge_at = None # Al massimo un duplicato per canzone
+            if reserve_hedge_slot(time.time()):
+                log_milestone(f"Task {primary.task_id} oltre il p{HEDGE_PERCENTILE:g} della latenza ({elapsed:.0f}s): invio un duplicato")
+                hedge = submit_generation(payload)
+                if hedge:
+                    tasks.append(hedge)
+                    active.append(hedge)
+                    state.update(tasks=[t.to_state() for t in tasks])
+            else:
+                log_info(f"Hedging saltato: già {HEDGE_MAX_PER_HOUR} duplicati nell'ultima ora")
+
+        delays = [t.poller.next_delay(time.monotonic() - t.submitted_at) for t in active]
+        if hedge_at is not None:
+            delays.append(hedge_at - elapsed)
+        time.sleep(max(0.0, min(min(delays), poll_deadline - elapsed)))
+
+        for task in active:
+            poll_task(task)
+            if on_stream:
+                first_track = (task.data.get("response", {}).get("sunoData") or [{}])[0]
+                if first_track.get("streamAudioUrl"):
+                    on_stream(first_track["streamAudioUrl"], task.status)
+
+    # I campioni di un task ripreso dopo un riavvio falserebbero lo storico delle latenze
+    report = winner.poller.record(persist=not winner.resumed)
+    log_milestone("API musicale ha terminato la generazione con successo")
+    delay = report["detection_delay"]
+    delay_str = f"{delay:.1f}s" if delay is not None else "N/A"
+    log_milestone(f"Polling: {report['requests']} richieste, ritardo di rilevamento <= {delay_str}")
+
+    # Ogni generazione restituisce più tracce (di solito due): le paghiamo tutte, le scarichiamo tutte
+    tracks = winner.tracks()
+    if not tracks:
+        log_error(f"Nessun URL audio trovato nella risposta finale dell'API. Dati ricevuti: {winner.data}")
         return None
-    
-    try:
-        # Cerca l'URL audio in più punti per robustezza
-        audio_url = data.get("response", {}).get("sunoData", [{}])[0].get("audioUrl") or data.get("audio_url")
-        if not audio_url:
-            log_error(f"Nessun URL audio trovato nella risposta finale dell'API. Dati ricevuti: {data}")
+
+    if len(tasks) > 1:
+        log_milestone(f"Hedging: vince il task {'duplicato' if winner is not primary else 'originale'} {winner.task_id}")
+        for loser in tasks:
+            if loser is winner or loser.status in FAILED_STATUSES:
+                continue
+            # KieAI non offre un'API per annullare un task: un ultimo polling,
+            # e se nel frattempo ha finito anche lui le sue tracce vanno in riserva
+            poll_task(loser)
+            if loser.status == "SUCCESS":
+                loser.poller.record(persist=not loser.resumed)
+                extra = loser.tracks()
+                log_milestone(f"Anche il task {loser.task_id} è pronto: {len(extra)} tracce in più")
+                tracks += extra
+            else:
+                log_info(f"Task {loser.task_id} abbandonato (stato {loser.status})")
+    return tracks
+
+def generate_music(lyrics: str, style: str, on_early_audio: Optional[Callable[..., None]] = None,
+                   state: Optional[JobState] = None) -> Optional[list[Tuple[Path, dict]]]:
+    """
+    Invia i testi all'API musicale, esegue il polling e scarica in parallelo
+    tutte le tracce restituite. Ritorna la lista di (percorso, dati traccia).
+    Con EARLY_PUBLISH attivo, `on_early_audio(percorso, url=..., partial=...)` viene
+    chiamata una sola volta per la prima traccia, prima che il download sia completo.
+    Con uno `state` persistente, task e tracce già ottenuti prima di un riavvio vengono ripresi.
+    """
+    state = state or JobState(None)
+    # Il nome dei file è deciso subito (e salvato), così una pubblicazione anticipata
+    # conosce già il percorso finale e un download ripreso ritrova il suo `.part`
+    track_prefix = state.get("track_prefix")
+    if not track_prefix:
+        track_prefix = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{''.join(random.choices('0123456789abcdef', k=4))}"
+        state.update(track_prefix=track_prefix)
+
+    def track_path(index: int) -> Path:
+        return OUTPUT_DIR / f"{track_prefix}_{index}.mp3"
+
+    early_published = on_early_audio is None or EARLY_PUBLISH == "off"
+
+    def publish_stream(url: str, status: str):
+        nonlocal early_published
+        if not early_published and EARLY_PUBLISH == "stream":
+            log_milestone(f"Pubblicazione anticipata in streaming (stato {status})")
+            on_early_audio(track_path(1), url=url)
+            early_published = True
+
+    tracks = state.get("tracks")
+    if tracks:
+        log_milestone("Tracce già pronte prima del riavvio: riprendo il download")
+    else:
+        payload = {
+            "prompt": lyrics,
+            "customMode": True,
+            "model": MUSIC_MODEL,
+            "style": style,
+            "instrumental": IS_INSTRUMENTAL,
+            "callBackUrl": CALLBACK_URL
+        }
+        tracks = wait_for_tracks(payload, state, on_stream=publish_stream)
+        if not tracks:
             return None
-            
-        log_milestone("Download del file audio generato")
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        random_suffix = ''.join(random.choices('0123456789abcdef', k=4))
-        mp3_filepath = OUTPUT_DIR / f"{timestamp}_{random_suffix}.mp3"
-        
-        with requests.get(audio_url, stream=True, timeout=120) as r:
-            r.raise_for_status()
-            with open(mp3_filepath, "wb") as f:
-                for chunk in r.iter_content(chunk_size=8192):
-                    f.write(chunk)
-        
-        log_milestone("COMPLETATO!")
-        return mp3_filepath
-    except Exception as e:
-        log_error(f"Errore critico durante il download o il salvataggio del file audio: {e}")
+        state.update(stage="downloading", tracks=tracks)
+
+    log_milestone(f"Download di {len(tracks)} tracce generate")
+    downloads = []
+    with ThreadPoolExecutor(max_workers=len(tracks)) as executor:
+        futures = {}
+        for index, track in enumerate(tracks, start=1):
+            if track_path(index).exists():
+                downloads.append((index, track_path(index), track)) # Già scaricata prima di un riavvio
+                continue
+            on_first_bytes = None
+            if index == 1 and not early_published:
+                # Modalità "file" (o stream mai arrivato): si pubblica il file mentre cresce
+                on_first_bytes = lambda part: on_early_audio(track_path(1), partial=part)
+            futures[executor.submit(download_file, track["audioUrl"], track_path(index), download_session, on_first_bytes)] = (index, track)
+        for future in as_completed(futures):
+            index, track = futures[future]
+            try:
+                downloads.append((index, future.result(), track))
+            except Exception as e:
+                log_error(f"Errore critico durante il download o il salvataggio della traccia {index}: {e}")
+
+    if not downloads:
         return None
+    log_milestone("COMPLETATO!")
+    return [(path, track) for _, path, track in sorted(downloads, key=lambda d: d[0])]
+
+def run_job(table_number: str, concatenated_text: str, job_dir: Optional[Path] = None) -> bool:
+    """
+    Esegue un job completo (testo, musica, metadati). Ritorna True se almeno una canzone è pronta.
+    Con `job_dir` l'avanzamento viene salvato in `job_dir/job.json` e un job interrotto
+    riparte dall'ultima fase completata.
+    """
+    # Assicura che la directory di output esista
+    OUTPUT_DIR.mkdir(exist_ok=True)
+    state = JobState(job_dir)
+    if state.get("stage"):
+        log_milestone(f"Riprendo il job dalla fase '{state.get('stage')}'")
+    if state.get("stage") == "done":
+        # Canzoni già pronte: il Producer era stato interrotto prima di accodarle
+        for song_data in state.get("songs", []):
+            emit_song(song_data)
+        return True
+    
+    def archive_summary(summary: str):
+        """Archivia il riassunto appena è completo, anche prima delle lyrics."""
+        archive_summary_dir = ARCHIVE_BASE_DIR / table_number
+        archive_summary_dir.mkdir(parents=True, exist_ok=True)
+        summary_filename = f"summary_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
+        (archive_summary_dir / summary_filename).write_text(summary, encoding="utf-8")
+        log_milestone("Riassunto archiviato")
+
+    if state.get("lyrics"):
+        lyrics, style = state.get("lyrics"), state.get("style")
+    else:
+        cache_key = lyrics_cache_key(concatenated_text)
+        cached = lyrics_cache.get(cache_key)
+        if cached:
+            # Testo già generato (e pagato) da un tentativo precedente: si passa subito alla musica
+            lyrics, summary = cached["lyrics"], cached["summary"]
+            hit_rate = lyrics_cache.hit_rate() or 0.0
+            log_milestone(f"Lyrics dalla cache (hit rate {hit_rate:.0%}), salto OpenAI")
+        else:
+            result = generate_lyrics(concatenated_text, on_summary=archive_summary)
+            if not result:
+                return False
+            lyrics, summary = result
+            lyrics_cache.put(cache_key, {"lyrics": lyrics, "summary": summary})
+        style = choose_random_style()
+        state.update(stage="lyrics", lyrics=lyrics, summary=summary, style=style)
+
+    # Genera la musica
+    def publish_early(music_path: Path, url: Optional[str] = None, partial: Optional[Path] = None):
+        """Consegna subito la riga JSON della prima traccia, marcata come anticipata."""
+        early_data = {"path": str(music_path.resolve()), "table": table_number, "style": style, "track": 1, "early": True,
+                      "created": round(time.time(), 1)}
+        if url:
+            early_data["url"] = url
+        if partial:
+            early_data["partial"] = str(partial.resolve())
+        emit_song(early_data)
+
+    music_tracks = generate_music(lyrics, style, on_early_audio=publish_early, state=state)
+    if not music_tracks:
+        return False
+
+    # Durata, loudness e picchi di ogni traccia, analizzate in parallelo una sola volta
+    with ThreadPoolExecutor(max_workers=len(music_tracks)) as executor:
+        analyses = list(executor.map(analyse_song, [music_path for music_path, _ in music_tracks]))
+
+    # Salva i metadati (testo, stile, trascrizione completa) accanto a ogni file audio
+    # e prepara una riga JSON per traccia, che il processo Producer catturerà
+    songs = []
+    for index, ((music_path, track), meta) in enumerate(zip(music_tracks, analyses), start=1):
+        track_style = track.get("tags") or style
+        music_path.with_suffix('.style.txt').write_text(track_style, encoding="utf-8")
+        music_path.with_suffix('.lyrics.txt').write_text(track.get("prompt") or lyrics, encoding="utf-8")
+        music_path.with_suffix('.full-transcript.txt').write_text(concatenated_text, encoding="utf-8")
+
+        song_data = {
+            "path": str(music_path.resolve()), # .resolve() garantisce un percorso assoluto
+            "table": table_number,
+            "style": track_style,
+            "track": index,
+            "tracks": len(music_tracks),
+            "created": round(time.time(), 1)
+        }
+        if meta:
+            write_meta(music_path, meta)
+            song_data.update(meta)
+        else:
+            log_error(f"Analisi della traccia {index} non riuscita (ffmpeg?): il player chiederà la durata a mpv")
+        songs.append(song_data)
+    state.update(stage="done", songs=songs)
+    for song_data in songs:
+        emit_song(song_data)
+    return True
+
+def read_job_text(job: dict) -> str:
+    """Testo di un job del protocollo: `text` diretto, oppure `path` di un file o di una cartella di .txt."""
+    if job.get("text"):
+        return job["text"]
+    path = Path(job.get("path") or "")
+    if path.is_dir():
+        return "\n---\n".join(p.read_text(encoding="utf-8") for p in sorted(path.glob("*.txt")))
+    if path.is_file():
+        return path.read_text(encoding="utf-8")
+    return ""
+
+def serve_stream(reader, write_line: Callable[[str], None]):
+    """
+    Ciclo del protocollo JSON-lines: legge un job per riga e risponde con eventi
+    `progress`, `log`, `song` e infine un `result` con lo stesso `id` del job.
+    """
+    global event_sink
+    write_lock = threading.Lock() # Gli eventi possono arrivare anche dai thread di download
+
+    def send(event: dict):
+        with write_lock:
+            write_line(json.dumps(event))
+
+    for raw_line in reader:
+        if not raw_line.strip():
+            continue
+        try:
+            job = json.loads(raw_line)
+        except json.JSONDecodeError as e:
+            send({"event": "result", "id": None, "ok": False, "error": f"JSON non valido: {e}"})
+            continue
+        job_id = job.get("id")
+        event_sink = lambda event: send({"id": job_id, **event})
+        try:
+            text = read_job_text(job)
+            if not text.strip():
+                log_error("Job senza testo. Impossibile procedere.")
+                ok = False
+            else:
+                job_dir = Path(job["job_dir"]) if job.get("job_dir") else None
+                ok = run_job(str(job.get("table", "0")), text, job_dir)
+        except Exception as e:
+            log_error(f"Errore inatteso nel job {job_id}: {e}")
+            ok = False
+        finally:
+            event_sink = None
+        send({"event": "result", "id": job_id, "ok": ok})
+
+def serve(socket_path: Optional[str] = None):
+    """Daemon persistente: job su stdin (default) o su un socket Unix, un job alla volta."""
+    log_debug(f"Worker GenerateSong in ascolto su {socket_path or 'stdin'} (PID {os.getpid()}).")
+    if not socket_path:
+        def write_stdout(line: str):
+            sys.stdout.write(line + "\n")
+            sys.stdout.flush()
+        serve_stream(sys.stdin, write_stdout)
+        return
+
+    import socketserver
+
+    class JobHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            def write_socket(line: str):
+                self.wfile.write((line + "\n").encode("utf-8"))
+                self.wfile.flush()
+            serve_stream((line.decode("utf-8") for line in self.rfile), write_socket)
+
+    Path(socket_path).unlink(missing_ok=True)
+    with socketserver.UnixStreamServer(socket_path, JobHandler) as server:
+        server.serve_forever()
+
+def benchmark_text_stage(text_path: str, runs: int = 1):
+    """Confronta la latenza end-to-end della fase testo nelle due modalità, con e senza streaming."""
+    global event_sink
+    text = Path(text_path).read_text(encoding="utf-8")
+    event_sink = lambda event: None # Niente milestone a schermo durante le misure
+    if INCREMENTAL_SUMMARIES:
+        summarize_batch(openai_client, text) # Cache calda per tutti, come a regime
+    print(f"{'modalità':<10} {'stream':<7} {'riassunto (s)':>14} {'totale (s)':>11}  riusciti")
+    for mode in ("two_step", "fused"):
+        for stream in (False, True):
+            summary_times, totals = [], []
+            for _ in range(runs):
+                started = time.perf_counter()
+                result = generate_lyrics(
+                    text,
+                    on_summary=lambda _: summary_times.append(time.perf_counter() - started),
+                    mode=mode,
+                    stream=stream
+                )
+                if result:
+                    totals.append(time.perf_counter() - started)
+            mean = lambda values: f"{sum(values) / len(values):.2f}" if values else "N/A"
+            print(f"{mode:<10} {str(stream):<7} {mean(summary_times):>14} {mean(totals):>11}  {len(totals)}/{runs}")
+    event_sink = None
 
 def main():
+    if "--bench-text" in sys.argv:
+        runs = int(sys.argv[sys.argv.index("--runs") + 1]) if "--runs" in sys.argv else 3
+        benchmark_text_stage(sys.argv[sys.argv.index("--bench-text") + 1], runs)
+        return
+
+    if "--serve" in sys.argv:
+        socket_path = sys.argv[sys.argv.index("--socket") + 1] if "--socket" in sys.argv else None
+        serve(socket_path)
+        return
+
     if len(sys.argv) < 2:
-        log_error("Uso: python GenerateSong.py <table_number>")
+        log_error("Uso: python GenerateSong.py <table_number> [--job-dir DIR] | --serve [--socket PATH] | --bench-text FILE [--runs N]")
         sys.exit(1)
         
     table_number = sys.argv[1]
@@ -238,39 +774,10 @@ def main():
     if not concatenated_text.strip():
         log_error("Input da stdin vuoto. Impossibile procedere.")
         sys.exit(1)
-    
-    # Assicura che la directory di output esista
-    OUTPUT_DIR.mkdir(exist_ok=True)
-    
-    result = generate_lyrics(concatenated_text)
-    if not result:
-        sys.exit(1)
-    lyrics, summary = result
-    
-    # Archivia il riassunto
-    archive_summary_dir = ARCHIVE_BASE_DIR / table_number
-    archive_summary_dir.mkdir(parents=True, exist_ok=True)
-    summary_filename = f"summary_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
-    (archive_summary_dir / summary_filename).write_text(summary, encoding="utf-8")
-    
-    # Genera la musica
-    style = choose_random_style()
-    music_path = generate_music(lyrics, style)
-    if not music_path:
-        sys.exit(1)
 
-    # Salva i metadati (testo, stile, trascrizione completa) accanto al file audio
-    music_path.with_suffix('.style.txt').write_text(style, encoding="utf-8")
-    music_path.with_suffix('.lyrics.txt').write_text(lyrics, encoding="utf-8")
-    music_path.with_suffix('.full-transcript.txt').write_text(concatenated_text, encoding="utf-8")
-    
-    # Stampa il JSON finale che il processo Producer catturerà
-    output_data = {
-        "path": str(music_path.resolve()), # .resolve() garantisce un percorso assoluto
-        "table": table_number,
-        "style": style
-    }
-    print(json.dumps(output_data))
+    job_dir = Path(sys.argv[sys.argv.index("--job-dir") + 1]) if "--job-dir" in sys.argv else None
+    if not run_job(table_number, concatenated_text, job_dir):
+        sys.exit(1)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
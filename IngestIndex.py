@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# ____    _    ____   ____    _    ____  ____
+#| __ )  / \  |  _ \ | __ )  / \  |  _ \|  _ \
+#|  _ \ / _ \ | |_) ||  _ \ / _ \ | |_) | | | |
+#| |_) / ___ \|  _ < | |_) / ___ \|  _ <| |_| |
+#|____/_/   \_\_| \_\|____/_/   \_\_| \_\____/
+
+"""
+IngestIndex.py: Indice in memoria delle trascrizioni in attesa, per tavolo.
+AudioWatchdog annota ogni trascrizione salvata in `.tmp_player/ingest.log` (una riga
+JSON per evento); il Producer legge solo le righe nuove a ogni ciclo, invece di
+riscandire tutte le cartelle di WORK_IN_PROGRESS. Una scansione completa avviene
+all'avvio e, come rete di sicurezza, ogni INGEST_RESCAN_SECONDS.
+
+I tavoli sono identificati da stringhe: "12" oppure, con più locali, "venue.12".
+"""
+
+import os
+import re
+import json
+import time
+from pathlib import Path
+from typing import Optional
+
+from filelock import FileLock
+
+try:
+    PROJECT_ROOT = Path(__file__).parent.resolve()
+except NameError:
+    PROJECT_ROOT = Path('.').resolve()
+
+# --- CONFIGURAZIONE ---
+TMP_DIR = PROJECT_ROOT / ".tmp_player"
+INGEST_LOG_FILE = TMP_DIR / "ingest.log"
+INGEST_LOCK_FILE = TMP_DIR / "ingest.log.lock"
+INGEST_RESCAN_SECONDS = float(os.getenv("INGEST_RESCAN_SECONDS", "60"))
+# Oltre questa dimensione il log, già letto per intero, viene svuotato
+INGEST_LOG_MAX_BYTES = 1024 * 1024
+
+# Numero del tavolo, eventualmente preceduto dal nome del locale: "12", "terrazza.12"
+TABLE_ID_RE = re.compile(r"^(?:[A-Za-z0-9]+\.)?\d+$")
+
+
+def is_table_id(name: str) -> bool:
+    return bool(TABLE_ID_RE.match(name))
+
+
+def record_ingest(table: str, path: Path):
+    """Chiamata da AudioWatchdog dopo aver scritto una trascrizione."""
+    TMP_DIR.mkdir(exist_ok=True)
+    stat = path.stat()
+    event = {"table": table, "path": str(path), "mtime": stat.st_mtime, "bytes": stat.st_size}
+    with FileLock(INGEST_LOCK_FILE):
+        with open(INGEST_LOG_FILE, "a", encoding="utf-8") as f:
+            f.write(json.dumps(event) + "\n")
+
+
+class PendingIndex:
+    """Trascrizioni in attesa: tavolo -> {percorso: (mtime, byte)}."""
+
+    def __init__(self, work_dir: Path):
+        self.work_dir = work_dir
+        self.pending: dict[str, dict[str, tuple[float, int]]] = {}
+        self.offset = 0
+        self.last_rescan = 0.0
+
+    def rescan(self):
+        """Ricostruisce l'indice dal disco (avvio e controllo periodico)."""
+        pending = {}
+        for table_dir in self.work_dir.iterdir():
+            if not table_dir.is_dir() or not is_table_id(table_dir.name):
+                continue
+            files = {}
+            for path in table_dir.glob("*.txt"):
+                try:
+                    stat = path.stat()
+                except FileNotFoundError:
+                    continue
+                files[str(path)] = (stat.st_mtime, stat.st_size)
+            if files:
+                pending[table_dir.name] = files
+        self.pending = pending
+        self.last_rescan = time.monotonic()
+        # Gli eventi già scritti sono compresi nella scansione
+        self.offset = INGEST_LOG_FILE.stat().st_size if INGEST_LOG_FILE.exists() else 0
+
+    def poll(self):
+        """Applica gli eventi arrivati dall'ultima chiamata (o riscandisce, se è ora)."""
+        if not self.last_rescan or time.monotonic() - self.last_rescan >= INGEST_RESCAN_SECONDS:
+            self.rescan()
+            return
+        if not INGEST_LOG_FILE.exists():
+            return
+        size = INGEST_LOG_FILE.stat().st_size
+        if size < self.offset:
+            self.offset = 0 # Log svuotato da un'altra istanza: si riparte dall'inizio
+        if size == self.offset:
+            return
+        with open(INGEST_LOG_FILE, "r", encoding="utf-8") as f:
+            f.seek(self.offset)
+            chunk = f.read()
+        # Solo righe complete: una riga a metà verrà letta al prossimo giro
+        complete = chunk[:chunk.rfind("\n") + 1]
+        self.offset += len(complete.encode("utf-8"))
+        for line in complete.splitlines():
+            try:
+                event = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if Path(event["path"]).exists():
+                self.pending.setdefault(event["table"], {})[event["path"]] = (event["mtime"], event["bytes"])
+        self._truncate_if_large()
+
+    def _truncate_if_large(self):
+        if self.offset < INGEST_LOG_MAX_BYTES:
+            return
+        with FileLock(INGEST_LOCK_FILE):
+            if INGEST_LOG_FILE.stat().st_size == self.offset: # Nessuna riga arrivata nel frattempo
+                INGEST_LOG_FILE.write_text("", encoding="utf-8")
+                self.offset = 0
+
+    def tables(self) -> list[str]:
+        return list(self.pending)
+
+    def stats(self, table: str) -> Optional[dict]:
+        """Come TableScheduler.transcript_stats, ma dall'indice."""
+        files = self.pending.get(table)
+        if not files:
+            return None
+        times = [mtime for mtime, _ in files.values()]
+        return {"count": len(files), "oldest": min(times), "newest": max(times),
+                "bytes": sum(size for _, size in files.values())}
+
+    def total(self) -> int:
+        return sum(len(files) for files in self.pending.values())
+
+    def take(self, table: str) -> list[Path]:
+        """Rimuove dall'indice le trascrizioni del tavolo e ne restituisce i percorsi."""
+        return [Path(p) for p in self.pending.pop(table, {})]
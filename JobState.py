@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# ____    _    ____   ____    _    ____  ____
+#| __ )  / \  |  _ \ | __ )  / \  |  _ \|  _ \
+#|  _ \ / _ \ | |_) ||  _ \ / _ \ | |_) | | | |
+#| |_) / ___ \|  _ < | |_) / ___ \|  _ <| |_| |
+#|____/_/   \_\_| \_\|____/_/   \_\_| \_\____/
+
+"""
+JobState.py: Avanzamento persistente di un job di generazione, salvato in
+`.tmp_player/jobs/<id>/job.json` accanto alle trascrizioni del batch.
+Se il Producer viene interrotto, al riavvio il job riparte dall'ultima fase
+completata (lyrics, task KieAI inviato, tracce da scaricare, canzoni pronte)
+senza ripagare le chiamate già fatte.
+
+Fasi, in ordine: "lyrics" -> "submitted" -> "downloading" -> "done".
+"""
+
+import os
+import json
+from pathlib import Path
+from typing import Any, Optional
+
+JOB_STATE_FILENAME = "job.json"
+
+
+class JobState:
+    """
+    Dizionario dello stato di un job, riscritto in modo atomico a ogni `update`.
+    Senza `job_dir` (es. GenerateSong lanciato a mano) vive solo in memoria.
+    """
+
+    def __init__(self, job_dir: Optional[Path]):
+        self.path = Path(job_dir) / JOB_STATE_FILENAME if job_dir else None
+        self.data = self._load()
+
+    def _load(self) -> dict:
+        if self.path is None:
+            return {}
+        try:
+            return json.loads(self.path.read_text(encoding="utf-8"))
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return self.data.get(key, default)
+
+    def update(self, **fields):
+        self.data.update(fields)
+        if self.path is None or not self.path.parent.exists():
+            return
+        tmp_path = self.path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(self.data, ensure_ascii=False, indent=2), encoding="utf-8")
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# ____    _    ____   ____    _    ____  ____
+#| __ )  / \  |  _ \ | __ )  / \  |  _ \|  _ \
+#|  _ \ / _ \ | |_) ||  _ \ / _ \ | |_) | | | |
+#| |_) / ___ \|  _ < | |_) / ___ \|  _ <| |_| |
+#|____/_/   \_\_| \_\|____/_/   \_\_| \_\____/
+
+"""
+KieLatency.py: Registra i tempi di generazione osservati sull'API KieAI
+(per modello e per stato intermedio, es. TEXT_SUCCESS / FIRST_SUCCESS)
+e ne ricava un calendario di polling adattivo: rado all'inizio, quando la
+canzone non può essere pronta, e fitto vicino alla finestra di completamento attesa.
+Dagli stessi dati viene la soglia oltre la quale un task lento viene duplicato (hedging).
+"""
+
+import os
+import json
+from pathlib import Path
+from typing import Optional
+
+from filelock import FileLock, Timeout
+
+try:
+    PROJECT_ROOT = Path(__file__).parent.resolve()
+except NameError:
+    PROJECT_ROOT = Path('.').resolve()
+
+# --- CONFIGURAZIONE ---
+TMP_DIR = PROJECT_ROOT / ".tmp_player"
+LATENCY_STATE_FILE = TMP_DIR / "kieai_latency.json"
+LATENCY_LOCK_FILE = TMP_DIR / "kieai_latency.json.lock"
+
+LATENCY_MAX_SAMPLES = int(os.getenv("LATENCY_MAX_SAMPLES", "200"))
+# Sotto questo numero di campioni il calendario resta quello fisso (POLL_INTERVAL)
+LATENCY_MIN_SAMPLES = int(os.getenv("LATENCY_MIN_SAMPLES", "5"))
+POLL_MIN_INTERVAL = float(os.getenv("POLL_MIN_INTERVAL", "2"))
+POLL_MAX_INTERVAL = float(os.getenv("POLL_MAX_INTERVAL", "30"))
+# Percentili che delimitano la finestra di completamento in cui il polling è fitto
+POLL_WINDOW_LOW = float(os.getenv("POLL_WINDOW_LOW", "10"))
+POLL_WINDOW_HIGH = float(os.getenv("POLL_WINDOW_HIGH", "90"))
+
+# Hedging: oltre questo percentile della latenza storica si invia una generazione duplicata
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "95"))
+# Tetto ai duplicati nell'ultima ora, condiviso tra i processi (ogni duplicato costa crediti)
+HEDGE_MAX_PER_HOUR = int(os.getenv("HEDGE_MAX_PER_HOUR", "4"))
+HEDGE_STATE_FILE = TMP_DIR / "kieai_hedges.json"
+
+# Stati intermedi dell'API, in ordine di avanzamento
+PROGRESS_STATUSES = ("TEXT_SUCCESS", "FIRST_SUCCESS", "SUCCESS")
+
+
+def percentile(values: list[float], q: float) -> Optional[float]:
+    """Percentile con interpolazione lineare (q in 0-100)."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    pos = (len(ordered) - 1) * q / 100.0
+    low = int(pos)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (pos - low)
+
+
+def load_latency_state() -> dict:
+    """Legge lo storico delle latenze. Uno stato mancante o corrotto vale come vuoto."""
+    try:
+        return json.loads(LATENCY_STATE_FILE.read_text(encoding="utf-8"))
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def model_samples(model: str, key: str, state: Optional[dict] = None) -> list[float]:
+    """Campioni registrati per un modello e una chiave (uno stato o una metrica)."""
+    state = load_latency_state() if state is None else state
+    return state.get(model, {}).get(key, [])
+
+
+def record_latency_samples(model: str, samples: dict[str, float]):
+    """Aggiunge i campioni di una generazione allo storico condiviso tra i processi."""
+    TMP_DIR.mkdir(exist_ok=True)
+    try:
+        with FileLock(LATENCY_LOCK_FILE, timeout=5):
+            state = load_latency_state()
+            per_model = state.setdefault(model, {})
+            for key, value in samples.items():
+                values = per_model.setdefault(key, [])
+                values.append(round(value, 2))
+                del values[:-LATENCY_MAX_SAMPLES]
+            tmp_file = LATENCY_STATE_FILE.with_suffix(".tmp")
+            tmp_file.write_text(json.dumps(state), encoding="utf-8")
+            os.replace(tmp_file, LATENCY_STATE_FILE)
+    except Timeout:
+        pass  # Le statistiche non devono mai bloccare una generazione
+
+
+def hedge_after(model: str, state: Optional[dict] = None) -> Optional[float]:
+    """Secondi dopo i quali un task è considerato in coda lunga. None se lo storico è insufficiente."""
+    totals = model_samples(model, "SUCCESS", state)
+    if len(totals) < LATENCY_MIN_SAMPLES:
+        return None
+    return percentile(totals, HEDGE_PERCENTILE)
+
+
+def reserve_hedge_slot(now: float) -> bool:
+    """Prenota un duplicato se nell'ultima ora non si è già raggiunto HEDGE_MAX_PER_HOUR."""
+    TMP_DIR.mkdir(exist_ok=True)
+    try:
+        with FileLock(LATENCY_LOCK_FILE, timeout=5):
+            try:
+                hedges = json.loads(HEDGE_STATE_FILE.read_text(encoding="utf-8"))
+            except (FileNotFoundError, json.JSONDecodeError):
+                hedges = []
+            hedges = [t for t in hedges if now - t < 3600]
+            if len(hedges) >= HEDGE_MAX_PER_HOUR:
+                return False
+            hedges.append(now)
+            HEDGE_STATE_FILE.write_text(json.dumps(hedges), encoding="utf-8")
+            return True
+    except Timeout:
+        return False
+
+
+class AdaptivePoller:
+    """
+    Decide quanto attendere prima del prossimo polling di un task KieAI e
+    tiene il conto delle richieste e del ritardo di rilevamento.
+    I tempi sono secondi trascorsi dall'invio del task.
+    """
+
+    def __init__(self, model: str, base_interval: float):
+        self.model = model
+        self.base_interval = base_interval
+        state = load_latency_state()
+        self.samples = {status: model_samples(model, status, state) for status in PROGRESS_STATUSES}
+        # Tempo rimanente fino a SUCCESS, condizionato all'ultimo stato intermedio visto
+        self.remaining = {
+            status: model_samples(model, f"{status}->SUCCESS", state) for status in PROGRESS_STATUSES[:-1]
+        }
+        self.requests = 0
+        self.last_poll = 0.0
+        self.status_times: dict[str, float] = {}
+        self.detection_delay: Optional[float] = None
+
+    def _window(self) -> Optional[tuple[float, float]]:
+        """Finestra [inizio, fine] in cui ci si aspetta il completamento."""
+        for status in reversed(PROGRESS_STATUSES[:-1]):
+            seen_at = self.status_times.get(status)
+            rem = self.remaining[status]
+            if seen_at is not None and len(rem) >= LATENCY_MIN_SAMPLES:
+                return (seen_at + percentile(rem, POLL_WINDOW_LOW), seen_at + percentile(rem, POLL_WINDOW_HIGH))
+        totals = self.samples["SUCCESS"]
+        if len(totals) >= LATENCY_MIN_SAMPLES:
+            return (percentile(totals, POLL_WINDOW_LOW), percentile(totals, POLL_WINDOW_HIGH))
+        return None
+
+    def next_delay(self, elapsed: float) -> float:
+        """Attesa prima del prossimo polling: rada prima della finestra, fitta dentro."""
+        window = self._window()
+        if window is None:
+            return self.base_interval  # Storico insufficiente: comportamento classico
+        start, end = window
+        if elapsed < start:
+            # Non svegliarsi mai oltre l'inizio finestra, ma nemmeno troppo spesso prima
+            return max(POLL_MIN_INTERVAL, min(start - elapsed, POLL_MAX_INTERVAL))
+        if elapsed <= end:
+            return POLL_MIN_INTERVAL
+        # Coda lunga oltre il percentile alto: si torna gradualmente all'intervallo base
+        return min(self.base_interval, POLL_MIN_INTERVAL + (elapsed - end) / 4)
+
+    def observe(self, elapsed: float, status: str):
+        """Registra l'esito di un polling eseguito al tempo `elapsed`."""
+        self.requests += 1
+        if status in PROGRESS_STATUSES and status not in self.status_times:
+            # La transizione è avvenuta tra il polling precedente e questo: si usa il punto medio
+            self.status_times[status] = (self.last_poll + elapsed) / 2
+            if status == "SUCCESS":
+                self.detection_delay = elapsed - self.last_poll
+        self.last_poll = elapsed
+
+    def record(self, persist: bool = True) -> dict:
+        """Salva le latenze osservate (se `persist`) e restituisce il riepilogo del polling."""
+        samples = dict(self.status_times)
+        success_at = self.status_times.get("SUCCESS")
+        if success_at is not None and persist:
+            for status in PROGRESS_STATUSES[:-1]:
+                if status in self.status_times:
+                    samples[f"{status}->SUCCESS"] = success_at - self.status_times[status]
+            samples["requests"] = self.requests
+            if self.detection_delay is not None:
+                samples["detection_delay"] = self.detection_delay
+            record_latency_samples(self.model, samples)
+        return {
+            "requests": self.requests,
+            "detection_delay": self.detection_delay,
+            "status_times": self.status_times,
+        }
+
+
+if __name__ == "__main__":
+    # Riepilogo rapido dello storico: python KieLatency.py
+    for model_name, metrics in load_latency_state().items():
+        print(f"--- {model_name} ---")
+        for key, values in metrics.items():
+            p50, p90 = percentile(values, 50), percentile(values, 90)
+            print(f"  {key:<26} n={len(values):<4} p50={p50:.1f} p90={p90:.1f}")
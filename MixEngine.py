@@ -0,0 +1,352 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# ____    _    ____   ____    _    ____  ____
+#| __ )  / \  |  _ \ | __ )  / \  |  _ \|  _ \
+#|  _ \ / _ \ | |_) ||  _ \ / _ \ | |_) | | | |
+#| |_) / ___ \|  _ < | |_) / ___ \|  _ <| |_| |
+#|____/_/   \_\_| \_\|____/_/   \_\_| \_\____/
+
+"""
+MixEngine.py: Motore di mixaggio in Python, alternativo a mpv (PLAYER_BACKEND=mix).
+Gli MP3 vengono decodificati da ffmpeg in blocchi float32 (NumPy), i due piatti sono
+mixati con una curva a potenza costante su blocchi vettoriali e il risultato va a
+un'uscita intercambiabile: scheda audio (sounddevice), file WAV o uscita nulla.
+Senza hardware audio il crossfade si può misurare e verificare in modo deterministico.
+
+Statistiche a fine esecuzione: CPU per secondo di audio, blocchi consegnati in ritardo.
+
+    python MixEngine.py [--sink null|wav:FILE|device] [--crossfade SECONDI] [--realtime] A.mp3 B.mp3 ...
+    python MixEngine.py --selftest      (toni sintetici, nessun file né ffmpeg necessari)
+"""
+
+import os
+import sys
+import time
+import wave
+import subprocess
+from collections import deque
+from typing import Callable, Iterator, Optional
+
+import numpy as np
+
+# --- CONFIGURAZIONE ---
+SAMPLE_RATE = 44100
+CHANNELS = 2
+BLOCK_FRAMES = int(os.getenv("MIX_BLOCK_FRAMES", "1024"))
+DECODE_CHUNK_FRAMES = 16384
+# A crossfade possibile ma senza canzone pronta, la coda si richiede al massimo ogni tanti secondi di
+# audio: next_track prende il lock della playlist e legge file, non va fatto a ogni blocco
+NEXT_TRACK_RETRY_SECONDS = 0.5
+
+
+# --- SORGENTI ---
+
+def decode_file(path: str, chunk_frames: int = DECODE_CHUNK_FRAMES) -> Iterator[np.ndarray]:
+    """Decodifica con ffmpeg in blocchi (frame, canali) float32, senza caricare tutto il file."""
+    command = ["ffmpeg", "-v", "error", "-nostdin", "-i", path,
+               "-f", "f32le", "-ac", str(CHANNELS), "-ar", str(SAMPLE_RATE), "-"]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    frame_bytes = 4 * CHANNELS
+    try:
+        while True:
+            data = process.stdout.read(chunk_frames * frame_bytes)
+            if not data:
+                break
+            usable = len(data) - len(data) % frame_bytes
+            yield np.frombuffer(data[:usable], dtype=np.float32).reshape(-1, CHANNELS)
+    finally:
+        process.stdout.close()
+        process.kill()
+        process.wait()
+
+
+def array_source(samples: np.ndarray, chunk_frames: int = DECODE_CHUNK_FRAMES) -> Iterator[np.ndarray]:
+    """Sorgente da un array già in memoria (verifiche e test senza file)."""
+    for start in range(0, len(samples), chunk_frames):
+        yield samples[start:start + chunk_frames]
+
+
+class Deck:
+    """
+    Un piatto: legge dalla sorgente tenendo sempre `lookahead` frame decodificati in anticipo,
+    così sa quando mancano meno di `lookahead` frame alla fine (l'inizio del crossfade).
+    """
+
+    def __init__(self, name: str, source: Iterator[np.ndarray], lookahead: int):
+        self.name = name
+        self.source = source
+        self.lookahead = lookahead
+        self.chunks: deque[np.ndarray] = deque()
+        self.buffered = 0
+        self.eof = False
+        self.played = 0
+
+    def _fill(self, frames: int):
+        while not self.eof and self.buffered < frames:
+            try:
+                chunk = next(self.source)
+            except StopIteration:
+                self.eof = True
+                break
+            self.chunks.append(chunk)
+            self.buffered += len(chunk)
+
+    def remaining(self) -> Optional[int]:
+        """Frame mancanti alla fine, noti solo quando la fine è entro il lookahead."""
+        self._fill(self.lookahead + BLOCK_FRAMES)
+        return self.buffered if self.eof else None
+
+    def read(self, frames: int, pad: bool = True) -> np.ndarray:
+        """`frames` frame; a fine canzone completa con silenzio (o, con pad=False, ne restituisce meno)."""
+        self._fill(frames + self.lookahead)
+        out = np.zeros((frames, CHANNELS), dtype=np.float32)
+        filled = 0
+        while filled < frames and self.chunks:
+            chunk = self.chunks[0]
+            take = min(frames - filled, len(chunk))
+            out[filled:filled + take] = chunk[:take]
+            filled += take
+            if take == len(chunk):
+                self.chunks.popleft()
+            else:
+                self.chunks[0] = chunk[take:]
+        self.buffered -= filled
+        self.played += filled
+        return out if pad else out[:filled]
+
+    @property
+    def finished(self) -> bool:
+        return self.eof and self.buffered == 0
+
+
+# --- USCITE ---
+
+class NullSink:
+    """Scarta l'audio. Con `realtime` consegna al ritmo della scheda e conta i blocchi in ritardo."""
+
+    def __init__(self, realtime: bool = False):
+        self.realtime = realtime
+        self.underruns = 0
+        self.deadline = None
+
+    def write(self, block: np.ndarray):
+        if not self.realtime:
+            return
+        now = time.monotonic()
+        if self.deadline is None:
+            self.deadline = now
+        elif now > self.deadline:
+            self.underruns += 1 # Il blocco è pronto dopo che la scheda avrebbe finito il precedente
+            self.deadline = now
+        self.deadline += len(block) / SAMPLE_RATE
+        time.sleep(max(0.0, self.deadline - time.monotonic() - len(block) / SAMPLE_RATE))
+
+    def close(self):
+        pass
+
+
+class WavSink:
+    """Scrive un WAV 16 bit: per ascoltare o confrontare il risultato del mix."""
+
+    def __init__(self, path: str):
+        self.file = wave.open(path, "wb")
+        self.file.setnchannels(CHANNELS)
+        self.file.setsampwidth(2)
+        self.file.setframerate(SAMPLE_RATE)
+        self.underruns = 0
+
+    def write(self, block: np.ndarray):
+        self.file.writeframes((np.clip(block, -1.0, 1.0) * 32767).astype("<i2").tobytes())
+
+    def close(self):
+        self.file.close()
+
+
+class DeviceSink:
+    """Scheda audio tramite sounddevice (dipendenza opzionale, serve solo per questa uscita)."""
+
+    def __init__(self):
+        try:
+            import sounddevice
+        except ImportError:
+            raise RuntimeError("Per l'uscita 'device' installa sounddevice: pip install sounddevice")
+        self.stream = sounddevice.OutputStream(samplerate=SAMPLE_RATE, channels=CHANNELS, dtype="float32",
+                                               blocksize=BLOCK_FRAMES)
+        self.stream.start()
+        self.underruns = 0
+
+    def write(self, block: np.ndarray):
+        if self.stream.write(np.ascontiguousarray(block)):
+            self.underruns += 1
+
+    def close(self):
+        self.stream.stop()
+        self.stream.close()
+
+
+def make_sink(spec: str, realtime: bool = False):
+    """"null", "wav:percorso.wav" oppure "device"."""
+    if spec.startswith("wav:"):
+        return WavSink(spec[4:])
+    if spec == "device":
+        return DeviceSink()
+    return NullSink(realtime=realtime)
+
+
+# --- MOTORE ---
+
+def equal_power_gains(position: int, frames: int, total: int) -> tuple[np.ndarray, np.ndarray]:
+    """Guadagni (uscente, entrante) per `frames` campioni a partire da `position` su `total`."""
+    t = (position + np.arange(frames, dtype=np.float32)) / total
+    t = np.clip(t, 0.0, 1.0)[:, None]
+    return np.cos(t * np.pi / 2), np.sin(t * np.pi / 2)
+
+
+class MixEngine:
+    """
+    Suona una sequenza di tracce con crossfade. `next_track(block)` restituisce la prossima
+    (etichetta, sorgente) oppure None; l'etichetta (nome o dati della canzone) passa a `on_track_start`; viene chiamata senza attesa all'inizio di ogni crossfade
+    e con attesa quando non c'è niente da suonare. `on_track_end` segnala una traccia finita
+    senza crossfade (da lì in poi silenzio finché non arriva la prossima).
+    """
+
+    def __init__(self, sink, crossfade_seconds: float = 8.0, gain: float = 1.0):
+        self.sink = sink
+        self.crossfade_frames = max(1, int(crossfade_seconds * SAMPLE_RATE))
+        self.gain = gain
+        self.audio_frames = 0
+        self.cpu_seconds = 0.0
+        self.crossfades = 0
+        self.on_track_start: Optional[Callable[[object], None]] = None
+        self.on_track_end: Optional[Callable[[], None]] = None
+
+    def _emit(self, block: np.ndarray):
+        started = time.process_time()
+        if self.gain != 1.0:
+            block = block * self.gain
+        self.cpu_seconds += time.process_time() - started
+        self.sink.write(block)
+        self.audio_frames += len(block)
+
+    def _start(self, track) -> Deck:
+        label, source = track
+        if self.on_track_start:
+            self.on_track_start(label)
+        return Deck(str(label), source, self.crossfade_frames)
+
+    def run(self, next_track: Callable[[bool], Optional[tuple]]):
+        current = None
+        retry_at = 0 # Frame di audio emesso dopo cui si può richiedere la prossima traccia
+        while True:
+            if current is None:
+                track = next_track(True)
+                if track is None:
+                    return
+                current = self._start(track)
+                retry_at = 0
+
+            cpu_started = time.process_time()
+            remaining = current.remaining()
+            if remaining is not None and remaining <= self.crossfade_frames and self.audio_frames >= retry_at:
+                track = next_track(False)
+                if track is not None:
+                    self.cpu_seconds += time.process_time() - cpu_started
+                    current = self._crossfade(current, self._start(track), remaining)
+                    retry_at = 0
+                    continue
+                retry_at = self.audio_frames + int(NEXT_TRACK_RETRY_SECONDS * SAMPLE_RATE)
+            frames = BLOCK_FRAMES
+            if remaining is not None and remaining > self.crossfade_frames:
+                frames = min(frames, remaining - self.crossfade_frames) # Il crossfade parte al frame esatto
+            block = current.read(frames, pad=False)
+            self.cpu_seconds += time.process_time() - cpu_started
+            self._emit(block)
+            if current.finished:
+                current = None
+                if self.on_track_end:
+                    self.on_track_end()
+
+    def _crossfade(self, out_deck: Deck, in_deck: Deck, length: int) -> Deck:
+        """Sovrappone le ultime `length` frame di `out_deck` all'inizio di `in_deck`."""
+        position = 0
+        while position < length:
+            cpu_started = time.process_time()
+            frames = min(BLOCK_FRAMES, length - position)
+            out_gain, in_gain = equal_power_gains(position, frames, length)
+            block = out_deck.read(frames) * out_gain + in_deck.read(frames) * in_gain
+            self.cpu_seconds += time.process_time() - cpu_started
+            self._emit(block)
+            position += frames
+        self.crossfades += 1
+        return in_deck
+
+    def stats(self) -> dict:
+        audio_seconds = self.audio_frames / SAMPLE_RATE
+        return {
+            "audio_seconds": round(audio_seconds, 2),
+            "cpu_ms_per_audio_second": round(self.cpu_seconds / audio_seconds * 1000, 3) if audio_seconds else 0.0,
+            "underruns": self.sink.underruns,
+            "crossfades": self.crossfades,
+        }
+
+
+# --- VERIFICA LOCALE ---
+
+def _tone(frequency: float, seconds: float) -> np.ndarray:
+    t = np.arange(int(seconds * SAMPLE_RATE), dtype=np.float32) / SAMPLE_RATE
+    mono = 0.5 * np.sin(2 * np.pi * frequency * t, dtype=np.float32)
+    return np.repeat(mono[:, None], CHANNELS, axis=1)
+
+
+def _selftest() -> int:
+    """Tre toni con crossfade da 2s su WAV: lunghezza esatta, potenza costante, nessun buco."""
+    import tempfile
+    seconds, crossfade = 6.0, 2.0
+    tones = [("440Hz", _tone(440, seconds)), ("660Hz", _tone(660, seconds)), ("550Hz", _tone(550, seconds))]
+    queue = deque((name, array_source(samples)) for name, samples in tones)
+    failures = 0
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "mix.wav")
+        engine = MixEngine(WavSink(path), crossfade_seconds=crossfade)
+        engine.run(lambda block: queue.popleft() if queue else None)
+        engine.sink.close()
+        with wave.open(path, "rb") as f:
+            mixed = np.frombuffer(f.readframes(f.getnframes()), dtype="<i2").reshape(-1, CHANNELS) / 32767
+
+    expected = int(seconds * SAMPLE_RATE) * 3 - 2 * int(crossfade * SAMPLE_RATE)
+    ok = len(mixed) == expected
+    failures += not ok
+    print(f"{'OK  ' if ok else 'FAIL'} lunghezza: {len(mixed)} frame (attesi {expected})")
+
+    # Potenza su finestre da 50 ms: con toni non correlati il crossfade a potenza costante non deve avere buchi
+    window = SAMPLE_RATE // 20
+    rms = np.sqrt(np.mean(mixed[:len(mixed) // window * window, 0].reshape(-1, window) ** 2, axis=1))
+    ok = rms.min() > 0.9 * rms.max()
+    failures += not ok
+    print(f"{'OK  ' if ok else 'FAIL'} potenza RMS min/max: {rms.min():.3f}/{rms.max():.3f}")
+
+    print(f"     statistiche: {engine.stats()}")
+    ok = engine.stats()["crossfades"] == 2
+    failures += not ok
+    print(f"{'OK  ' if ok else 'FAIL'} crossfade eseguiti: {engine.stats()['crossfades']}")
+    return failures
+
+
+if __name__ == "__main__":
+    if "--selftest" in sys.argv:
+        sys.exit(1 if _selftest() else 0)
+    args = sys.argv[1:]
+    sink_spec = args[args.index("--sink") + 1] if "--sink" in args else "null"
+    crossfade_seconds = float(args[args.index("--crossfade") + 1]) if "--crossfade" in args else 8.0
+    options = {"--sink", "--crossfade"}
+    files = [a for i, a in enumerate(args) if not a.startswith("--") and (i == 0 or args[i - 1] not in options)]
+    if not files:
+        print(__doc__)
+        sys.exit(1)
+    tracks = deque((os.path.basename(f), decode_file(f)) for f in files)
+    engine = MixEngine(make_sink(sink_spec, realtime="--realtime" in args), crossfade_seconds)
+    engine.on_track_start = lambda name: print(f"PLAY: {name}")
+    engine.run(lambda block: tracks.popleft() if tracks else None)
+    engine.sink.close()
+    print(engine.stats())
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# ____    _    ____   ____    _    ____  ____
+#| __ )  / \  |  _ \ | __ )  / \  |  _ \|  _ \
+#|  _ \ / _ \ | |_) ||  _ \ / _ \ | |_) | | | |
+#| |_) / ___ \|  _ < | |_) / ___ \|  _ <| |_| |
+#|____/_/   \_\_| \_\|____/_/   \_\_| \_\____/
+
+"""
+MpvDecks.py: Due "piatti" mpv sempre accesi (--idle) per il backend PLAYER_BACKEND=decks.
+Ogni canzone viene caricata con `loadfile` nel piatto libero invece di avviare un nuovo
+processo: niente attese per il socket, niente processi uccisi a fine crossfade.
+Il crossfade è una rampa di volume a potenza costante con passi su scadenze monotone.
+"""
+
+import math
+import time
+import logging
+import threading
+import subprocess
+from pathlib import Path
+from typing import Optional
+
+from MpvIPC import MpvClient
+
+# Passi al secondo della rampa di volume durante il crossfade
+DECK_RAMP_RATE = 25
+DECK_LOAD_TIMEOUT = 10
+
+
+class MpvDeck:
+    """Un'istanza di mpv a lunga vita con la sua connessione IPC."""
+
+    def __init__(self, name: str, socket_path: Path):
+        self.name = name
+        self.socket_path = Path(socket_path)
+        self.process: Optional[subprocess.Popen] = None
+        self.ipc: Optional[MpvClient] = None
+        self.loaded = threading.Event()
+        self.ended = threading.Event()
+        self.source: Optional[str] = None
+
+    def start(self) -> bool:
+        """Avvia mpv in attesa di file (o lo riavvia se è morto)."""
+        self.shutdown()
+        self.socket_path.unlink(missing_ok=True)
+        command = ["mpv", "--idle=yes", "--really-quiet", "--no-video", "--no-terminal", "--volume=0",
+                   f"--input-ipc-server={self.socket_path}"]
+        self.process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.ipc = MpvClient(self.socket_path)
+        if not self.ipc.connect(timeout=5) or self.process.poll() is not None:
+            logging.error(f"Piatto {self.name}: mpv non si è avviato.")
+            self.shutdown()
+            return False
+        self.ipc.on_event(self._on_event)
+        for prop in ("time-pos", "duration", "pause"):
+            self.ipc.observe_property(prop)
+        self.ended.set() # Nessuna canzone caricata
+        logging.info(f"Piatto {self.name} pronto (PID {self.process.pid}).")
+        return True
+
+    def _on_event(self, message: dict):
+        event = message.get("event")
+        if event == "file-loaded":
+            self.loaded.set()
+        elif event == "end-file":
+            self.ended.set()
+
+    def alive(self) -> bool:
+        return self.process is not None and self.process.poll() is None and self.ipc is not None and self.ipc.connected
+
+    def load(self, source: str, volume: int, paused: bool = False) -> Optional[float]:
+        """Carica una canzone e attende che mpv l'abbia aperta. Ritorna i secondi impiegati (None se fallisce)."""
+        if not self.alive() and not self.start():
+            return None
+        started = time.monotonic()
+        self.loaded.clear()
+        self._unload() # Un end-file della canzone precedente arrivato dopo segnerebbe questa come fallita
+        self.ended.clear()
+        with self.ipc.cond:
+            self.ipc.properties.pop("time-pos", None) # Valori della canzone precedente
+            self.ipc.properties.pop("duration", None)
+        self.ipc.set_property("volume", volume)
+        self.ipc.set_property("pause", paused)
+        if self.ipc.command("loadfile", source, "replace") is None and not self.ipc.connected:
+            return None
+        if not self.loaded.wait(DECK_LOAD_TIMEOUT) or self.ended.is_set():
+            logging.error(f"Piatto {self.name}: impossibile aprire {source}")
+            self.stop()
+            return None
+        self.source = source
+        return time.monotonic() - started
+
+    def play(self):
+        self.ipc.set_property("pause", False)
+
+    def stop(self):
+        """Scarica la canzone: il piatto torna libero, il processo resta acceso."""
+        if self.ipc:
+            self._unload()
+        self.source = None
+
+    def _unload(self, timeout: float = 2.0):
+        """Ferma la canzone caricata e aspetta il suo end-file (arriva in pochi ms, il tetto è per un mpv bloccato)."""
+        if not self.ended.is_set():
+            self.ipc.command("stop")
+            self.ended.wait(timeout)
+
+    def remaining(self, known_duration: Optional[float] = None) -> Optional[float]:
+        """
+        Secondi alla fine della canzone caricata (None finché mpv non li conosce). `known_duration`
+        è quella misurata al download, valida già prima che mpv abbia letto il file.
+        """
+        duration, position = known_duration or self.ipc.properties.get("duration"), self.ipc.properties.get("time-pos")
+        if duration is None or position is None:
+            return None
+        return max(0.0, duration - position)
+
+    def shutdown(self):
+        if self.ipc:
+            self.ipc.close()
+        if self.process and self.process.poll() is None:
+            self.process.kill()
+        self.ipc = self.process = None
+
+
+def equal_power_volumes(progress: float, out_volume: int, in_volume: int) -> tuple[int, int]:
+    """
+    Volumi mpv (uscente, entrante) a metà crossfade `progress` (0-1), partendo da `out_volume` e
+    arrivando a `in_volume`. La somma delle potenze resta costante; il volume di mpv è cubico
+    rispetto all'ampiezza, da qui la radice cubica.
+    """
+    out_gain, in_gain = math.cos(progress * math.pi / 2), math.sin(progress * math.pi / 2)
+    return round(out_volume * out_gain ** (1 / 3)), round(in_volume * in_gain ** (1 / 3))
+
+
+def crossfade(out_deck: MpvDeck, in_deck: MpvDeck, seconds: float, out_volume: int, in_volume: int) -> float:
+    """
+    Rampa di volume da un piatto all'altro (ognuno con il volume della sua canzone).
+    Ritorna il ritardo massimo di un passo, in secondi.
+    """
+    steps = max(1, int(seconds * DECK_RAMP_RATE))
+    fade_start, max_lateness = time.monotonic(), 0.0
+    for i in range(steps + 1):
+        delay = fade_start + i * seconds / steps - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        max_lateness = max(max_lateness, -delay)
+        out_step, in_step = equal_power_volumes(i / steps, out_volume, in_volume)
+        out_deck.ipc.set_property("volume", out_step)
+        in_deck.ipc.set_property("volume", in_step)
+    return max_lateness
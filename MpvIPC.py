@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# ____    _    ____   ____    _    ____  ____
+#| __ )  / \  |  _ \ | __ )  / \  |  _ \|  _ \
+#|  _ \ / _ \ | |_) ||  _ \ / _ \ | |_) | | | |
+#| |_) / ___ \|  _ < | |_) / ___ \|  _ <| |_| |
+#|____/_/   \_\_| \_\|____/_/   \_\_| \_\____/
+
+"""
+MpvIPC.py: Client persistente per il socket IPC JSON di mpv.
+Una sola connessione per istanza di mpv, aperta all'avvio e chiusa con il player:
+un thread legge tutte le righe in arrivo, abbina le risposte ai comandi tramite
+`request_id` e tiene aggiornate le proprietà osservate con `observe_property`
+(time-pos, duration, eof-reached...), così il player le legge dalla memoria
+invece di interrogare mpv ogni volta.
+"""
+
+import json
+import time
+import socket
+import logging
+import threading
+from pathlib import Path
+from typing import Any, Callable, Optional
+
+
+class MpvClient:
+    def __init__(self, socket_path: Path):
+        self.socket_path = Path(socket_path)
+        self.sock: Optional[socket.socket] = None
+        self.properties: dict[str, Any] = {}
+        self.cond = threading.Condition()
+        self.pending: dict[int, dict] = {} # request_id -> risposta (None finché non arriva)
+        self.next_id = 1
+        self.observers: dict[int, str] = {}
+        self.event_callbacks: list[Callable[[dict], None]] = []
+        self.write_lock = threading.Lock()
+        self.commands_sent = 0
+        self.reader: Optional[threading.Thread] = None
+
+    def connect(self, timeout: float = 5.0) -> bool:
+        """Si collega appena mpv ha creato il socket (riprova fino a `timeout` secondi)."""
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                sock.connect(str(self.socket_path))
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                sock.close()
+                if time.monotonic() >= deadline:
+                    return False
+                time.sleep(0.02)
+        self.sock = sock
+        self.reader = threading.Thread(target=self._read_loop, daemon=True)
+        self.reader.start()
+        return True
+
+    @property
+    def connected(self) -> bool:
+        return self.sock is not None and self.reader is not None and self.reader.is_alive()
+
+    def close(self):
+        sock, self.sock = self.sock, None # Il thread di lettura può azzerarlo in qualsiasi momento
+        if sock:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
+
+    def _read_loop(self):
+        buffer = b""
+        sock = self.sock
+        while True:
+            try:
+                chunk = sock.recv(65536)
+            except OSError:
+                break
+            if not chunk:
+                break
+            buffer += chunk
+            *lines, buffer = buffer.split(b"\n")
+            for line in lines:
+                if line.strip():
+                    self._dispatch(line)
+        with self.cond:
+            self.sock = None if self.sock is sock else self.sock
+            self.cond.notify_all() # Sveglia chi aspetta una risposta che non arriverà più
+
+    def _dispatch(self, line: bytes):
+        try:
+            message = json.loads(line)
+        except json.JSONDecodeError:
+            return
+        callbacks = ()
+        with self.cond:
+            if "request_id" in message and "event" not in message:
+                if message["request_id"] in self.pending:
+                    self.pending[message["request_id"]] = message
+            elif message.get("event") == "property-change":
+                self.properties[message["name"]] = message.get("data")
+            if "event" in message:
+                callbacks = list(self.event_callbacks)
+            self.cond.notify_all()
+        for callback in callbacks:
+            try:
+                callback(message)
+            except Exception as e:
+                logging.error(f"Callback evento mpv fallita: {e}")
+
+    def _send(self, command: list, wait: bool, timeout: float) -> Optional[dict]:
+        with self.cond:
+            request_id = self.next_id
+            self.next_id += 1
+            if wait:
+                self.pending[request_id] = None
+        line = json.dumps({"command": command, "request_id": request_id}).encode("utf-8") + b"\n"
+        try:
+            with self.write_lock:
+                if self.sock is None:
+                    raise OSError("non connesso")
+                self.sock.sendall(line)
+                self.commands_sent += 1
+        except OSError:
+            with self.cond:
+                self.pending.pop(request_id, None)
+            return None
+        if not wait:
+            return None
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while self.pending.get(request_id) is None and self.sock is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+            return self.pending.pop(request_id, None)
+
+    def command(self, *args, timeout: float = 2.0) -> Any:
+        """Esegue un comando e ne restituisce `data` (None in caso di errore o timeout)."""
+        response = self._send(list(args), wait=True, timeout=timeout)
+        if response and response.get("error") == "success":
+            return response.get("data")
+        return None
+
+    def send(self, *args) -> bool:
+        """Comando senza attesa della risposta (es. le rampe di volume)."""
+        if self.sock is None:
+            return False
+        self._send(list(args), wait=False, timeout=0)
+        return True
+
+    def get_property(self, name: str) -> Any:
+        if name in self.properties:
+            return self.properties[name]
+        return self.command("get_property", name)
+
+    def set_property(self, name: str, value: Any, wait: bool = False) -> Any:
+        if wait:
+            return self.command("set_property", name, value)
+        return self.send("set_property", name, value)
+
+    def observe_property(self, name: str):
+        """Da qui in poi `properties[name]` segue il valore corrente in mpv."""
+        observer_id = len(self.observers) + 1
+        self.observers[observer_id] = name
+        self.command("observe_property", observer_id, name)
+
+    def wait_for_property(self, name: str, predicate: Callable[[Any], bool] = lambda v: v is not None,
+                          timeout: float = 5.0) -> Any:
+        """Attende che una proprietà osservata soddisfi `predicate`; restituisce l'ultimo valore."""
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while not predicate(self.properties.get(name)) and self.sock is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+            return self.properties.get(name)
+
+    def on_event(self, callback: Callable[[dict], None]):
+        self.event_callbacks.append(callback)
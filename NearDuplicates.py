@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# ____    _    ____   ____    _    ____  ____
+#| __ )  / \  |  _ \ | __ )  / \  |  _ \|  _ \
+#|  _ \ / _ \ | |_) ||  _ \ / _ \ | |_) | | | |
+#| |_) / ___ \|  _ < | |_) / ___ \|  _ <| |_| |
+#|____/_/   \_\_| \_\|____/_/   \_\_| \_\____/
+
+"""
+NearDuplicates.py: Riconosce le trascrizioni quasi uguali a quelle già usate da un tavolo.
+I tavoli ripetono spesso le stesse chiacchiere e lo stesso audio può arrivare due volte
+a Whisper (cartella di fallback): ogni volta si pagherebbero riassunto, lyrics e musica.
+
+Ogni trascrizione diventa un insieme di shingle (terne di parole normalizzate) e una firma
+MinHash di NEAR_DUP_PERMUTATIONS valori; la frazione di valori uguali stima la similarità
+di Jaccard. Per tavolo si tengono le firme delle trascrizioni diventate canzone (job riuscito)
+negli ultimi NEAR_DUP_WINDOW_MINUTES minuti, in `.tmp_player/near_duplicates.json`: un job
+fallito o ritentato non trova le proprie trascrizioni tra i "già cantati".
+
+Statistiche e chiamate API evitate:     python NearDuplicates.py
+Similarità tra due file:                python NearDuplicates.py A.txt B.txt
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import random
+import hashlib
+from pathlib import Path
+from typing import Optional
+
+try:
+    PROJECT_ROOT = Path(__file__).parent.resolve()
+except NameError:
+    PROJECT_ROOT = Path('.').resolve()
+
+# --- CONFIGURAZIONE ---
+TMP_DIR = PROJECT_ROOT / ".tmp_player"
+NEAR_DUP_STATE_FILE = TMP_DIR / "near_duplicates.json"
+# "skip": i duplicati non vanno in produzione | "flag": solo segnalati nel log | "off"
+NEAR_DUP_ACTION = os.getenv("NEAR_DUP_ACTION", "flag").strip().lower()
+# Similarità (Jaccard stimata) oltre la quale due trascrizioni sono lo stesso discorso
+NEAR_DUP_THRESHOLD = float(os.getenv("NEAR_DUP_THRESHOLD", "0.8"))
+NEAR_DUP_WINDOW_MINUTES = float(os.getenv("NEAR_DUP_WINDOW_MINUTES", "90"))
+# Chiamate API di un job completo (riassunto, lyrics, generazione musicale)
+NEAR_DUP_CALLS_PER_JOB = int(os.getenv("NEAR_DUP_CALLS_PER_JOB", "3"))
+NEAR_DUP_PERMUTATIONS = 64
+NEAR_DUP_MAX_PER_TABLE = 100
+SHINGLE_WORDS = 3
+
+_MERSENNE_PRIME = (1 << 61) - 1
+_rng = random.Random(20240601) # Seme fisso: le firme salvate restano confrontabili tra un avvio e l'altro
+_PERMUTATIONS = [(_rng.randrange(1, _MERSENNE_PRIME), _rng.randrange(0, _MERSENNE_PRIME))
+                 for _ in range(NEAR_DUP_PERMUTATIONS)]
+
+
+def shingles(text: str) -> set[str]:
+    """Terne di parole consecutive, senza maiuscole né punteggiatura."""
+    words = re.findall(r"\w+", text.lower())
+    if len(words) < SHINGLE_WORDS:
+        return {" ".join(words)} if words else set()
+    return {" ".join(words[i:i + SHINGLE_WORDS]) for i in range(len(words) - SHINGLE_WORDS + 1)}
+
+
+def signature(text: str) -> Optional[list[int]]:
+    """Firma MinHash del testo (None se il testo è vuoto)."""
+    hashes = [int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest(), "big") for s in shingles(text)]
+    if not hashes:
+        return None
+    return [min((a * h + b) % _MERSENNE_PRIME for h in hashes) for a, b in _PERMUTATIONS]
+
+
+def similarity(sig_a: list[int], sig_b: list[int]) -> float:
+    return sum(x == y for x, y in zip(sig_a, sig_b)) / len(sig_a)
+
+
+class NearDuplicateIndex:
+    """
+    Stato in `.tmp_player/near_duplicates.json`:
+      tables: tavolo -> [[istante, firma, nome del file], ...] (le più recenti in fondo)
+      stats:  checked, duplicates, skipped_jobs, api_calls_avoided
+    """
+
+    def __init__(self):
+        self.state = self._load()
+
+    def _load(self) -> dict:
+        try:
+            state = json.loads(NEAR_DUP_STATE_FILE.read_text(encoding="utf-8"))
+        except (FileNotFoundError, json.JSONDecodeError):
+            state = {}
+        state.setdefault("tables", {})
+        state.setdefault("stats", {"checked": 0, "duplicates": 0, "skipped_jobs": 0, "api_calls_avoided": 0})
+        return state
+
+    def _save(self):
+        TMP_DIR.mkdir(exist_ok=True)
+        tmp_file = NEAR_DUP_STATE_FILE.with_suffix(".tmp")
+        tmp_file.write_text(json.dumps(self.state), encoding="utf-8")
+        os.replace(tmp_file, NEAR_DUP_STATE_FILE)
+
+    def _recent(self, table: str, now: float) -> list:
+        entries = self.state["tables"].get(table, [])
+        return [e for e in entries if now - e[0] <= NEAR_DUP_WINDOW_MINUTES * 60]
+
+    def check_batch(self, table: str, files: list[Path], now: Optional[float] = None) -> tuple[list[Path], dict, list]:
+        """
+        Separa le trascrizioni nuove dai quasi-duplicati (di quelle recenti del tavolo o di
+        un'altra dello stesso batch). Ritorna (nuove, {duplicato: (originale, similarità)}, firme):
+        le firme delle nuove entrano nell'indice solo con `commit`, a job riuscito.
+        """
+        now = time.time() if now is None else now
+        recent = self._recent(table, now)
+        fresh, duplicates, signatures = [], {}, []
+        for path in sorted(files):
+            sig = signature(path.read_text(encoding="utf-8"))
+            self.state["stats"]["checked"] += 1
+            if sig is None:
+                fresh.append(path)
+                continue
+            best = max(((similarity(sig, e[1]), e[2]) for e in recent), default=None)
+            if best and best[0] >= NEAR_DUP_THRESHOLD:
+                duplicates[path] = (best[1], best[0])
+                continue
+            fresh.append(path)
+            recent.append([now, sig, path.name])
+            signatures.append([now, sig, path.name])
+        self.state["stats"]["duplicates"] += len(duplicates)
+        self._save()
+        return fresh, duplicates, signatures
+
+    def commit(self, table: str, signatures: list):
+        """Il job con queste trascrizioni è andato a buon fine: da ora contano come già cantate."""
+        if not signatures:
+            return
+        recent = self._recent(table, time.time()) + signatures
+        self.state["tables"][table] = recent[-NEAR_DUP_MAX_PER_TABLE:]
+        self._save()
+
+    def record_skipped_job(self):
+        """Un intero batch era già stato cantato: un job (e le sue chiamate API) in meno."""
+        self.state["stats"]["skipped_jobs"] += 1
+        self.state["stats"]["api_calls_avoided"] += NEAR_DUP_CALLS_PER_JOB
+        self._save()
+
+    def stats(self) -> dict:
+        return self.state["stats"]
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3:
+        text_a, text_b = (Path(p).read_text(encoding="utf-8") for p in sys.argv[1:3])
+        set_a, set_b = shingles(text_a), shingles(text_b)
+        exact = len(set_a & set_b) / len(set_a | set_b) if set_a | set_b else 0.0
+        sig_a, sig_b = signature(text_a), signature(text_b)
+        estimate = similarity(sig_a, sig_b) if sig_a and sig_b else 0.0
+        verdict = "DUPLICATO" if estimate >= NEAR_DUP_THRESHOLD else "diverso"
+        print(f"Jaccard esatto: {exact:.2f}  MinHash: {estimate:.2f}  (soglia {NEAR_DUP_THRESHOLD}) -> {verdict}")
+        sys.exit(0)
+    index = NearDuplicateIndex()
+    s = index.stats()
+    print(f"Trascrizioni controllate: {s['checked']}, quasi-duplicati: {s['duplicates']}")
+    print(f"Job evitati: {s['skipped_jobs']}, chiamate API evitate: {s['api_calls_avoided']}")
+    for table in sorted(index.state["tables"]):
+        print(f"  tavolo {table}: {len(index._recent(table, time.time()))} firme recenti")
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# ____    _    ____   ____    _    ____  ____
+#| __ )  / \  |  _ \ | __ )  / \  |  _ \|  _ \
+#|  _ \ / _ \ | |_) ||  _ \ / _ \ | |_) | | | |
+#| |_) / ___ \|  _ < | |_) / ___ \|  _ <| |_| |
+#|____/_/   \_\_| \_\|____/_/   \_\_| \_\____/
+
+"""
+PlayerWake.py: Sveglia del player quando arriva una canzone nuova.
+Il player apre un socket Unix a datagrammi in `.tmp_player/player_wake.sock` e ci resta
+in attesa quando la playlist è vuota; il Producer, appena ha scritto in playlist, manda
+un datagramma con l'istante della pubblicazione. Se il player non è in ascolto l'invio
+fallisce in silenzio: il player, comunque, ricontrolla la coda ogni tanto.
+"""
+
+import os
+import json
+import time
+import select
+import socket
+from pathlib import Path
+from typing import Optional
+
+try:
+    PROJECT_ROOT = Path(__file__).parent.resolve()
+except NameError:
+    PROJECT_ROOT = Path('.').resolve()
+
+# --- CONFIGURAZIONE ---
+WAKE_SOCKET = PROJECT_ROOT / ".tmp_player" / "player_wake.sock"
+
+
+def notify_player(path: Path = WAKE_SOCKET):
+    """Chiamata dopo aver accodato canzoni. Non blocca e non fallisce mai."""
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.setblocking(False)
+            sock.sendto(json.dumps({"published": time.time()}).encode("utf-8"), str(path))
+    except OSError:
+        pass # Player fermo o coda del socket piena: in entrambi i casi non serve altro
+
+
+class WakeListener:
+    """Lato player: il socket resta aperto per tutta la vita del processo."""
+
+    def __init__(self, path: Path = WAKE_SOCKET):
+        self.path = Path(path)
+        self.path.unlink(missing_ok=True) # Socket rimasto da un player terminato male
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(str(self.path))
+        self.sock.setblocking(False)
+
+    def wait(self, timeout: float) -> Optional[float]:
+        """
+        Attende una sveglia per al massimo `timeout` secondi. Ritorna l'istante di pubblicazione
+        della più vecchia tra quelle arrivate (None se è scaduto il timeout).
+        """
+        ready, _, _ = select.select([self.sock], [], [], timeout)
+        if not ready:
+            return None
+        published = []
+        while True: # Più pubblicazioni ravvicinate valgono una sola sveglia
+            try:
+                data = self.sock.recv(1024)
+            except BlockingIOError:
+                break
+            try:
+                published.append(float(json.loads(data)["published"]))
+            except (json.JSONDecodeError, KeyError, TypeError, ValueError):
+                published.append(time.time())
+        return min(published) if published else None
+
+    def close(self):
+        self.sock.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
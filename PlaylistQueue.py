@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# ____    _    ____   ____    _    ____  ____
+#| __ )  / \  |  _ \ | __ )  / \  |  _ \|  _ \
+#|  _ \ / _ \ | |_) ||  _ \ / _ \ | |_) | | | |
+#| |_) / ___ \|  _ < | |_) / ___ \|  _ <| |_| |
+#|____/_/   \_\_| \_\|____/_/   \_\_| \_\____/
+
+"""
+PlaylistQueue.py: Playlist a priorità con scadenza di freschezza.
+Il Producer continua ad accodare righe JSON in `playlist.queue`, ognuna con `created` e
+`deadline` (created + PLAYLIST_MAX_AGE_MINUTES). Il player le sposta in un heap in memoria
+ed estrae sempre quella con la chiave più bassa:
+
+    chiave = max(deadline, chiave della canzone precedente dello stesso tavolo + PLAYLIST_TABLE_SPACING_SECONDS)
+
+cioè prima la scadenza più vicina, ma un tavolo con molte canzoni in coda non ne suona
+due di fila mentre gli altri aspettano. Le canzoni scadute (il tavolo se n'è già andato)
+finiscono in testa alla riserva invece di essere suonate. Inserimento ed estrazione
+costano O(log n).
+
+Le canzoni nell'heap sono salvate in `.tmp_player/player_pending.json`: il player le
+ritrova al riavvio e il Producer le conta insieme a `playlist.queue`.
+
+Stato della coda:    python PlaylistQueue.py
+"""
+
+import os
+import json
+import time
+import heapq
+import itertools
+from pathlib import Path
+
+try:
+    PROJECT_ROOT = Path(__file__).parent.resolve()
+except NameError:
+    PROJECT_ROOT = Path('.').resolve()
+
+# --- CONFIGURAZIONE ---
+TMP_DIR = PROJECT_ROOT / ".tmp_player"
+PLAYER_PENDING_FILE = TMP_DIR / "player_pending.json"
+# Oltre questa età una canzone non viene più suonata dalla playlist, ma passa alla riserva
+PLAYLIST_MAX_AGE_MINUTES = float(os.getenv("PLAYLIST_MAX_AGE_MINUTES", "10"))
+# Distanza minima, in secondi di priorità, tra due canzoni consecutive dello stesso tavolo
+PLAYLIST_TABLE_SPACING_SECONDS = float(os.getenv("PLAYLIST_TABLE_SPACING_SECONDS", "240"))
+
+
+def stamp_entry(song_data: dict, now: float = None) -> dict:
+    """Aggiunge `created` e `deadline` a una riga di playlist che non li ha ancora."""
+    now = time.time() if now is None else now
+    song_data.setdefault("created", round(now, 1))
+    song_data.setdefault("deadline", round(song_data["created"] + PLAYLIST_MAX_AGE_MINUTES * 60, 1))
+    return song_data
+
+
+def read_player_pending() -> list[dict]:
+    """Canzoni già prese in carico dal player e non ancora suonate (per il Producer)."""
+    try:
+        return json.loads(PLAYER_PENDING_FILE.read_text(encoding="utf-8"))
+    except (FileNotFoundError, json.JSONDecodeError):
+        return []
+
+
+class PriorityPlaylist:
+    """Heap delle canzoni in attesa. Da usare sotto il lock della playlist."""
+
+    def __init__(self):
+        self.heap: list[tuple[float, int, dict]] = []
+        self.counter = itertools.count() # A parità di chiave vale l'ordine di arrivo
+        self.table_keys: dict[str, float] = {}
+
+    def __len__(self) -> int:
+        return len(self.heap)
+
+    def push(self, song_data: dict):
+        stamp_entry(song_data)
+        table = str(song_data.get("table"))
+        key = song_data["deadline"]
+        if table in self.table_keys:
+            key = max(key, self.table_keys[table] + PLAYLIST_TABLE_SPACING_SECONDS)
+        self.table_keys[table] = key
+        heapq.heappush(self.heap, (key, next(self.counter), song_data))
+
+    def pop(self, now: float = None) -> tuple[dict | None, list[dict]]:
+        """Ritorna (prossima canzone valida o None, canzoni scadute scartate lungo la strada)."""
+        now = time.time() if now is None else now
+        expired = []
+        while self.heap:
+            _, _, song_data = heapq.heappop(self.heap)
+            if song_data["deadline"] >= now:
+                return song_data, expired
+            expired.append(song_data)
+        return None, expired
+
+    def entries(self) -> list[dict]:
+        return [song_data for _, _, song_data in sorted(self.heap)]
+
+    def save(self, held: list[dict] = ()):
+        """`held`: canzoni già tolte dall'heap ma non ancora in onda (es. quella precaricata)."""
+        TMP_DIR.mkdir(exist_ok=True)
+        tmp_file = PLAYER_PENDING_FILE.with_suffix(".tmp")
+        tmp_file.write_text(json.dumps(list(held) + self.entries()), encoding="utf-8")
+        os.replace(tmp_file, PLAYER_PENDING_FILE)
+
+    def load(self):
+        """Riprende le canzoni rimaste in attesa quando il player è stato fermato."""
+        for song_data in sorted(read_player_pending(), key=lambda s: s.get("created", 0)):
+            self.push(song_data)
+
+
+if __name__ == "__main__":
+    now = time.time()
+    pending = read_player_pending()
+    print(f"Canzoni in attesa nel player: {len(pending)} (scadenza {PLAYLIST_MAX_AGE_MINUTES:g} min)")
+    for song_data in pending:
+        left = song_data.get("deadline", now) - now
+        status = f"scade tra {left / 60:.1f} min" if left >= 0 else "SCADUTA"
+        print(f"  tavolo {song_data.get('table')}: {Path(song_data.get('path', '')).name} ({status})")
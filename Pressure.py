@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# ____    _    ____   ____    _    ____  ____
+#| __ )  / \  |  _ \ | __ )  / \  |  _ \|  _ \
+#|  _ \ / _ \ | |_) ||  _ \ / _ \ | |_) | | | |
+#| |_) / ___ \|  _ < | |_) / ___ \|  _ <| |_| |
+#|____/_/   \_\_| \_\|____/_/   \_\_| \_\____/
+
+"""
+Pressure.py: Segnale di contropressione pubblicato dal Producer.
+Quando le trascrizioni si accumulano, o la playlist ha più canzoni di quelle che servono
+a coprire la latenza di generazione, il livello sale verso 1:
+AudioWatchdog rimanda le trascrizioni Whisper e i tavoli (Tavolo.py) alzano le soglie
+di registrazione e tengono l'audio in locale finché la pressione non scende.
+
+Il file viene scritto in `.tmp_player/pressure.json` e, per i tavoli, anche in
+`FROM_TABLES/pressure.json`. Un segnale più vecchio di PRESSURE_MAX_AGE secondi
+(Producer fermo) vale come pressione nulla: nessuno resta bloccato. Il limite viaggia nel
+file stesso (`max_age`), così tavoli e watchdog usano lo stesso valore del Producer.
+"""
+
+import os
+import json
+import time
+from pathlib import Path
+
+try:
+    PROJECT_ROOT = Path(__file__).parent.resolve()
+except NameError:
+    PROJECT_ROOT = Path('.').resolve()
+
+# --- CONFIGURAZIONE ---
+PRESSURE_FILE = PROJECT_ROOT / ".tmp_player" / "pressure.json"
+TABLES_PRESSURE_FILE = PROJECT_ROOT / "FROM_TABLES" / "pressure.json"
+PRESSURE_MAX_AGE = float(os.getenv("PRESSURE_MAX_AGE", "60"))
+# Oltre questo livello AudioWatchdog rimanda le trascrizioni e i tavoli tengono l'audio in locale
+PRESSURE_HIGH = float(os.getenv("PRESSURE_HIGH", "0.8"))
+# Trascrizioni in attesa in WORK_IN_PROGRESS che da sole portano la pressione al massimo
+PRESSURE_BACKLOG_TRANSCRIPTS = int(os.getenv("PRESSURE_BACKLOG_TRANSCRIPTS", "20"))
+
+
+def compute_pressure(queued: int, max_queue: int, pending_transcripts: int, needed: int) -> float:
+    """
+    Livello 0-1: il massimo tra l'eccedenza della playlist e l'arretrato di trascrizioni.
+    Conta solo la coda oltre le `needed` canzoni necessarie: una playlist piena è il regime
+    normale (con MAX_QUEUE_SIZE=2 lo è quasi sempre), non un sovraccarico.
+    """
+    queue_ratio = max(0, queued - needed) / max_queue if max_queue > 0 else 0.0
+    backlog_ratio = pending_transcripts / PRESSURE_BACKLOG_TRANSCRIPTS if PRESSURE_BACKLOG_TRANSCRIPTS > 0 else 0.0
+    return round(min(1.0, max(queue_ratio, backlog_ratio)), 2)
+
+
+def write_pressure(level: float, **details):
+    """Pubblica il livello (con i dettagli che lo hanno prodotto) per watchdog e tavoli."""
+    data = json.dumps({"level": level, "updated": time.time(), "max_age": PRESSURE_MAX_AGE, **details})
+    for path in (PRESSURE_FILE, TABLES_PRESSURE_FILE):
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_suffix(".tmp")
+            tmp_path.write_text(data, encoding="utf-8")
+            os.replace(tmp_path, path)
+        except OSError:
+            continue # Una cartella condivisa non raggiungibile non deve fermare il Producer
+
+
+def read_pressure(path: Path = PRESSURE_FILE) -> float:
+    """Livello corrente, 0 se il segnale manca o è scaduto."""
+    try:
+        data = json.loads(Path(path).read_text(encoding="utf-8"))
+        if time.time() - data["updated"] > data.get("max_age", PRESSURE_MAX_AGE):
+            return 0.0
+        return float(data["level"])
+    except (FileNotFoundError, json.JSONDecodeError, KeyError, TypeError, ValueError, AttributeError):
+        return 0.0
+
+
+if __name__ == "__main__":
+    print(f"Pressione: {read_pressure():.2f} (soglia {PRESSURE_HIGH})")
@@ -40,13 +40,25 @@ load_dotenv()
 
 import time
 import json
+import base64
 import shutil
 import subprocess
+import threading
 from multiprocessing import Pool
 from datetime import datetime
+from typing import Optional
 from filelock import FileLock, Timeout
 from colorama import init, Fore, Style
 
+from QueueController import QUEUE_CONTROL, plan, record_sample
+from TableScheduler import TableScheduler, oldest_transcript_time, transcript_stats
+from Pressure import compute_pressure, write_pressure
+from IngestIndex import PendingIndex, is_table_id
+from Broker import WORK_BROKER, BrokerClient, BrokerError
+from NearDuplicates import NEAR_DUP_ACTION, NearDuplicateIndex
+from PlayerWake import notify_player
+from PlaylistQueue import read_player_pending, stamp_entry
+
 # --- INIZIALIZZAZIONE GLOBALE ---
 init(autoreset=True)
 
@@ -55,19 +67,44 @@ init(autoreset=True)
 WORK_DIR = PROJECT_ROOT / "WORK_IN_PROGRESS"
 TRANSCRIPT_ARCHIVE_DIR = PROJECT_ROOT / "FROM_TABLES" / "Archive" / "Trascrizioni"
 FAILED_TRANSCRIPTS_DIR = WORK_DIR / "failed_processing"
+DUPLICATE_TRANSCRIPTS_DIR = PROJECT_ROOT / "FROM_TABLES" / "Archive" / "duplicate_transcriptions"
+SONGS_DIR = PROJECT_ROOT / "SONGS"
 TMP_DIR = PROJECT_ROOT / ".tmp_player"
 JOBS_TMP_DIR = TMP_DIR / "jobs" # <-- 2. MODIFICA: Directory per i batch temporanei
 
 PLAYLIST_FILE = TMP_DIR / "playlist.queue"
 PLAYLIST_LOCK_FILE = TMP_DIR / "playlist.queue.lock"
+RESERVE_FILE = TMP_DIR / "reserve.queue"
 PRODUCER_LOCK_FILE = TMP_DIR / "producer_instance.lock"
 PRODUCER_STATE_FILE = TMP_DIR / "producer_state.json"
+# Creazioni per tavolo registrate una riga alla volta; compattate nello snapshot ogni STATE_COMPACT_EVERY righe
+PRODUCER_JOURNAL_FILE = TMP_DIR / "producer_state.journal"
+STATE_COMPACT_EVERY = 200
+# Scritto dal worker nella cartella del job: canzoni già pubblicate in anticipo
+PUBLISHED_FILENAME = "published.json"
+# Con GENERATOR_MODE=broker: canzoni e risultato ricevuti, salvati prima dell'`ack` al broker
+BROKER_RESULT_FILENAME = "broker_result.json"
 
 # Il percorso dello script da lanciare deve essere assoluto per evitare errori
 SONG_GENERATOR_SCRIPT = PROJECT_ROOT / "GenerateSong.py"
 
 MAX_WORKERS= int(os.getenv("MAX_WORKERS", "2"))
 MAX_QUEUE_SIZE= int(os.getenv("MAX_QUEUE_SIZE", "2"))
+# Tracce extra di una stessa generazione: "queue" le accoda in playlist,
+# "reserve" le tiene in una riserva che il player usa quando la coda è vuota
+EXTRA_TRACKS_MODE = os.getenv("EXTRA_TRACKS_MODE", "reserve").strip().lower()
+# "daemon": un GenerateSong persistente per worker (protocollo JSON-lines su stdin/stdout);
+# "subprocess": un nuovo interprete per ogni canzone, come in origine;
+# "broker": i job vanno al broker (Broker.py) e li eseguono i Worker.py, anche su altre macchine
+GENERATOR_MODE = os.getenv("GENERATOR_MODE", "daemon").strip().lower()
+GENERATOR_LOG_FILE = PROJECT_ROOT / "LOGS" / "generator.log"
+# Micro-batching: con la pipeline occupata le trascrizioni di un tavolo si accumulano
+# finché il tavolo tace da BATCH_MIN_WAIT secondi e ha almeno BATCH_MIN_BYTES di testo,
+# o comunque non oltre BATCH_MAX_WAIT secondi dalla più vecchia. A pipeline ferma si parte subito.
+BATCH_MIN_WAIT = float(os.getenv("BATCH_MIN_WAIT", "20"))
+BATCH_MAX_WAIT = float(os.getenv("BATCH_MAX_WAIT", "120"))
+BATCH_MIN_BYTES = int(os.getenv("BATCH_MIN_BYTES", "400"))
+PRESSURE_INTERVAL = 5
 
 # --- FUNZIONI DI UTILITÀ ---
 def get_timestamp():
@@ -79,27 +116,267 @@ def clear_status_line():
     sys.stdout.flush()
 
 def get_queue_size() -> int:
-    """ Controlla in modo sicuro la dimensione attuale della playlist. """
+    """ Controlla in modo sicuro la dimensione attuale della playlist (righe in attesa + canzoni già nel player). """
     try:
         with FileLock(PLAYLIST_LOCK_FILE, timeout=1):
+            pending = len(read_player_pending())
             if not PLAYLIST_FILE.exists():
-                return 0
+                return pending
             lines = PLAYLIST_FILE.read_text(encoding="utf-8").splitlines()
-            return len([line for line in lines if line.strip()])
+            return pending + len([line for line in lines if line.strip()])
     except Timeout:
         return MAX_QUEUE_SIZE
     except FileNotFoundError:
         return 0
 
+def get_queued_songs() -> Optional[list[dict]]:
+    """ Voci della playlist e canzoni già prese dal player (per il controllo adattivo della coda); None se il lock è occupato. """
+    try:
+        with FileLock(PLAYLIST_LOCK_FILE, timeout=1):
+            lines = PLAYLIST_FILE.read_text(encoding="utf-8").splitlines() if PLAYLIST_FILE.exists() else []
+            songs = read_player_pending()
+    except Timeout:
+        return None # Come get_queue_size: nel dubbio la coda è piena, niente job pagati alla cieca
+    for line in lines:
+        try:
+            songs.append(json.loads(line))
+        except json.JSONDecodeError:
+            continue
+    return songs
+
+def publish_songs(playlist_lines: list[str], reserve_lines: list[str] = ()):
+    """
+    Accoda le righe JSON delle canzoni in playlist e nella riserva, sotto lo stesso lock.
+    Ogni riga della playlist riceve `created` e `deadline` (PlaylistQueue.py).
+    """
+    playlist_lines = [json.dumps(stamp_entry(json.loads(line))) for line in playlist_lines]
+    with FileLock(PLAYLIST_LOCK_FILE):
+        with open(PLAYLIST_FILE, "a", encoding="utf-8") as f:
+            f.writelines(line + "\n" for line in playlist_lines)
+        if reserve_lines:
+            with open(RESERVE_FILE, "a", encoding="utf-8") as f:
+                f.writelines(line + "\n" for line in reserve_lines)
+    if playlist_lines or reserve_lines:
+        notify_player() # Il player in attesa parte subito invece di aspettare il prossimo controllo
+
+# --- COMUNICAZIONE CON GenerateSong ---
+# Daemon GenerateSong del processo worker corrente: uno per processo del Pool,
+# avviato al primo job e riusato, così client OpenAI e connessioni TLS restano caldi.
+_generator_daemon = None
+
+def get_generator_daemon() -> subprocess.Popen:
+    """ Restituisce il daemon di questo worker, avviandolo (o riavviandolo) se necessario. """
+    global _generator_daemon
+    if _generator_daemon is None or _generator_daemon.poll() is not None:
+        GENERATOR_LOG_FILE.parent.mkdir(exist_ok=True)
+        with open(GENERATOR_LOG_FILE, "a", encoding="utf-8") as log_handle:
+            _generator_daemon = subprocess.Popen(
+                [sys.executable, "-u", str(SONG_GENERATOR_SCRIPT), "--serve"],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=log_handle, # I log di debug del daemon finiscono nel file, non in una pipe che si riempie
+                text=True,
+                encoding="utf-8",
+                cwd=PROJECT_ROOT
+            )
+    return _generator_daemon
+
+def kill_on_cancel(process: subprocess.Popen, cancel: Optional[threading.Event], done: Optional[threading.Event] = None):
+    """
+    Uccide `process` appena `cancel` viene impostato (prestito del broker perso) mentre il job è in
+    corso (fino a `done`): durante l'attesa di KieAI il generatore non produce eventi per minuti e
+    chi li legge non avrebbe occasione di fermarlo.
+    """
+    if cancel is None:
+        return
+    def watch():
+        while process.poll() is None and not (done and done.is_set()):
+            if cancel.wait(0.5):
+                process.kill()
+                return
+    threading.Thread(target=watch, daemon=True).start()
+
+def daemon_events(job_dir: Path, table_number: str, text: str, cancel: Optional[threading.Event] = None):
+    """ Invia un job al daemon e ne restituisce gli eventi fino al `result` (o finché `cancel` non lo interrompe). """
+    global _generator_daemon
+    job_id = job_dir.name
+    request = json.dumps({"id": job_id, "table": table_number, "text": text, "job_dir": str(job_dir)}) + "\n"
+    daemon = get_generator_daemon()
+    try:
+        daemon.stdin.write(request)
+        daemon.stdin.flush()
+    except OSError:
+        # Daemon morto tra un job e l'altro: se ne avvia uno nuovo e si riprova una volta
+        daemon.kill()
+        daemon = get_generator_daemon()
+        daemon.stdin.write(request)
+        daemon.stdin.flush()
+
+    finished, done = False, threading.Event()
+    kill_on_cancel(daemon, cancel, done)
+    try:
+        for line in iter(daemon.stdout.readline, ''):
+            try:
+                event = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if event.get("id") != job_id:
+                continue
+            if event.get("event") == "result":
+                finished = True
+            yield event
+            if finished:
+                return
+    finally:
+        done.set()
+        if not finished and daemon.poll() is None:
+            # Job abbandonato a metà (es. prestito del broker perso): il daemon non deve continuare a spendere
+            daemon.kill()
+            _generator_daemon = None
+    _generator_daemon = None
+    yield {"event": "result", "ok": False, "error": "il daemon è terminato durante il job"}
+
+def subprocess_events(job_dir: Path, table_number: str, text: str, cancel: Optional[threading.Event] = None):
+    """ Lancia un GenerateSong dedicato al job e traduce il suo output in eventi (`cancel` lo uccide). """
+    command = [sys.executable, "-u", str(SONG_GENERATOR_SCRIPT), table_number, "--job-dir", str(job_dir)]
+    # stderr su file e non su pipe: se il processo la riempie mentre leggiamo stdout si bloccherebbero entrambi
+    stderr_file = job_dir / "generator.stderr"
+    with open(stderr_file, "w", encoding="utf-8") as stderr:
+        process = subprocess.Popen(
+            command,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=stderr,
+            text=True,
+            encoding="utf-8",
+            cwd=PROJECT_ROOT
+        )
+    kill_on_cancel(process, cancel)
+    process.stdin.write(text)
+    process.stdin.close()
+
+    try:
+        for line in iter(process.stdout.readline, ''):
+            line = line.strip()
+            if not line: continue
+            if line.startswith("MILESTONE:"):
+                yield {"event": "progress", "message": line.replace("MILESTONE: ", "").strip()}
+            elif line.startswith("{"):
+                try:
+                    song_data = json.loads(line)
+                except json.JSONDecodeError:
+                    yield {"event": "log", "level": "info", "message": line}
+                    continue
+                yield {"event": "song", "data": song_data}
+            else:
+                yield {"event": "log", "level": "info", "message": line}
+    except GeneratorExit:
+        process.kill() # Job abbandonato a metà: niente altre chiamate API
+        raise
+
+    return_code = process.wait()
+    stderr_output = stderr_file.read_text(encoding="utf-8", errors="replace")
+    if stderr_output.strip() and return_code != 0:
+        yield {"event": "log", "level": "error", "message": stderr_output.strip()}
+    yield {"event": "result", "ok": return_code == 0, "error": f"codice {return_code}"}
+
+def store_song_files(song_data: dict) -> dict:
+    """ Salva in SONGS i file allegati da un worker remoto (WORKER_SEND_AUDIO) e punta la canzone alla copia locale. """
+    files = song_data.pop("files", None)
+    if not files:
+        return song_data # Cartella SONGS condivisa: il percorso è già valido qui
+    SONGS_DIR.mkdir(exist_ok=True)
+    for name, data in files.items():
+        dest = SONGS_DIR / Path(name).name
+        if not dest.exists():
+            tmp_dest = dest.with_name(dest.name + ".tmp")
+            tmp_dest.write_bytes(base64.b64decode(data))
+            os.replace(tmp_dest, dest)
+    return {**song_data, "path": str(SONGS_DIR / Path(song_data["path"]).name)}
+
+def broker_events(job_dir: Path, table_number: str, text: str):
+    """
+    Affida il job al broker e ne restituisce gli eventi mandati dal worker che lo esegue.
+    Canzoni e risultato finiscono in job_dir prima dell'`ack`: un job ripreso dopo un riavvio
+    li rilegge da lì, anche se il broker lo ha già dimenticato.
+    """
+    result_file = job_dir / BROKER_RESULT_FILENAME
+    try:
+        saved = json.loads(result_file.read_text(encoding="utf-8"))
+    except (FileNotFoundError, json.JSONDecodeError):
+        saved = None
+    if saved:
+        yield from saved
+        return
+    client = BrokerClient()
+    job = {"id": job_dir.name, "table": table_number, "text": text}
+    songs = {} # (percorso, anticipata) -> evento: una consegna ripetuta rimanda le stesse canzoni
+    submitted, warned = False, False
+    cursor = {"epoch": None, "attempt": None, "after": 0} # Il broker lo fa ripartire se non è più valido
+    while True:
+        try:
+            if not submitted:
+                client.call("submit", job=job) # Dopo un riavvio del Producer il broker riconosce il job già in corso
+                submitted = True
+            reply = client.call("fetch", id=job["id"], wait=20, **cursor)
+        except BrokerError as e:
+            if not warned:
+                yield {"event": "log", "level": "info", "message": f"{e}. Attendo che torni disponibile..."}
+                warned = True
+            time.sleep(5)
+            continue
+        if not reply.get("ok"):
+            submitted = False # Il broker ha perso il job (riavvio senza stato): lo si affida di nuovo
+            cursor = {"epoch": None, "attempt": None, "after": 0}
+            continue
+        warned = False
+        cursor = {"epoch": reply.get("epoch"), "attempt": reply.get("attempt"), "after": reply["next"]}
+        for event in reply["events"]:
+            if event.get("event") == "song":
+                event = {**event, "data": store_song_files(event["data"])}
+                songs[(event["data"]["path"], bool(event["data"].get("early")))] = event
+            if event.get("event") == "result":
+                tmp_file = result_file.with_suffix(".tmp")
+                tmp_file.write_text(json.dumps(list(songs.values()) + [event]), encoding="utf-8")
+                os.replace(tmp_file, result_file)
+                try:
+                    client.call("ack", id=job["id"])
+                except BrokerError:
+                    pass # Senza ack il broker tiene il risultato per BROKER_RESULT_TTL, nessun danno
+                client.close()
+                yield event
+                return
+            yield event
+
+def generator_events(job_dir: Path, table_number: str, text: str):
+    """ Eventi del job secondo GENERATOR_MODE. L'avanzamento del job resta salvato in job_dir. """
+    if GENERATOR_MODE == "subprocess":
+        return subprocess_events(job_dir, table_number, text)
+    if GENERATOR_MODE == "broker":
+        return broker_events(job_dir, table_number, text)
+    return daemon_events(job_dir, table_number, text)
+
+def load_published_paths(job_dir: Path) -> set:
+    """ Canzoni del job già pubblicate in anticipo (sopravvive a un riavvio del Producer). """
+    try:
+        return set(json.loads((job_dir / PUBLISHED_FILENAME).read_text(encoding="utf-8")))
+    except (FileNotFoundError, json.JSONDecodeError):
+        return set()
+
+def save_published_paths(job_dir: Path, paths: set):
+    (job_dir / PUBLISHED_FILENAME).write_text(json.dumps(sorted(paths)), encoding="utf-8")
+
 # --- LOGICA DEL WORKER ---
 # <-- 3. MODIFICA: La firma della funzione ora accetta job_dir invece di calcolarlo -->
-def create_song_worker(job_dir: Path, table_number: int, creations_count: int) -> tuple[int, bool]:
+def create_song_worker(job_dir: Path, table_number: str, creations_count: int, resumed: bool = False) -> tuple[str, bool]:
     """
     Funzione eseguita da ogni processo worker.
     Lavora su una directory di job temporanea e isolata.
+    Con `resumed` il job era rimasto a metà da un'esecuzione precedente del Producer.
     """
     clear_status_line()
-    print(f"{Fore.CYAN}{get_timestamp()} [ {table_number} ] Equità: {creations_count}. COMPONGO (Job: {job_dir.name})!{Style.RESET_ALL}")
+    action = "RIPRENDO" if resumed else "COMPONGO"
+    print(f"{Fore.CYAN}{get_timestamp()} [ {table_number} ] Equità: {creations_count}. {action} (Job: {job_dir.name})!{Style.RESET_ALL}")
     
     # Il worker ora opera sulla directory di job che gli è stata passata
     transcript_files = sorted(list(job_dir.glob("*.txt")))
@@ -114,61 +391,74 @@ def create_song_worker(job_dir: Path, table_number: int, creations_count: int) -
         clear_status_line()
         print(f"{Fore.MAGENTA}{get_timestamp()} [ {table_number} ] Avviato. Trovati [{len(transcript_files)}] file. Genero riassunto & lyrics...{Style.RESET_ALL}")
 
-        command = [sys.executable, "-u", str(SONG_GENERATOR_SCRIPT), str(table_number)]
-        process = subprocess.Popen(
-            command,
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-            encoding="utf-8",
-            cwd=PROJECT_ROOT
-        )
-        process.stdin.write(concatenated_text)
-        process.stdin.close()
-        
-        song_data_json = ""
-        for line in iter(process.stdout.readline, ''):
-            line = line.strip()
-            if not line: continue
+        song_data_lines = []
+        song_paths = set()
+        early_paths = load_published_paths(job_dir)
+        errors = []
+        result = {"ok": False}
+        job_started_at = time.monotonic()
+        for event in generator_events(job_dir, table_number, concatenated_text):
+            kind = event.get("event")
+            if kind == "stream":
+                continue # Frammenti di testo in streaming: utili ai client interattivi, non al log
             clear_status_line()
-            if line.startswith("MILESTONE:"):
-                message = line.replace("MILESTONE: ", "").strip()
+            if kind == "progress":
+                message = event["message"]
                 color = Fore.YELLOW + Style.BRIGHT if "INVIO ALL'API" in message else Style.DIM
                 print(f"{color}{get_timestamp()} [ {table_number} ] {message}{Style.RESET_ALL}")
-            elif line.startswith("{"):
-                song_data_json = line
-            else:
-                print(f"{Style.DIM}{line}{Style.RESET_ALL}")
-        
-        stderr_output = process.stderr.read()
-        return_code = process.wait()
-
-        if return_code != 0:
+            elif kind == "song":
+                song_data = event["data"]
+                if song_data.get("early"):
+                    # Pubblicazione anticipata: la canzone va in playlist mentre il download è in corso
+                    if song_data["path"] in early_paths:
+                        continue # Già pubblicata prima di un riavvio
+                    publish_songs([json.dumps(song_data)])
+                    early_paths.add(song_data["path"])
+                    save_published_paths(job_dir, early_paths)
+                    print(f"{Fore.GREEN}{get_timestamp()} [ {table_number} ] Canzone pubblicata in anticipo dopo {time.monotonic() - job_started_at:.0f}s.{Style.RESET_ALL}")
+                elif song_data["path"] not in song_paths: # Un job riconsegnato rimanda anche le canzoni già ricevute
+                    song_paths.add(song_data["path"])
+                    song_data_lines.append(json.dumps(song_data))
+            elif kind == "log":
+                if event.get("level") == "error":
+                    errors.append(event["message"])
+                else:
+                    print(f"{Style.DIM}{event['message']}{Style.RESET_ALL}")
+            elif kind == "result":
+                result = event
+
+        if not result.get("ok"):
             clear_status_line()
-            print(f"{Fore.RED}{Style.BRIGHT}{get_timestamp()} [ {table_number} ] ERRORE! '{SONG_GENERATOR_SCRIPT.name}' ha fallito (codice {return_code}).{Style.RESET_ALL}")
-            print(f"{Fore.RED}{stderr_output.strip()}", file=sys.stderr)
+            print(f"{Fore.RED}{Style.BRIGHT}{get_timestamp()} [ {table_number} ] ERRORE! '{SONG_GENERATOR_SCRIPT.name}' ha fallito ({result.get('error', 'job non riuscito')}).{Style.RESET_ALL}")
+            if errors:
+                print(f"{Fore.RED}" + "\n".join(errors), file=sys.stderr)
             # Sposta l'intera cartella del job fallito per l'analisi
             error_dir = FAILED_TRANSCRIPTS_DIR / f"failed_job_{job_dir.name}"
             shutil.move(str(job_dir), str(error_dir))
             return table_number, False
 
-        if not song_data_json:
+        if not song_data_lines and not early_paths:
             clear_status_line()
             print(f"{Fore.RED}{Style.BRIGHT}{get_timestamp()} [ {table_number} ] ERRORE! Script terminato senza output JSON.{Style.RESET_ALL}")
             return table_number, False
         
-        with FileLock(PLAYLIST_LOCK_FILE):
-            with open(PLAYLIST_FILE, "a", encoding="utf-8") as f:
-                f.write(song_data_json + "\n")
+        # La prima traccia va sempre in playlist, le altre secondo EXTRA_TRACKS_MODE
+        playlist_lines, reserve_lines = song_data_lines[:1], song_data_lines[1:]
+        if EXTRA_TRACKS_MODE == "queue":
+            playlist_lines, reserve_lines = song_data_lines, []
+        # Le tracce già pubblicate in anticipo non vanno accodate una seconda volta
+        playlist_lines = [l for l in playlist_lines if json.loads(l)["path"] not in early_paths]
+        publish_songs(playlist_lines, reserve_lines)
+        if EXTRA_TRACKS_MODE == "queue":
+            record_sample("tracks", len(playlist_lines) + len(early_paths))
         
-        archive_sub_dir = TRANSCRIPT_ARCHIVE_DIR / str(table_number)
+        archive_sub_dir = TRANSCRIPT_ARCHIVE_DIR / table_number
         archive_sub_dir.mkdir(parents=True, exist_ok=True)
         for txt_file in transcript_files: # I file sono ancora in job_dir
             shutil.move(str(txt_file), str(archive_sub_dir / txt_file.name))
         
         clear_status_line()
-        print(f"{Fore.GREEN}{Style.BRIGHT}{get_timestamp()} [ {table_number} ] PRODUZIONE COMPLETATA! Canzone inviata alla playlist.{Style.RESET_ALL}")
+        print(f"{Fore.GREEN}{Style.BRIGHT}{get_timestamp()} [ {table_number} ] PRODUZIONE COMPLETATA! {len(playlist_lines) + len(early_paths)} in playlist, {len(reserve_lines)} in riserva.{Style.RESET_ALL}")
         
         # <-- 4. MODIFICA: Pulisce la cartella del job temporaneo dopo il successo -->
         shutil.rmtree(job_dir)
@@ -189,7 +479,17 @@ class ProducerManager:
     def __init__(self, max_workers: int):
         self.max_workers = max_workers
         self.active_jobs = {}
+        # job -> {"started": istante di avvio (None per i job ripresi), "oldest": trascrizione più vecchia}
+        self.job_meta = {}
+        self.queue_plan = None
+        self.pressure = 0.0
+        self.pressure_published_at = 0.0
+        self.journal_lines = 0
         self.creation_counts = self._load_state()
+        self.scheduler = TableScheduler()
+        # Trascrizioni in attesa per tavolo, aggiornate dagli eventi di AudioWatchdog
+        self.index = PendingIndex(WORK_DIR)
+        self.duplicates = NearDuplicateIndex()
         self.spinner_chars = ['-', '\\', '|', '/']
         self.spinner_index = 0
         
@@ -197,36 +497,56 @@ class ProducerManager:
         print(f"{Fore.CYAN}{get_timestamp()} [PRODUCER] Manager avviato. Workers: {max_workers}, Coda max: {MAX_QUEUE_SIZE}.{Style.RESET_ALL}")
 
     def _load_state(self) -> dict:
-        default_counts = {str(i): 0 for i in range(1, 6)}
-        if not PRODUCER_STATE_FILE.exists():
-            return default_counts
-        try:
-            with PRODUCER_STATE_FILE.open('r') as f:
-                counts = json.load(f)
-                for i in range(1, 6):
-                    if str(i) not in counts:
-                        counts[str(i)] = 0
-                return counts
-        except (json.JSONDecodeError, IOError):
-            clear_status_line()
-            print(f"{Fore.RED}{get_timestamp()} [PRODUCER] ERRORE: File di stato corrotto. Ricomincio da zero.{Style.RESET_ALL}", file=sys.stderr)
-            return default_counts
+        """ Snapshot delle creazioni per tavolo più le righe del journal scritte dopo. I tavoli nascono al primo uso. """
+        counts = {}
+        if PRODUCER_STATE_FILE.exists():
+            try:
+                with PRODUCER_STATE_FILE.open('r') as f:
+                    counts = {str(table): n for table, n in json.load(f).items()}
+            except (json.JSONDecodeError, IOError, AttributeError):
+                clear_status_line()
+                print(f"{Fore.RED}{get_timestamp()} [PRODUCER] ERRORE: File di stato corrotto. Ricomincio da zero.{Style.RESET_ALL}", file=sys.stderr)
+        if PRODUCER_JOURNAL_FILE.exists():
+            for line in PRODUCER_JOURNAL_FILE.read_text(encoding="utf-8").splitlines():
+                try:
+                    table = json.loads(line)["table"]
+                except (json.JSONDecodeError, KeyError, TypeError):
+                    continue # Riga troncata da un'interruzione durante la scrittura
+                counts[table] = counts.get(table, 0) + 1
+                self.journal_lines += 1
+        return counts
 
     def _save_state(self):
-        with PRODUCER_STATE_FILE.open('w') as f:
-            json.dump(self.creation_counts, f, indent=2)
+        """ Riscrive lo snapshot completo e svuota il journal (compattazione). """
+        tmp_file = PRODUCER_STATE_FILE.with_suffix(".tmp")
+        tmp_file.write_text(json.dumps(self.creation_counts, separators=(",", ":")), encoding="utf-8")
+        os.replace(tmp_file, PRODUCER_STATE_FILE)
+        PRODUCER_JOURNAL_FILE.unlink(missing_ok=True)
+        self.journal_lines = 0
+
+    def _record_creation(self, table: str):
+        """ Una canzone in più per il tavolo: si aggiunge una riga al journal invece di riscrivere tutto. """
+        self.creation_counts[table] = self.creation_counts.get(table, 0) + 1
+        with PRODUCER_JOURNAL_FILE.open('a', encoding="utf-8") as f:
+            f.write(json.dumps({"table": table}) + "\n")
+        self.journal_lines += 1
+        if self.journal_lines >= STATE_COMPACT_EVERY:
+            self._save_state()
 
     def run(self):
         """Ciclo principale del manager."""
         # <-- 5. MODIFICA: Assicura che anche la directory dei job venga creata -->
-        for d in [TMP_DIR, WORK_DIR, TRANSCRIPT_ARCHIVE_DIR, FAILED_TRANSCRIPTS_DIR, JOBS_TMP_DIR]:
+        for d in [TMP_DIR, WORK_DIR, TRANSCRIPT_ARCHIVE_DIR, FAILED_TRANSCRIPTS_DIR, DUPLICATE_TRANSCRIPTS_DIR, JOBS_TMP_DIR]:
             d.mkdir(parents=True, exist_ok=True)
             
         with Pool(processes=self.max_workers) as pool:
             try:
+                self.resume_orphaned_jobs(pool)
                 while True:
                     self.cleanup_finished_jobs()
+                    self.index.poll()
                     self.assign_new_jobs_fairly(pool)
+                    self.publish_pressure()
                     self.print_status_with_spinner()
                     time.sleep(0.2)
             except KeyboardInterrupt:
@@ -234,6 +554,10 @@ class ProducerManager:
                 print(f"\n{Fore.YELLOW}{get_timestamp()} [PRODUCER] Terminazione richiesta... Attendo fine lavori...{Style.RESET_ALL}")
                 pool.close()
                 pool.join()
+            finally:
+                write_pressure(0.0) # Producer fermo: nessuno deve restare frenato
+                self.scheduler.flush(force=True)
+                self._save_state()
         
         clear_status_line()
         print(f"{Fore.CYAN}{get_timestamp()} [PRODUCER] Lavori terminati. Uscita pulita.{Style.RESET_ALL}")
@@ -244,39 +568,125 @@ class ProducerManager:
 
         for job in completed_jobs:
             table = self.active_jobs.pop(job)
+            meta = self.job_meta.pop(job)
             try:
                 _, success = job.get()
+                if success and meta["started"] is not None:
+                    record_sample("generation", time.monotonic() - meta["started"])
                 if success:
-                    # Assicuriamoci di aggiornare dinamicamente il dizionario se un tavolo non esiste
-                    if str(table) not in self.creation_counts:
-                         self.creation_counts[str(table)] = 0
-                    self.creation_counts[str(table)] += 1
-                    self._save_state()
+                    self.scheduler.record_completion(table, meta["oldest"])
+                    self.duplicates.commit(table, meta.get("signatures"))
+                    self._record_creation(table)
             except Exception as e:
                 clear_status_line()
                 print(f"{Fore.RED}{Style.BRIGHT}{get_timestamp()} [PRODUCER] ERRORE CRITICO ottenendo risultato per tavolo #{table}: {e}{Style.RESET_ALL}", file=sys.stderr)
 
+    def resume_orphaned_jobs(self, pool):
+        """
+        Riprende i job rimasti in JOBS_TMP_DIR da un'esecuzione interrotta. Il lock di istanza
+        garantisce che nessun altro Producer li stia lavorando; ogni job riparte dall'ultima
+        fase salvata in job.json (task KieAI compresi), senza ripagare le chiamate già fatte.
+        """
+        orphaned = sorted(d for d in JOBS_TMP_DIR.iterdir() if d.is_dir() and any(d.glob('*.txt')))
+        for job_dir in orphaned:
+            table = job_dir.name.split("_")[0]
+            if not is_table_id(table):
+                continue
+            clear_status_line()
+            print(f"{Fore.YELLOW}{get_timestamp()} [PRODUCER] Job interrotto trovato: {job_dir.name}. Lo riprendo.{Style.RESET_ALL}")
+            self.launch_job(pool, job_dir, table, resumed=True)
+
+    def launch_job(self, pool, job_dir: Path, table: str, resumed: bool = False, signatures: Optional[list] = None):
+        """Affida un job a un worker del Pool e ne tiene traccia (`signatures`: firme dei quasi-duplicati, da registrare se riesce)."""
+        creations = self.creation_counts.get(table, 0)
+        job_obj = pool.apply_async(create_song_worker, args=(job_dir, table, creations, resumed))
+        self.active_jobs[job_obj] = table
+        self.job_meta[job_obj] = {
+            "started": None if resumed else time.monotonic(),
+            "oldest": oldest_transcript_time(job_dir) or time.time(), # shutil.move conserva la data di modifica
+            "signatures": signatures,
+        }
+
     # <-- 6. MODIFICA: Logica di assegnazione completamente riscritta con Batch Atomici -->
-    def assign_new_jobs_fairly(self, pool):
-        """Assegna nuovi lavori usando batch atomici per massimizzare il throughput."""
-        if get_queue_size() >= MAX_QUEUE_SIZE or len(self.active_jobs) >= self.max_workers:
+    def queue_is_full(self) -> bool:
+        """
+        In modalità fissa la coda è piena a MAX_QUEUE_SIZE canzoni. In modalità adattiva
+        MAX_QUEUE_SIZE resta il tetto, ma si avviano job solo finché la musica disponibile
+        e quella in arrivo non coprono la latenza p90 di una nuova generazione.
+        """
+        if QUEUE_CONTROL != "adaptive":
+            return get_queue_size() >= MAX_QUEUE_SIZE
+        queued_songs = get_queued_songs()
+        if queued_songs is None:
+            return True
+        self.queue_plan = plan(queued_songs, len(self.active_jobs), EXTRA_TRACKS_MODE == "queue")
+        return len(queued_songs) >= MAX_QUEUE_SIZE or self.queue_plan["to_start"] == 0
+
+    def publish_pressure(self):
+        """ Ogni PRESSURE_INTERVAL secondi pubblica il livello di contropressione per watchdog e tavoli. """
+        now = time.monotonic()
+        if now - self.pressure_published_at < PRESSURE_INTERVAL:
             return
+        self.pressure_published_at = now
+        pending = self.index.total()
+        queued = get_queue_size()
+        # Canzoni in coda che servono: in modalità fissa tutte quelle fino a MAX_QUEUE_SIZE
+        needed = self.queue_plan["needed"] if QUEUE_CONTROL == "adaptive" and self.queue_plan else MAX_QUEUE_SIZE
+        self.pressure = compute_pressure(queued, MAX_QUEUE_SIZE, pending, needed)
+        write_pressure(self.pressure, queued=queued, needed=needed, pending_transcripts=pending,
+                       active_jobs=len(self.active_jobs))
+
+    def batch_is_ready(self, stats: dict, now: float) -> bool:
+        """ Decide se le trascrizioni in attesa di un tavolo formano già un batch da inviare. """
+        if not self.active_jobs:
+            return True # Pipeline ferma: la latenza conta più del risparmio
+        if now - stats["oldest"] >= BATCH_MAX_WAIT:
+            return True
+        return now - stats["newest"] >= BATCH_MIN_WAIT and stats["bytes"] >= BATCH_MIN_BYTES
+
+    def filter_near_duplicates(self, table: str, job_dir: Path) -> Optional[list]:
+        """
+        Confronta il batch con le trascrizioni recenti del tavolo. In modalità "skip" i quasi-duplicati
+        vanno in archivio e, se non resta niente di nuovo, il job non parte. Ritorna le firme da
+        registrare a job riuscito, oppure None se non c'è niente da produrre.
+        """
+        fresh, duplicates, signatures = self.duplicates.check_batch(table, list(job_dir.glob('*.txt')))
+        for path, (original, score) in duplicates.items():
+            clear_status_line()
+            print(f"{Fore.YELLOW}{get_timestamp()} [ {table} ] Quasi-duplicato: {path.name} ~ {original} ({score:.0%}).{Style.RESET_ALL}")
+            if NEAR_DUP_ACTION == "skip":
+                archive_dir = DUPLICATE_TRANSCRIPTS_DIR / table
+                archive_dir.mkdir(parents=True, exist_ok=True)
+                shutil.move(str(path), str(archive_dir / path.name))
+        if NEAR_DUP_ACTION != "skip" or fresh:
+            return signatures
+        shutil.rmtree(job_dir)
+        self.duplicates.record_skipped_job()
+        clear_status_line()
+        print(f"{Fore.YELLOW}{get_timestamp()} [ {table} ] Batch già cantato: job saltato "
+              f"(chiamate API evitate finora: {self.duplicates.stats()['api_calls_avoided']}).{Style.RESET_ALL}")
+        return None
 
-        while len(self.active_jobs) < self.max_workers:
-            # Scansiona le directory con file .txt pronti
-            ready_dirs = [d for d in WORK_DIR.iterdir() if d.is_dir() and d.name.isdigit() and any(d.glob('*.txt'))]
-            candidate_tables = [d.name for d in ready_dirs]
+    def assign_new_jobs_fairly(self, pool):
+        """Assegna nuovi lavori usando batch atomici per massimizzare il throughput."""
+        while len(self.active_jobs) < self.max_workers and not self.queue_is_full():
+            # Solo i tavoli con trascrizioni in attesa, dall'indice in memoria: nessuna scansione di WORK_DIR
+            now = time.time()
+            ready = {}
+            for table in self.index.tables():
+                stats = self.index.stats(table)
+                if stats and self.batch_is_ready(stats, now):
+                    ready[table] = stats["oldest"]
             
-            if not candidate_tables:
+            if not ready:
                 break # Nessun lavoro da assegnare
 
-            # Logica di equità: scegli il tavolo con meno creazioni tra quelli con lavoro pronto
-            table_to_process_str = min(candidate_tables, key=lambda t: self.creation_counts.get(t, 0))
-            table_to_process = int(table_to_process_str)
-            creations = self.creation_counts.get(table_to_process_str, 0)
+            # Logica di equità: servizio recente (con decadimento) e margine sullo SLO di latenza del tavolo
+            table_to_process = self.scheduler.pick(ready)
+            self.index.take(table_to_process)
 
             # --- INIZIO LOGICA DEL BATCH ATOMICO ---
-            source_dir = WORK_DIR / table_to_process_str
+            source_dir = WORK_DIR / table_to_process
             # Rilegge i file per sicurezza, per evitare race conditions
             files_to_process = list(source_dir.glob('*.txt'))
             
@@ -284,7 +694,7 @@ class ProducerManager:
                 continue # I file sono spariti tra la scansione e ora, riprova il ciclo
 
             # 1. Crea una directory di job unica
-            job_id = f"{table_to_process_str}_{datetime.now().strftime('%H%M%S')}_{uuid.uuid4().hex[:6]}"
+            job_id = f"{table_to_process}_{datetime.now().strftime('%H%M%S')}_{uuid.uuid4().hex[:6]}"
             job_dir = JOBS_TMP_DIR / job_id
             job_dir.mkdir()
 
@@ -297,9 +707,16 @@ class ProducerManager:
                     pass
             # --- FINE LOGICA DEL BATCH ATOMICO ---
 
-            # 3. Lancia il worker passandogli il percorso del job
-            job_obj = pool.apply_async(create_song_worker, args=(job_dir, table_to_process, creations))
-            self.active_jobs[job_obj] = table_to_process
+            # 3. Le chiacchiere già trasformate in canzone di recente non ripagano un job intero
+            signatures = []
+            if NEAR_DUP_ACTION != "off":
+                signatures = self.filter_near_duplicates(table_to_process, job_dir)
+                if signatures is None:
+                    continue
+
+            # 4. Lancia il worker passandogli il percorso del job
+            self.scheduler.record_dispatch(table_to_process, ready[table_to_process])
+            self.launch_job(pool, job_dir, table_to_process, signatures=signatures)
 
 
     def print_status_with_spinner(self):
@@ -308,7 +725,13 @@ class ProducerManager:
         
         status_msg = f"Slot liberi: {self.max_workers - len(self.active_jobs)}/{self.max_workers} | Coda: {current_queue_size}/{MAX_QUEUE_SIZE} | In Lavorazione: {active_list}"
         
-        if current_queue_size >= MAX_QUEUE_SIZE:
+        if self.pressure > 0:
+            status_msg += f" | Pressione: {self.pressure:.2f}"
+        if self.duplicates.stats()["skipped_jobs"]:
+            status_msg += f" | Duplicati evitati: {self.duplicates.stats()['skipped_jobs']}"
+        if self.queue_plan:
+            status_msg += f" | Musica: {self.queue_plan['buffered']:.0f}s / latenza job: {self.queue_plan['latency']:.0f}s"
+        if current_queue_size >= MAX_QUEUE_SIZE or (self.queue_plan and self.queue_plan["to_start"] == 0):
              status_msg += f" {Fore.YELLOW}(IN PAUSA){Style.RESET_ALL}"
         
         spinner_char = self.spinner_chars[self.spinner_index]
@@ -318,11 +741,60 @@ class ProducerManager:
         sys.stdout.flush()
         self.spinner_index = (self.spinner_index + 1) % len(self.spinner_chars)
 
+# --- BENCHMARK DELLO SCHEDULING ---
+def benchmark_scheduling(table_counts=(5, 50, 500), busy_tables: int = 5, ticks: int = 200):
+    """
+    Costo di un giro di scheduling al crescere dei tavoli (in una cartella temporanea):
+    scansione di tutte le cartelle come in origine contro indice in memoria + scelta del tavolo.
+    Solo `busy_tables` tavoli hanno trascrizioni in attesa, come in una serata reale.
+    """
+    import tempfile
+    scheduler = TableScheduler()
+    print(f"{'tavoli':>7} {'scansione (ms/giro)':>20} {'indice (ms/giro)':>17}")
+    for count in table_counts:
+        with tempfile.TemporaryDirectory() as tmp:
+            work_dir = Path(tmp)
+            for i in range(count):
+                table_dir = work_dir / f"sala{i // 100}.{i % 100 + 1}"
+                table_dir.mkdir()
+                if i % max(1, count // busy_tables) == 0:
+                    for n in range(3):
+                        (table_dir / f"{table_dir.name}-{n}.txt").write_text("chiacchiere " * 50, encoding="utf-8")
+
+            started = time.perf_counter()
+            for _ in range(ticks):
+                ready = {}
+                for d in work_dir.iterdir():
+                    stats = transcript_stats(d) if d.is_dir() and is_table_id(d.name) else None
+                    if stats:
+                        ready[d.name] = stats["oldest"]
+                scheduler.pick(ready)
+            scan_ms = (time.perf_counter() - started) / ticks * 1000
+
+            index = PendingIndex(work_dir)
+            index.rescan() # Una volta all'avvio, poi solo eventi
+            started = time.perf_counter()
+            for _ in range(ticks):
+                index.poll()
+                ready = {table: index.stats(table)["oldest"] for table in index.tables()}
+                scheduler.pick(ready)
+            index_ms = (time.perf_counter() - started) / ticks * 1000
+        print(f"{count:>7} {scan_ms:>20.3f} {index_ms:>17.3f}")
+
 # --- PUNTO DI INGRESSO DELLO SCRIPT ---
 if __name__ == "__main__":
+    if "--bench-scheduler" in sys.argv:
+        benchmark_scheduling()
+        sys.exit(0)
+
     print(f"{Fore.BLUE}{Style.BRIGHT}--- Parametri di Configurazione Caricati ---{Style.RESET_ALL}")
     print(f"{Fore.BLUE}  - MAX_WORKERS    : {MAX_WORKERS}{Style.RESET_ALL}")
     print(f"{Fore.BLUE}  - MAX_QUEUE_SIZE : {MAX_QUEUE_SIZE}{Style.RESET_ALL}")
+    print(f"{Fore.BLUE}  - EXTRA_TRACKS   : {EXTRA_TRACKS_MODE}{Style.RESET_ALL}")
+    print(f"{Fore.BLUE}  - GENERATOR_MODE : {GENERATOR_MODE}{Style.RESET_ALL}")
+    if GENERATOR_MODE == "broker":
+        print(f"{Fore.BLUE}  - WORK_BROKER    : {WORK_BROKER}{Style.RESET_ALL}")
+    print(f"{Fore.BLUE}  - QUEUE_CONTROL  : {QUEUE_CONTROL}{Style.RESET_ALL}")
     print(f"{Fore.BLUE}{Style.BRIGHT}-------------------------------------------{Style.RESET_ALL}\n")
 
     try:
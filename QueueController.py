@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# ____    _    ____   ____    _    ____  ____
+#| __ )  / \  |  _ \ | __ )  / \  |  _ \|  _ \
+#|  _ \ / _ \ | |_) ||  _ \ / _ \ | |_) | | | |
+#| |_) / ___ \|  _ < | |_) / ___ \|  _ <| |_| |
+#|____/_/   \_\_| \_\|____/_/   \_\_| \_\____/
+
+"""
+QueueController.py: Profondità della coda calcolata invece che fissa.
+Il player pubblica cosa sta suonando (`now_playing.json`) e la durata delle canzoni;
+il Producer registra la latenza end-to-end di ogni job. Da questi dati si ricava
+quanti job avviare adesso perché la musica non finisca prima che arrivi la prossima
+canzone, senza produrne in anticipo più di quante ne servano.
+"""
+
+import os
+import json
+import math
+import time
+from pathlib import Path
+from typing import Optional
+
+from filelock import FileLock, Timeout
+
+from KieLatency import percentile
+
+try:
+    PROJECT_ROOT = Path(__file__).parent.resolve()
+except NameError:
+    PROJECT_ROOT = Path('.').resolve()
+
+# --- CONFIGURAZIONE ---
+TMP_DIR = PROJECT_ROOT / ".tmp_player"
+NOW_PLAYING_FILE = TMP_DIR / "now_playing.json"
+QUEUE_STATS_FILE = TMP_DIR / "queue_stats.json"
+QUEUE_STATS_LOCK_FILE = TMP_DIR / "queue_stats.json.lock"
+
+# "adaptive" (profondità calcolata) oppure "fixed" (solo MAX_QUEUE_SIZE, come in origine)
+QUEUE_CONTROL = os.getenv("QUEUE_CONTROL", "adaptive").strip().lower()
+# Percentile della latenza end-to-end su cui si pianifica (più alto = più prudente)
+QUEUE_LATENCY_PERCENTILE = float(os.getenv("QUEUE_LATENCY_PERCENTILE", "90"))
+# Margine in secondi oltre la latenza prevista
+QUEUE_SAFETY_SECONDS = float(os.getenv("QUEUE_SAFETY_SECONDS", "30"))
+# Stime usate finché non ci sono abbastanza misure
+DEFAULT_SONG_SECONDS = float(os.getenv("DEFAULT_SONG_SECONDS", "180"))
+DEFAULT_GENERATION_SECONDS = float(os.getenv("DEFAULT_GENERATION_SECONDS", "240"))
+# Tracce in playlist per job con EXTRA_TRACKS_MODE=queue (una generazione ne produce di solito due)
+DEFAULT_TRACKS_PER_JOB = float(os.getenv("DEFAULT_TRACKS_PER_JOB", "2"))
+QUEUE_STATS_MAX_SAMPLES = 100
+QUEUE_STATS_MIN_SAMPLES = 3
+
+
+def load_queue_stats() -> dict:
+    try:
+        return json.loads(QUEUE_STATS_FILE.read_text(encoding="utf-8"))
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def record_sample(key: str, seconds: float):
+    """Aggiunge una misura ("generation", "song" o "tracks") allo storico condiviso."""
+    TMP_DIR.mkdir(exist_ok=True)
+    try:
+        with FileLock(QUEUE_STATS_LOCK_FILE, timeout=2):
+            stats = load_queue_stats()
+            values = stats.setdefault(key, [])
+            values.append(round(seconds, 1))
+            del values[:-QUEUE_STATS_MAX_SAMPLES]
+            tmp_file = QUEUE_STATS_FILE.with_suffix(".tmp")
+            tmp_file.write_text(json.dumps(stats), encoding="utf-8")
+            os.replace(tmp_file, QUEUE_STATS_FILE)
+    except Timeout:
+        pass # Le statistiche non devono mai bloccare player o Producer
+
+
+def generation_latency(stats: Optional[dict] = None) -> float:
+    """Latenza end-to-end di un job al percentile configurato."""
+    samples = (load_queue_stats() if stats is None else stats).get("generation", [])
+    if len(samples) < QUEUE_STATS_MIN_SAMPLES:
+        return DEFAULT_GENERATION_SECONDS
+    return percentile(samples, QUEUE_LATENCY_PERCENTILE)
+
+
+def typical_song_seconds(stats: Optional[dict] = None) -> float:
+    """Durata mediana delle canzoni suonate, per le voci in coda senza durata nota."""
+    samples = (load_queue_stats() if stats is None else stats).get("song", [])
+    if len(samples) < QUEUE_STATS_MIN_SAMPLES:
+        return DEFAULT_SONG_SECONDS
+    return percentile(samples, 50)
+
+
+def tracks_per_job(stats: Optional[dict] = None) -> float:
+    """Tracce mandate in playlist da un job (mediana), quando anche le extra vanno in coda."""
+    samples = (load_queue_stats() if stats is None else stats).get("tracks", [])
+    if len(samples) < QUEUE_STATS_MIN_SAMPLES:
+        return DEFAULT_TRACKS_PER_JOB
+    return max(1.0, percentile(samples, 50))
+
+
+def write_now_playing(path: str, duration: float, position: float):
+    """Chiamata dal player all'inizio di ogni canzone."""
+    data = {"path": path, "started": time.time() - position, "duration": duration}
+    tmp_file = NOW_PLAYING_FILE.with_suffix(".tmp")
+    tmp_file.write_text(json.dumps(data), encoding="utf-8")
+    os.replace(tmp_file, NOW_PLAYING_FILE)
+
+
+def clear_now_playing():
+    NOW_PLAYING_FILE.unlink(missing_ok=True)
+
+
+def remaining_playback_seconds() -> float:
+    """Secondi che mancano alla fine della canzone in riproduzione (0 se il player è fermo)."""
+    try:
+        data = json.loads(NOW_PLAYING_FILE.read_text(encoding="utf-8"))
+        return max(0.0, data["started"] + data["duration"] - time.time())
+    except (FileNotFoundError, json.JSONDecodeError, KeyError, TypeError):
+        return 0.0
+
+
+def plan(queued_songs: list[dict], in_flight: int, extra_tracks_queued: bool = False) -> dict:
+    """
+    Quanti job avviare ora. La musica già disponibile (resto della canzone corrente +
+    canzoni in coda) più quella promessa dai job in corso deve coprire la latenza di
+    un job avviato adesso, più un margine. Con `extra_tracks_queued` ogni job promette
+    tutte le tracce che manda in playlist, non una sola. Ritorna i numeri usati, per il log;
+    `needed` sono le canzoni in coda che servono davvero (le altre sono eccedenza, vedi Pressure.py).
+    """
+    stats = load_queue_stats()
+    song_seconds = typical_song_seconds(stats)
+    latency = generation_latency(stats)
+    job_seconds = song_seconds * (tracks_per_job(stats) if extra_tracks_queued else 1)
+    playing = remaining_playback_seconds()
+    buffered = playing + sum(s.get("duration") or song_seconds for s in queued_songs)
+    promised = in_flight * job_seconds
+    shortfall = latency + QUEUE_SAFETY_SECONDS - buffered - promised
+    to_start = max(0, math.ceil(shortfall / job_seconds))
+    return {
+        "buffered": buffered,
+        "latency": latency,
+        "to_start": to_start,
+        "needed": max(0, math.ceil((latency + QUEUE_SAFETY_SECONDS - playing - promised) / song_seconds)),
+        "target": len(queued_songs) + in_flight + to_start,
+    }
+
+
+if __name__ == "__main__":
+    # Stato del controllore: python QueueController.py
+    stats = load_queue_stats()
+    print(f"Latenza p{QUEUE_LATENCY_PERCENTILE:g}: {generation_latency(stats):.0f}s "
+          f"({len(stats.get('generation', []))} campioni)")
+    print(f"Durata tipica canzone: {typical_song_seconds(stats):.0f}s ({len(stats.get('song', []))} campioni)")
+    print(f"Tracce in playlist per job (EXTRA_TRACKS_MODE=queue): {tracks_per_job(stats):g} "
+          f"({len(stats.get('tracks', []))} campioni)")
+    print(f"Riproduzione rimanente: {remaining_playback_seconds():.0f}s")
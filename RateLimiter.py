@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# ____    _    ____   ____    _    ____  ____
+#| __ )  / \  |  _ \ | __ )  / \  |  _ \|  _ \
+#|  _ \ / _ \ | |_) ||  _ \ / _ \ | |_) | | | |
+#| |_) / ___ \|  _ < | |_) / ___ \|  _ <| |_| |
+#|____/_/   \_\_| \_\|____/_/   \_\_| \_\____/
+
+"""
+RateLimiter.py: Limitatore di richieste condiviso tra tutti i processi del progetto
+(AudioWatchdog, worker del Producer, daemon GenerateSong) e retry centralizzati.
+Per ogni coppia API/modello c'è un token bucket salvato in `.tmp_player/ratelimit.json`;
+un 429 con Retry-After blocca quella chiave per tutti, non solo per chi l'ha ricevuto.
+
+Limiti dal .env, in richieste al minuto (0 = nessun limite, solo Retry-After):
+    RATE_LIMIT_OPENAI_RPM=120
+    RATE_LIMIT_OPENAI_GPT_4O_RPM=60     (sovrascrive il limite dell'API per un modello)
+"""
+
+import os
+import re
+import json
+import time
+import random
+from email.utils import parsedate_to_datetime
+from pathlib import Path
+from typing import Callable, Optional, TypeVar
+
+import requests
+from filelock import FileLock
+
+try:
+    PROJECT_ROOT = Path(__file__).parent.resolve()
+except NameError:
+    PROJECT_ROOT = Path('.').resolve()
+
+# --- CONFIGURAZIONE ---
+TMP_DIR = PROJECT_ROOT / ".tmp_player"
+RATE_LIMIT_STATE_FILE = TMP_DIR / "ratelimit.json"
+RATE_LIMIT_LOCK_FILE = TMP_DIR / "ratelimit.json.lock"
+
+API_MAX_RETRIES = int(os.getenv("API_MAX_RETRIES", "5"))
+API_RETRY_BASE_SECONDS = float(os.getenv("API_RETRY_BASE_SECONDS", "2"))
+API_RETRY_MAX_SECONDS = float(os.getenv("API_RETRY_MAX_SECONDS", "60"))
+# Quante richieste possono partire a raffica prima che il ritmo si stabilizzi
+RATE_LIMIT_BURST = float(os.getenv("RATE_LIMIT_BURST", "3"))
+
+T = TypeVar("T")
+
+
+def _env_key(api: str, model: str = "") -> str:
+    name = f"{api}_{model}" if model else api
+    return "RATE_LIMIT_" + re.sub(r"[^A-Z0-9]+", "_", name.upper()).strip("_") + "_RPM"
+
+
+def requests_per_minute(api: str, model: str = "") -> float:
+    """Limite configurato per il modello, altrimenti per l'API. 0 = illimitato."""
+    value = os.getenv(_env_key(api, model)) if model else None
+    if value is None:
+        value = os.getenv(_env_key(api), "0")
+    try:
+        return float(value)
+    except ValueError:
+        return 0.0
+
+
+def _load_state() -> dict:
+    try:
+        return json.loads(RATE_LIMIT_STATE_FILE.read_text(encoding="utf-8"))
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def _save_state(state: dict):
+    tmp_file = RATE_LIMIT_STATE_FILE.with_suffix(".tmp")
+    tmp_file.write_text(json.dumps(state), encoding="utf-8")
+    os.replace(tmp_file, RATE_LIMIT_STATE_FILE)
+
+
+def acquire(api: str, model: str = ""):
+    """Attende finché la chiave API/modello non è sbloccata e ha un token libero, poi lo consuma."""
+    TMP_DIR.mkdir(exist_ok=True)
+    key = f"{api}:{model}"
+    rpm = requests_per_minute(api, model)
+    while True:
+        with FileLock(RATE_LIMIT_LOCK_FILE):
+            now = time.time()
+            state = _load_state()
+            bucket = state.setdefault(key, {"tokens": RATE_LIMIT_BURST, "updated": now, "blocked_until": 0})
+            if rpm > 0:
+                rate = rpm / 60.0
+                bucket["tokens"] = min(RATE_LIMIT_BURST, bucket["tokens"] + (now - bucket["updated"]) * rate)
+            bucket["updated"] = now
+            if bucket["blocked_until"] > now:
+                wait = bucket["blocked_until"] - now
+            elif rpm <= 0 or bucket["tokens"] >= 1:
+                if rpm > 0:
+                    bucket["tokens"] -= 1
+                _save_state(state)
+                return
+            else:
+                wait = (1 - bucket["tokens"]) / rate
+            _save_state(state)
+        # Jitter: i processi in attesa non si svegliano tutti nello stesso istante
+        time.sleep(min(wait, 5.0) + random.uniform(0, 0.25))
+
+
+def block(api: str, model: str, seconds: float):
+    """Blocca una chiave per tutti i processi (es. dopo un 429 con Retry-After)."""
+    TMP_DIR.mkdir(exist_ok=True)
+    with FileLock(RATE_LIMIT_LOCK_FILE):
+        state = _load_state()
+        bucket = state.setdefault(f"{api}:{model}", {"tokens": 0, "updated": time.time(), "blocked_until": 0})
+        bucket["blocked_until"] = max(bucket["blocked_until"], time.time() + seconds)
+        bucket["tokens"] = 0
+        _save_state(state)
+
+
+def retry_after_seconds(exc: Exception) -> Optional[float]:
+    """Legge Retry-After (secondi o data HTTP) o retry-after-ms dalla risposta allegata all'eccezione."""
+    response = getattr(exc, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    value = headers.get("retry-after-ms")
+    if value:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+
+def is_retryable(exc: Exception) -> bool:
+    """429, errori 5xx, timeout e problemi di connessione, sia per `requests` che per `openai`."""
+    status = getattr(exc, "status_code", None) or getattr(getattr(exc, "response", None), "status_code", None)
+    if status is not None:
+        return status == 429 or status >= 500
+    if isinstance(exc, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return True
+    return type(exc).__name__ in ("APIConnectionError", "APITimeoutError")
+
+
+def call_with_retry(fn: Callable[[], T], api: str, model: str = "",
+                    max_attempts: int = API_MAX_RETRIES, on_retry: Optional[Callable[[str], None]] = None) -> T:
+    """
+    Esegue `fn` rispettando il limitatore condiviso. Gli errori temporanei vengono
+    ritentati con backoff esponenziale e jitter; un Retry-After blocca la chiave per
+    tutti i processi. L'ultima eccezione viene rilanciata.
+    """
+    for attempt in range(1, max_attempts + 1):
+        acquire(api, model)
+        try:
+            return fn()
+        except Exception as exc:
+            if not is_retryable(exc):
+                raise
+            retry_after = retry_after_seconds(exc)
+            if retry_after is not None:
+                block(api, model, retry_after)
+            if attempt == max_attempts:
+                raise
+            delay = min(API_RETRY_BASE_SECONDS * (2 ** (attempt - 1)), API_RETRY_MAX_SECONDS)
+            delay = random.uniform(delay / 2, delay) # Full jitter dimezzato
+            if on_retry:
+                on_retry(f"{api}{':' + model if model else ''} errore temporaneo ({exc}), nuovo tentativo {attempt + 1}/{max_attempts}")
+            # Con Retry-After l'attesa la impone acquire(); qui solo il backoff
+            time.sleep(0 if retry_after is not None else delay)
+    raise RuntimeError("call_with_retry: nessun tentativo eseguito")
+
+
+if __name__ == "__main__":
+    # Stato dei bucket: python RateLimiter.py
+    for bucket_key, bucket_state in _load_state().items():
+        blocked = max(0.0, bucket_state["blocked_until"] - time.time())
+        api_name, _, model_name = bucket_key.partition(":")
+        print(f"{bucket_key:<28} rpm: {requests_per_minute(api_name, model_name):<6g} "
+              f"token: {bucket_state['tokens']:.2f}  bloccato ancora: {blocked:.0f}s")
@@ -10,8 +10,10 @@
 
 
 """
-Riproduzione.py: Riproduce le canzoni generate in ordine FIFO,
-con un'interfaccia a dashboard e crossfade.
+Riproduzione.py: Riproduce le canzoni generate in ordine di priorità (scadenza di
+freschezza ed equità tra tavoli, PlaylistQueue.py), con un'interfaccia a dashboard e crossfade. Con PLAYER_BACKEND=decks due mpv
+restano sempre accesi e si alternano (MpvDecks.py); con PLAYER_BACKEND=mix il
+mixaggio avviene in Python (MixEngine.py).
 (Versione con percorsi dinamici e portabili)
 """
 
@@ -19,6 +21,7 @@ con un'interfaccia a dashboard e crossfade.
 import os
 import sys
 from pathlib import Path
+from dotenv import load_dotenv
 
 # Trova il percorso assoluto della directory in cui si trova questo script.
 # Questo rende il progetto portabile e indipendente dalla directory di lavoro corrente.
@@ -30,29 +33,50 @@ except NameError:
 
 # Imposta la directory di lavoro sulla radice del progetto per coerenza.
 os.chdir(PROJECT_ROOT)
+load_dotenv()
 # --- FINE BLOCCO UNIVERSALE ---
 
 import time
 import json
 import logging
 import subprocess
-import socket
 import threading
 from datetime import datetime
 from filelock import FileLock, Timeout
 from colorama import init, Fore, Style
 
+from QueueController import write_now_playing, clear_now_playing, record_sample
+from MpvIPC import MpvClient
+from MpvDecks import MpvDeck, crossfade
+from PlayerWake import WakeListener
+from SongMeta import gain_factor
+from PlaylistQueue import PriorityPlaylist
+
 # --- INIZIALIZZAZIONE GLOBALE ---
 init(autoreset=True)
 
 # --- CONFIGURAZIONE CON PERCORSI PORTABILI ---
 PLAYER_VOLUME = 80
+MPV_MAX_VOLUME = 130 # Oltre 100 mpv amplifica (--volume-max predefinito)
 CROSSFADE_SECONDS = 8
+# "decks": due mpv sempre accesi, canzoni caricate con loadfile e crossfade prima della fine;
+# "process": un nuovo mpv per ogni canzone, come in origine;
+# "mix": decodifica con ffmpeg e crossfade in Python verso MIX_SINK (MixEngine.py)
+PLAYER_BACKEND = os.getenv("PLAYER_BACKEND", "decks").strip().lower()
+# Con la playlist vuota il player aspetta la sveglia del Producer (PlayerWake.py);
+# la coda viene comunque ricontrollata ogni tanti secondi
+PLAYER_IDLE_POLL_SECONDS = 10
+# Tentativi di precaricamento di una stessa canzone prima di scartarla
+PRELOAD_MAX_FAILURES = 3
+MIX_SINK = os.getenv("MIX_SINK", "device").strip()
+# Backend "mix": un `.part` che non cresce da tanti secondi è un download fallito, non lento
+MIX_PARTIAL_STALL_SECONDS = float(os.getenv("MIX_PARTIAL_STALL_SECONDS", "60"))
 # Le directory temporanee e i file di lock sono ora relativi a PROJECT_ROOT.
 TMP_DIR = PROJECT_ROOT / ".tmp_player"
 PLAYLIST_FILE = TMP_DIR / "playlist.queue"
 PLAYER_LOCK_FILE = TMP_DIR / "player_instance.lock"
 PLAYLIST_LOCK_FILE = TMP_DIR / "playlist.queue.lock"
+RESERVE_FILE = TMP_DIR / "reserve.queue"
 MPV_SOCKET_MAIN = TMP_DIR / "main.sock"
 MPV_SOCKET_NEXT = TMP_DIR / "next.sock"
 
@@ -80,12 +104,23 @@ def get_timestamp():
 class DJPlayer:
     def __init__(self):
         self.current_process = None
+        self.current_ipc = None # Connessione IPC persistente all'mpv in riproduzione
+        self.current_volume = PLAYER_VOLUME
+        # Backend "decks": i due piatti e l'indice di quello in onda
+        self.decks = [MpvDeck("A", MPV_SOCKET_MAIN), MpvDeck("B", MPV_SOCKET_NEXT)]
+        self.active_deck = 0
+        self.preloaded = None # Canzone già caricata, in pausa, nel piatto libero
+        self.mix_engine = None # Backend "mix"
         self.monitor_thread = None
         self.stop_monitor_event = threading.Event()
         self.has_printed_empty_playlist_msg = False
         self._setup_environment()
-        print(f"{get_timestamp()} {Fore.CYAN}DJ Semplice (FIFO) con Stile Dashboard avviato.")
-        logging.info("DJ Semplice (FIFO) avviato.")
+        self.playlist = PriorityPlaylist()
+        with FileLock(PLAYLIST_LOCK_FILE):
+            self.playlist.load() # Canzoni prese in carico prima di un riavvio
+        self.wake = WakeListener()
+        print(f"{get_timestamp()} {Fore.CYAN}DJ (playlist a priorità) con Stile Dashboard avviato.")
+        logging.info("DJ (playlist a priorità) avviato.")
 
     def _setup_environment(self):
         """Prepara le directory e pulisce i socket residui."""
@@ -95,91 +130,173 @@ class DJPlayer:
         MPV_SOCKET_NEXT.unlink(missing_ok=True)
 
     @staticmethod
-    def _calculate_freshness(song_path: Path) -> str:
-        """Calcola la 'freschezza' di una canzone dal suo timestamp nel nome file."""
+    def _calculate_freshness(song_data: dict) -> str:
+        """
+        Calcola la 'freschezza' di una canzone dall'istante `created` della riga di playlist
+        (per le righe più vecchie, dal timestamp nel nome file).
+        """
         try:
-            parts = song_path.stem.split('_')
-            timestamp_str = f"{parts[0]}_{parts[1]}"
-            creation_time = datetime.strptime(timestamp_str, '%Y%m%d_%H%M%S')
-            delta_seconds = (datetime.now() - creation_time).total_seconds()
+            if song_data.get('created'):
+                delta_seconds = time.time() - song_data['created']
+            else:
+                parts = song_data['path'].stem.split('_')
+                timestamp_str = f"{parts[0]}_{parts[1]}"
+                creation_time = datetime.strptime(timestamp_str, '%Y%m%d_%H%M%S')
+                delta_seconds = (datetime.now() - creation_time).total_seconds()
             if delta_seconds < 60: return f"~{int(delta_seconds)}s"
             if delta_seconds < 3600: return f"~{round(delta_seconds / 60)}m"
             return f"~{round(delta_seconds / 3600, 1)}h"
         except (IndexError, ValueError):
             return "N/A"
 
-    def _get_next_song_from_queue(self) -> dict | None:
-        """Consuma la *prima* canzone dalla coda (FIFO) in modo sicuro."""
+    @staticmethod
+    def _pop_reserve_song() -> str | None:
+        """Preleva la traccia più recente dalla riserva (da chiamare col lock della playlist)."""
+        if not RESERVE_FILE.exists():
+            return None
+        reserve = [line for line in RESERVE_FILE.read_text(encoding="utf-8").splitlines() if line.strip()]
+        if not reserve:
+            return None
+        song_line = reserve.pop()
+        RESERVE_FILE.write_text("\n".join(reserve) + ("\n" if reserve else ""), encoding="utf-8")
+        return song_line
+
+    def _ingest_playlist(self):
+        """
+        Sposta le righe appena accodate dal Producer nella playlist a priorità (da chiamare
+        col lock della playlist). Ritorna True se la playlist del player è cambiata.
+        """
+        if not PLAYLIST_FILE.exists():
+            return False
+        lines = [line for line in PLAYLIST_FILE.read_text(encoding="utf-8").splitlines() if line.strip()]
+        if not lines:
+            return False
+        for line in lines:
+            try:
+                self.playlist.push(json.loads(line))
+            except (json.JSONDecodeError, AttributeError) as e:
+                print(f"{Fore.RED}Scartata riga non valida dalla playlist: {line}. Errore: {e}")
+                logging.error(f"Riga playlist non valida scartata: {e}")
+        PLAYLIST_FILE.write_text("", encoding="utf-8")
+        return True
+
+    @staticmethod
+    def _demote_to_reserve(expired: list[dict]):
+        """Le canzoni scadute vanno in testa alla riserva: saranno le ultime a essere ripescate."""
+        for song_data in expired:
+            print(f"{Fore.YELLOW}Canzone scaduta, spostata in riserva: {Path(song_data['path']).name} (Tavolo {song_data.get('table')})")
+            logging.info(f"Canzone scaduta spostata in riserva: {song_data['path']}")
+        reserve = RESERVE_FILE.read_text(encoding="utf-8").splitlines() if RESERVE_FILE.exists() else []
+        lines = [json.dumps(song_data) for song_data in expired] + [line for line in reserve if line.strip()]
+        RESERVE_FILE.write_text("\n".join(lines) + "\n", encoding="utf-8")
+
+    def _held_entries(self) -> list[dict]:
+        """La canzone precaricata, come riga di playlist: non è ancora in onda e va contata tra quelle in attesa."""
+        if self.preloaded is None or self.preloaded.get('from_reserve'):
+            return []
+        entry = {k: v for k, v in self.preloaded.items() if k not in ('source', 'woken_at')}
+        entry['path'] = str(entry['path'])
+        return [entry]
+
+    def _save_pending(self):
+        with FileLock(PLAYLIST_LOCK_FILE):
+            self.playlist.save(self._held_entries())
+
+    def _get_next_song_from_queue(self, block: bool = True, reserve: bool = True) -> dict | None:
+        """
+        Consuma in modo sicuro la canzone con la priorità più alta (PlaylistQueue.py): prima
+        la scadenza più vicina, senza far suonare due volte di fila lo stesso tavolo.
+        Se la coda è vuota e `reserve` è vero, pesca dalla riserva delle tracce extra.
+        Con `block=False` ritorna None invece di aspettare nuove canzoni.
+        """
         playlist_lock = FileLock(PLAYLIST_LOCK_FILE)
+        woken_at = None # Istante di pubblicazione dell'ultima sveglia ricevuta
         while True:
             try:
                 with playlist_lock.acquire(timeout=1):
-                    if not PLAYLIST_FILE.exists():
-                        lines = []
-                    else:
-                        lines = PLAYLIST_FILE.read_text(encoding="utf-8").splitlines()
-                        lines = [line for line in lines if line.strip()] # Pulisce righe vuote
-
-                    if not lines:
+                    changed = self._ingest_playlist()
+                    song_data, expired = self.playlist.pop()
+                    if expired:
+                        self._demote_to_reserve(expired)
+                    if song_data or expired or changed:
+                        self.playlist.save(self._held_entries()) # Il Producer conta anche queste canzoni
+                    if song_data is None and reserve:
+                        reserve_line = self._pop_reserve_song()
+                        try:
+                            song_data = json.loads(reserve_line) if reserve_line else None
+                        except json.JSONDecodeError as e:
+                            logging.error(f"Riga riserva non valida scartata: {e}")
+                            continue
+                        if song_data is not None:
+                            song_data['from_reserve'] = True # Niente scadenza: è già il ripiego
+                    if song_data is None:
+                        if not block:
+                            return None
                         if not self.has_printed_empty_playlist_msg:
                             print(f"{get_timestamp()} {EMPTY_COLOR}PLAYLIST VUOTA. In attesa di nuove canzoni...")
                             self.has_printed_empty_playlist_msg = True
                     else:
                         self.has_printed_empty_playlist_msg = False
-                        song_line_to_process = lines.pop(0) # Prendi e rimuovi la prima riga
-                        
-                        # Riscrive il file con le righe rimanenti
-                        PLAYLIST_FILE.write_text("\n".join(lines) + ("\n" if lines else ""), encoding="utf-8")
-                        
                         try:
-                            song_data = json.loads(song_line_to_process)
+                            song_data = dict(song_data)
                             # Converte la stringa del percorso in un oggetto Path
                             # Essendo un percorso assoluto, non serve risolverlo di nuovo.
                             song_data['path'] = Path(song_data['path'])
-                            if not song_data['path'].is_file():
+                            song_data['source'] = self._resolve_source(song_data)
+                            if not song_data['source']:
                                 print(f"{Fore.RED}File non trovato: {song_data['path']}. Scarto la canzone.")
                                 logging.warning(f"File canzone non trovato, scartato: {song_data['path']}")
                                 continue # Cerca la prossima canzone
+                            if woken_at:
+                                song_data['woken_at'] = woken_at
                             return song_data
-                        except (json.JSONDecodeError, KeyError) as e:
-                            print(f"{Fore.RED}Scartata riga non valida dalla playlist: {song_line_to_process}. Errore: {e}")
-                            logging.error(f"Riga playlist non valida scartata: {e}")
+                        except KeyError as e:
+                            print(f"{Fore.RED}Scartata canzone senza percorso: {song_data}. Errore: {e}")
+                            logging.error(f"Canzone senza percorso scartata: {e}")
+                            continue
             except Timeout:
-                pass # Se il lock è occupato, semplicemente riprova dopo una pausa
-            time.sleep(2)
+                if not block:
+                    return None
+                continue # Lock occupato: si riprova subito, l'attesa è già nel timeout del lock
+            woken_at = self.wake.wait(PLAYER_IDLE_POLL_SECONDS)
 
-    def _send_mpv_command(self, socket_path, command):
-        """Invia un comando JSON al socket IPC di mpv."""
-        if not socket_path.exists(): return False
-        try:
-            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
-                s.connect(str(socket_path))
-                s.sendall(json.dumps(command).encode('utf-8') + b'\n')
-            return True
-        except (ConnectionRefusedError, FileNotFoundError): return False
-
-    def _get_mpv_property(self, socket_path, prop):
-        """Ottiene una proprietà (es. 'duration') dal socket IPC di mpv."""
-        if not socket_path.exists(): return None
-        try:
-            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
-                s.settimeout(2.0) # Evita blocchi infiniti
-                s.connect(str(socket_path))
-                s.sendall(json.dumps({"command": ["get_property", prop]}).encode('utf-8') + b'\n')
-                response_data = s.recv(1024)
-                if not response_data: return None
-                response = json.loads(response_data.decode('utf-8'))
-            return response.get("data") if response.get("error") == "success" else None
-        except (json.JSONDecodeError, socket.timeout, ConnectionRefusedError, FileNotFoundError): return None
-
-    def _start_mpv_instance(self, song_path, volume, socket_path, table_number):
-        """Avvia una nuova istanza di mpv per una canzone."""
-        if not song_path.is_file(): return None
-        command = ["mpv", "--really-quiet", "--no-video", f"--volume={volume}", f"--input-ipc-server={socket_path}", str(song_path)]
+    @staticmethod
+    def _resolve_source(song_data: dict) -> str | None:
+        """
+        Sceglie cosa passare a mpv. Il file finale esiste solo a download completo;
+        le canzoni pubblicate in anticipo possono essere ancora un `.part` in crescita
+        (letto con `appending://`, che aspetta i nuovi byte) oppure un URL di streaming.
+        """
+        if song_data['path'].is_file():
+            return str(song_data['path'])
+        partial = song_data.get('partial')
+        if partial and Path(partial).is_file():
+            return f"appending://{partial}"
+        if song_data['path'].is_file(): # Rinominato proprio ora
+            return str(song_data['path'])
+        return song_data.get('url')
+
+    @staticmethod
+    def _song_volume(song_data: dict) -> int:
+        """Volume mpv con il guadagno di loudness calcolato al download (volume mpv cubico rispetto all'ampiezza)."""
+        return min(MPV_MAX_VOLUME, round(PLAYER_VOLUME * gain_factor(song_data) ** (1 / 3)))
+
+    def _start_mpv_instance(self, song_source, volume, socket_path, table_number):
+        """
+        Avvia una nuova istanza di mpv per una canzone (file locale o URL) e apre la sua
+        connessione IPC, che resta aperta per tutta la canzone. Ritorna (processo, client).
+        """
+        if not song_source: return None
+        command = ["mpv", "--really-quiet", "--no-video", f"--volume={volume}", f"--input-ipc-server={socket_path}", song_source]
         process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        time.sleep(1) # Attende che mpv si avvii e crei il socket
-        if process.poll() is not None: return None # Controlla se è crashato all'avvio
-        return process
+        ipc = MpvClient(socket_path)
+        if not ipc.connect(timeout=5) or process.poll() is not None: # Socket mai creato o mpv crashato all'avvio
+            ipc.close()
+            process.kill()
+            return None
+        for prop in ("time-pos", "duration", "eof-reached"):
+            ipc.observe_property(prop)
+        return process, ipc
 
     def _perform_crossfade(self, next_song_data):
         """Esegue un crossfade tra la canzone corrente e la successiva."""
@@ -190,34 +307,48 @@ class DJPlayer:
         self.stop_monitor_event.set()
         if self.monitor_thread and self.monitor_thread.is_alive(): self.monitor_thread.join()
         
-        next_process = self._start_mpv_instance(next_song_path, 0, MPV_SOCKET_NEXT, table_number)
-        if not next_process: return self.current_process # Se il nuovo player non parte, continua col vecchio
+        started = self._start_mpv_instance(next_song_data['source'], 0, MPV_SOCKET_NEXT, table_number)
+        next_target_volume = self._song_volume(next_song_data)
+        if not started: return self.current_process, self.current_ipc # Se il nuovo player non parte, continua col vecchio
+        next_process, next_ipc = started
         
-        steps, sleep_interval = 20, CROSSFADE_SECONDS / 20
+        # Passi su scadenze fisse: un passo in ritardo non sposta tutti quelli successivi
+        steps, step_seconds = 20, CROSSFADE_SECONDS / 20
+        fade_start, max_lateness = time.monotonic(), 0.0
         for i in range(steps + 1):
-            current_volume = int(PLAYER_VOLUME * (1 - (i / steps)))
-            next_volume = int(PLAYER_VOLUME * (i / steps))
-            self._send_mpv_command(MPV_SOCKET_MAIN, {"command": ["set_property", "volume", current_volume]})
-            self._send_mpv_command(MPV_SOCKET_NEXT, {"command": ["set_property", "volume", next_volume]})
-            time.sleep(sleep_interval)
+            delay = fade_start + i * step_seconds - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            max_lateness = max(max_lateness, -delay)
+            current_volume = int(self.current_volume * (1 - (i / steps)))
+            next_volume = int(next_target_volume * (i / steps))
+            if self.current_ipc: self.current_ipc.set_property("volume", current_volume)
+            next_ipc.set_property("volume", next_volume)
+        logging.info(f"Crossfade completato: {steps + 1} passi, ritardo massimo {max_lateness * 1000:.1f} ms")
             
         if self.current_process: self.current_process.kill()
+        if self.current_ipc: self.current_ipc.close()
         MPV_SOCKET_MAIN.unlink(missing_ok=True)
-        os.rename(MPV_SOCKET_NEXT, MPV_SOCKET_MAIN)
-        return next_process
+        os.rename(MPV_SOCKET_NEXT, MPV_SOCKET_MAIN) # La connessione già aperta resta valida
+        return next_process, next_ipc
 
-    def _monitor_playback(self, process, socket_path, song_data):
+    def _monitor_playback(self, process, ipc, song_data):
         """Monitora la riproduzione, stampa la barra di progresso e le informazioni."""
-        time.sleep(1)
-        duration = self._get_mpv_property(socket_path, "duration")
-        freshness = self._calculate_freshness(song_data['path'])
+        # Durata misurata al download (SongMeta.py); altrimenti time-pos e duration arrivano
+        # da observe_property: nessuna richiesta a mpv nel ciclo
+        duration = song_data.get('duration') or ipc.wait_for_property("duration", timeout=5)
+        freshness = self._calculate_freshness(song_data)
         
         durata_str = f"| {int(duration)//60:02d}:{int(duration)%60:02d}" if duration else ""
+        if duration:
+            # Il Producer usa questi dati per decidere quando avviare la prossima generazione
+            write_now_playing(str(song_data['path']), duration, ipc.properties.get("time-pos") or 0)
+            record_sample("song", duration)
         print(f"{get_timestamp()} {TAVOLO_COLOR}TAVOLO-{song_data['table']} > PLAY: {song_data['path'].name} {durata_str} | {FRESHNESS_COLOR}FRESH: {freshness}")
         print(f"{STYLE_COLOR}Stile: {song_data.get('style', 'N/A')}")
         
         while not self.stop_monitor_event.is_set() and process.poll() is None:
-            pos = self._get_mpv_property(socket_path, "time-pos")
+            pos = ipc.properties.get("time-pos")
             if pos is not None and duration is not None and duration > 0:
                 percent = int((pos / duration) * 100)
                 bar_len = 30
@@ -227,9 +358,10 @@ class DJPlayer:
                 dur_m, dur_s = divmod(int(duration), 60)
                 sys.stdout.write(f"\r{Fore.GREEN}PLAYING: |{bar}| {percent}% | Tavolo #{song_data.get('table', 'N/A')} | ({pos_m:02d}:{pos_s:02d} / {dur_m:02d}:{dur_s:02d})")
                 sys.stdout.flush()
-            time.sleep(1)
+            self.stop_monitor_event.wait(1)
         
         sys.stdout.write("\r" + " " * 120 + "\r") # Pulisce la riga
+        clear_now_playing()
         print(f"{get_timestamp()} {Fore.GREEN}FINISHED! Looking for next song...")
         print(f"{STYLE_COLOR}{SEPARATOR}{Style.RESET_ALL}\n")
         logging.info("Riproduzione terminata.")
@@ -237,39 +369,276 @@ class DJPlayer:
     def run(self):
         """Ciclo principale del player."""
         try:
-            while True:
-                song_data = self._get_next_song_from_queue()
-                if not song_data: continue # Torna a controllare la coda
-                
-                is_playing = self.current_process and self.current_process.poll() is None
-                if is_playing:
-                    new_process = self._perform_crossfade(song_data)
-                else:
-                    new_process = self._start_mpv_instance(song_data['path'], PLAYER_VOLUME, MPV_SOCKET_MAIN, song_data['table'])
-                
-                if not new_process:
-                    self.current_process = None
-                    logging.error(f"Impossibile avviare la riproduzione per {song_data['path']}")
-                    time.sleep(5)
-                    continue
-
-                self.current_process = new_process
-                self.stop_monitor_event.clear()
-                self.monitor_thread = threading.Thread(target=self._monitor_playback, args=(self.current_process, MPV_SOCKET_MAIN, song_data), daemon=True)
-                self.monitor_thread.start()
-                
-                self.current_process.wait() # Attende la fine del processo mpv
-                self.stop_monitor_event.set()
-                if self.monitor_thread and self.monitor_thread.is_alive():
-                    self.monitor_thread.join()
+            if PLAYER_BACKEND == "decks":
+                self._run_decks()
+            elif PLAYER_BACKEND == "mix":
+                self._run_mix()
+            else:
+                self._run_processes()
         finally:
             self.cleanup()
+
+    @staticmethod
+    def _log_wake_latency(song_data):
+        """Per le canzoni arrivate a playlist vuota: tempo dalla pubblicazione all'inizio della riproduzione."""
+        if 'woken_at' in song_data:
+            logging.info(f"'{song_data['path'].name}' in riproduzione {(time.time() - song_data['woken_at']) * 1000:.0f} ms dopo la pubblicazione")
+
+    def _start_monitor(self, process, ipc, song_data):
+        self.stop_monitor_event.clear()
+        self.monitor_thread = threading.Thread(target=self._monitor_playback, args=(process, ipc, song_data), daemon=True)
+        self.monitor_thread.start()
+
+    def _stop_monitor(self):
+        self.stop_monitor_event.set()
+        if self.monitor_thread and self.monitor_thread.is_alive():
+            self.monitor_thread.join()
+
+    def _preload_next(self, reserve: bool = False):
+        """
+        Appena c'è una canzone in playlist la carica, in pausa e a volume zero, nel piatto libero:
+        file aperto e decoder avviato prima del crossfade, che diventa solo volume e play.
+        La riserva si usa solo al momento del cambio (`reserve`), così una canzone pubblicata
+        nel frattempo non resta dietro una traccia di ripiego.
+        """
+        if self.preloaded is not None:
+            return
+        next_song_data = self._get_next_song_from_queue(block=False, reserve=reserve)
+        if not next_song_data:
+            return
+        deck = self.decks[1 - self.active_deck]
+        load_seconds = deck.load(next_song_data['source'], 0, paused=True)
+        if load_seconds is None:
+            logging.error(f"Precaricamento fallito per {next_song_data['path']}")
+            self._requeue(next_song_data)
+            return
+        self.preloaded = next_song_data
+        self._save_pending()
+        logging.info(f"Precaricata '{next_song_data['path'].name}' sul piatto {deck.name} in {load_seconds * 1000:.0f} ms")
+
+    def _requeue(self, song_data: dict):
+        """
+        Una canzone presa dalla coda ma non precaricata torna da dove veniva (il guasto può essere
+        passeggero). Dopo PRELOAD_MAX_FAILURES tentativi falliti si scarta.
+        """
+        entry = {k: v for k, v in song_data.items() if k not in ('source', 'woken_at', 'from_reserve')}
+        entry['path'] = str(entry['path'])
+        entry['load_failures'] = entry.get('load_failures', 0) + 1
+        if entry['load_failures'] >= PRELOAD_MAX_FAILURES:
+            print(f"{Fore.RED}Impossibile precaricare {song_data['path'].name}. Scarto la canzone.")
+            logging.error(f"Canzone scartata dopo {entry['load_failures']} precaricamenti falliti: {song_data['path']}")
+            return
+        with FileLock(PLAYLIST_LOCK_FILE):
+            if song_data.get('from_reserve'):
+                with open(RESERVE_FILE, "a", encoding="utf-8") as f: # In coda: è la prossima a essere ripescata
+                    f.write(json.dumps(entry) + "\n")
+            else:
+                self.playlist.push(entry)
+                self.playlist.save(self._held_entries())
+
+    def _expire_preloaded(self):
+        """Al cambio la canzone precaricata potrebbe essere scaduta: in quel caso torna in riserva."""
+        song_data = self.preloaded
+        if song_data is None or song_data.get('from_reserve') or song_data.get('deadline', time.time()) >= time.time():
+            return
+        with FileLock(PLAYLIST_LOCK_FILE):
+            self._demote_to_reserve(self._held_entries())
+            self.preloaded = None
+            self.playlist.save()
+        self.decks[1 - self.active_deck].stop()
+
+    def _take_preloaded(self) -> dict:
+        """La canzone precaricata va in onda: non è più tra quelle in attesa."""
+        song_data, self.preloaded = self.preloaded, None
+        self._save_pending()
+        return song_data
+
+    def _wait_for_crossfade_point(self, deck: MpvDeck, song_data: dict) -> bool:
+        """
+        Lascia suonare il piatto, precaricando intanto la prossima canzone. True quando mancano
+        CROSSFADE_SECONDS alla fine e c'è una canzone pronta, False se la corrente è finita prima.
+        """
+        while not deck.ended.wait(0.5):
+            if not deck.alive():
+                return False
+            remaining = deck.remaining(song_data.get('duration'))
+            at_crossfade_point = remaining is not None and remaining <= CROSSFADE_SECONDS
+            if at_crossfade_point:
+                self._expire_preloaded()
+            self._preload_next(reserve=at_crossfade_point)
+            if self.preloaded and at_crossfade_point:
+                return True
+        return False
+
+    def _crossfade_decks(self, song_data: dict) -> bool:
+        """Sfuma dalla canzone corrente verso quella già caricata (in pausa) nel piatto libero."""
+        out_deck, in_deck = self.decks[self.active_deck], self.decks[1 - self.active_deck]
+        if not in_deck.alive():
+            return False
+        next_song_data = self.preloaded
+        print(f"\n{get_timestamp()} {Fore.BLUE}CROSSFADE... Verso '{next_song_data['path'].name}' (Tavolo {next_song_data['table']})")
+        fade_requested = time.monotonic()
+        in_deck.play()
+        lateness = crossfade(out_deck, in_deck, CROSSFADE_SECONDS,
+                             self._song_volume(song_data), self._song_volume(next_song_data))
+        out_deck.stop()
+        self.active_deck = 1 - self.active_deck
+        logging.info(f"Crossfade {out_deck.name} -> {in_deck.name}: durata {time.monotonic() - fade_requested:.2f}s, "
+                     f"ritardo massimo di un passo {lateness * 1000:.1f} ms")
+        return True
+
+    def _run_decks(self):
+        """Backend a due piatti: nessun processo avviato o ucciso tra una canzone e l'altra."""
+        for deck in self.decks:
+            if not deck.start():
+                raise RuntimeError(f"impossibile avviare mpv per il piatto {deck.name}")
+        song_data = None
+        while True:
+            deck = self.decks[self.active_deck]
+            if song_data is None:
+                next_deck = self.decks[1 - self.active_deck]
+                self._expire_preloaded()
+                if self.preloaded and next_deck.alive():
+                    # La canzone corrente è finita prima del crossfade: parte subito quella precaricata
+                    song_data = self._take_preloaded()
+                    self.active_deck = 1 - self.active_deck
+                    deck = next_deck
+                    deck.ipc.set_property("volume", self._song_volume(song_data))
+                    deck.play()
+                else:
+                    if self.preloaded: # Piatto libero morto: la canzone torna in coda
+                        with FileLock(PLAYLIST_LOCK_FILE):
+                            for entry in self._held_entries():
+                                self.playlist.push(entry)
+                        self.preloaded = None
+                    song_data = self._get_next_song_from_queue()
+                    if not song_data: continue
+                    if deck.load(song_data['source'], self._song_volume(song_data)) is None:
+                        logging.error(f"Impossibile avviare la riproduzione per {song_data['path']}")
+                        song_data = None
+                        continue
+                    self._log_wake_latency(song_data)
+
+            self._start_monitor(deck.process, deck.ipc, song_data)
+            fade = self._wait_for_crossfade_point(deck, song_data)
+            self._stop_monitor()
+            if fade and self._crossfade_decks(song_data):
+                song_data = self._take_preloaded()
+            else:
+                if fade: # Il piatto libero non risponde: si lascia finire la canzone corrente
+                    while deck.alive() and not deck.ended.wait(0.5):
+                        pass
+                song_data = None
+
+    def _next_mix_track(self, block: bool):
+        """
+        Fornitore di canzoni per MixEngine: (dati della canzone, sorgente decodificata).
+        ffmpeg si ferma alla fine attuale di un `.part` in crescita, quindi una canzone
+        anticipata senza URL di streaming resta da parte (in `preloaded`, contata tra quelle
+        in attesa) finché il download non è completo. Senza attesa (`block=False`, durante
+        la musica) si ritorna None; con attesa si aspetta il file finale. Se il `.part` non
+        cresce da MIX_PARTIAL_STALL_SECONDS il download è fallito e la canzone si scarta.
+        """
+        from MixEngine import decode_file
+        while True:
+            song_data = self.preloaded or self._get_next_song_from_queue(block=block)
+            if song_data is None:
+                return None
+            source = self._resolve_source(song_data)
+            if source and source.startswith("appending://") and song_data.get('url'):
+                source = song_data['url']
+            if source and not source.startswith("appending://"):
+                break
+            if not source or self._partial_stalled(song_data): # Il download è fallito
+                print(f"{Fore.RED}Download non completato: {song_data['path'].name}. Scarto la canzone.")
+                logging.warning(f"Download non completato, canzone scartata: {song_data['path']}")
+                if self.preloaded is not None:
+                    self._take_preloaded()
+                continue
+            if self.preloaded is None:
+                self.preloaded = song_data
+                self._save_pending()
+            if not block:
+                return None
+            time.sleep(0.5)
+        if self.preloaded is not None:
+            self._take_preloaded()
+        gain = gain_factor(song_data)
+        return song_data, (chunk * gain for chunk in decode_file(source))
+
+    @staticmethod
+    def _partial_stalled(song_data: dict) -> bool:
+        """Il `.part` di una canzone anticipata non viene più scritto (Downloader lo lascia per riprendere)."""
+        try:
+            return time.time() - Path(song_data['partial']).stat().st_mtime > MIX_PARTIAL_STALL_SECONDS
+        except (KeyError, TypeError, FileNotFoundError):
+            return False
+
+    def _on_mix_track_start(self, song_data):
+        duration = song_data.get('duration') # Misurata al download (SongMeta.py)
+        durata_str = ""
+        if duration:
+            # Come _monitor_playback: il Producer pianifica la coda su questi dati
+            write_now_playing(str(song_data['path']), duration, 0)
+            record_sample("song", duration)
+            durata_str = f"| {int(duration)//60:02d}:{int(duration)%60:02d} "
+        else:
+            clear_now_playing() # Durata ignota: meglio nessuna stima che quella della canzone precedente
+        print(f"\n{get_timestamp()} {TAVOLO_COLOR}TAVOLO-{song_data['table']} > PLAY: {song_data['path'].name} {durata_str}| "
+              f"{FRESHNESS_COLOR}FRESH: {self._calculate_freshness(song_data)}")
+        print(f"{STYLE_COLOR}Stile: {song_data.get('style', 'N/A')}")
+        self._log_wake_latency(song_data)
+        logging.info(f"MixEngine: {self.mix_engine.stats()}")
+
+    def _run_mix(self):
+        """Backend senza mpv: il mixaggio e l'uscita audio sono in MixEngine.py (import qui: serve NumPy)."""
+        from MixEngine import MixEngine, make_sink
+        sink = make_sink(MIX_SINK, realtime=True)
+        self.mix_engine = MixEngine(sink, CROSSFADE_SECONDS, gain=PLAYER_VOLUME / 100)
+        self.mix_engine.on_track_start = self._on_mix_track_start
+        self.mix_engine.on_track_end = clear_now_playing
+        try:
+            self.mix_engine.run(self._next_mix_track)
+        finally:
+            clear_now_playing()
+            sink.close()
+            logging.info(f"MixEngine: {self.mix_engine.stats()}")
+
+    def _run_processes(self):
+        """Backend originale: un processo mpv per canzone."""
+        while True:
+            song_data = self._get_next_song_from_queue()
+            if not song_data: continue # Torna a controllare la coda
+            
+            is_playing = self.current_process and self.current_process.poll() is None
+            if is_playing:
+                started = self._perform_crossfade(song_data)
+            else:
+                started = self._start_mpv_instance(song_data['source'], self._song_volume(song_data), MPV_SOCKET_MAIN, song_data['table'])
+            
+            if not started or not started[0]:
+                self.current_process = self.current_ipc = None
+                logging.error(f"Impossibile avviare la riproduzione per {song_data['path']}")
+                time.sleep(5)
+                continue
+
+            self.current_process, self.current_ipc = started
+            self.current_volume = self._song_volume(song_data)
+            self._log_wake_latency(song_data)
+            self._start_monitor(self.current_process, self.current_ipc, song_data)
+            self.current_process.wait() # Attende la fine del processo mpv
+            self._stop_monitor()
     
     def cleanup(self):
         """Esegue la pulizia finale alla terminazione."""
         print(f"\n{get_timestamp()} {Fore.BLUE}Eseguo pulizia finale...")
         if self.current_process and self.current_process.poll() is None:
             self.current_process.kill()
+        if self.current_ipc:
+            self.current_ipc.close()
+        for deck in self.decks:
+            deck.shutdown()
+        self.wake.close()
         # Comando più robusto per terminare tutte le istanze di mpv legate al progetto
         subprocess.run(["pkill", "-f", f"mpv.*{TMP_DIR.name}"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
         print(f"{get_timestamp()} {Fore.GREEN}Pulizia completata.")
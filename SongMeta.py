@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# ____    _    ____   ____    _    ____  ____
+#| __ )  / \  |  _ \ | __ )  / \  |  _ \|  _ \
+#|  _ \ / _ \ | |_) ||  _ \ / _ \ | |_) | | | |
+#| |_) / ___ \|  _ < | |_) / ___ \|  _ <| |_| |
+#|____/_/   \_\_| \_\|____/_/   \_\_| \_\____/
+
+"""
+SongMeta.py: Analisi di una canzone subito dopo il download, una volta sola.
+Un unico passaggio di ffmpeg misura la loudness integrata (EBU R128) e produce un
+segnale mono a bassa frequenza da cui si ricavano durata e picchi della forma d'onda.
+Il risultato va nel file `<canzone>.meta.json` e nella riga della playlist: il player
+conosce durata e guadagno prima di avviare la canzone, senza chiederli a mpv.
+
+    python SongMeta.py SONGS/canzone.mp3     (analizza e scrive il .meta.json)
+"""
+
+import os
+import re
+import sys
+import json
+import array
+import subprocess
+from pathlib import Path
+from typing import Optional
+
+# --- CONFIGURAZIONE ---
+# Loudness di riferimento: il guadagno porta ogni canzone a questo livello
+SONG_TARGET_LUFS = float(os.getenv("SONG_TARGET_LUFS", "-14"))
+# Tetto del guadagno in entrambe le direzioni (una canzone quasi muta non va amplificata all'infinito)
+SONG_MAX_GAIN_DB = float(os.getenv("SONG_MAX_GAIN_DB", "12"))
+SONG_PEAKS = 64 # Valori della forma d'onda compatta (0-100)
+ANALYSIS_RATE = 8000 # Hz del segnale mono usato per durata e picchi
+ANALYSIS_TIMEOUT = 60
+
+_LOUDNESS_RE = re.compile(r"Integrated loudness:\s*I:\s*(-?[\d.]+|-inf)\s*LUFS", re.S)
+
+
+def meta_path(song_path: Path) -> Path:
+    return Path(song_path).with_suffix(".meta.json")
+
+
+def analyse_song(song_path: Path) -> Optional[dict]:
+    """
+    Ritorna {duration, loudness, gain_db, peaks} oppure None se ffmpeg manca o il file non si
+    decodifica (la canzone resta suonabile: il player ricade sulle richieste a mpv).
+    """
+    command = ["ffmpeg", "-v", "info", "-nostats", "-nostdin", "-i", str(song_path),
+               "-filter_complex", f"[0:a]ebur128=framelog=verbose,aresample={ANALYSIS_RATE},"
+                                  "aformat=sample_fmts=flt:channel_layouts=mono",
+               "-f", "f32le", "-"]
+    try:
+        result = subprocess.run(command, capture_output=True, timeout=ANALYSIS_TIMEOUT)
+    except (FileNotFoundError, subprocess.TimeoutExpired):
+        return None
+    if result.returncode != 0:
+        return None
+    samples = array.array("f")
+    samples.frombytes(result.stdout[:len(result.stdout) - len(result.stdout) % samples.itemsize])
+    if not samples:
+        return None
+
+    match = _LOUDNESS_RE.search(result.stderr.decode("utf-8", errors="replace"))
+    loudness = float(match.group(1)) if match and match.group(1) != "-inf" else None
+    gain_db = 0.0
+    if loudness is not None:
+        gain_db = max(-SONG_MAX_GAIN_DB, min(SONG_MAX_GAIN_DB, SONG_TARGET_LUFS - loudness))
+
+    bucket = -(-len(samples) // SONG_PEAKS) # Arrotondato per eccesso: al massimo SONG_PEAKS valori
+    peaks = []
+    for start in range(0, len(samples), bucket):
+        chunk = samples[start:start + bucket]
+        peaks.append(min(100, round(max(max(chunk), -min(chunk)) * 100)))
+
+    return {
+        "duration": round(len(samples) / ANALYSIS_RATE, 2),
+        "loudness": loudness,
+        "gain_db": round(gain_db, 1),
+        "peaks": peaks,
+    }
+
+
+def write_meta(song_path: Path, meta: dict):
+    path = meta_path(song_path)
+    tmp_file = path.with_suffix(".tmp")
+    tmp_file.write_text(json.dumps(meta), encoding="utf-8")
+    os.replace(tmp_file, path)
+
+
+def read_meta(song_path: Path) -> Optional[dict]:
+    try:
+        return json.loads(meta_path(song_path).read_text(encoding="utf-8"))
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def gain_factor(song_data: dict) -> float:
+    """Guadagno lineare (ampiezza) dalla riga della playlist; 1.0 per le canzoni non analizzate."""
+    return 10 ** ((song_data.get("gain_db") or 0.0) / 20)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print(__doc__)
+        sys.exit(1)
+    meta = analyse_song(Path(sys.argv[1]))
+    if meta is None:
+        print("Analisi fallita (ffmpeg assente o file non decodificabile).")
+        sys.exit(1)
+    write_meta(Path(sys.argv[1]), meta)
+    print(f"Durata {meta['duration']}s, loudness {meta['loudness']} LUFS, guadagno {meta['gain_db']:+.1f} dB")
+    print("Picchi: " + "".join(" ▁▂▃▄▅▆▇█"[min(8, p * 9 // 100)] for p in meta["peaks"]))
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# ____    _    ____   ____    _    ____  ____
+#| __ )  / \  |  _ \ | __ )  / \  |  _ \|  _ \
+#|  _ \ / _ \ | |_) ||  _ \ / _ \ | |_) | | | |
+#| |_) / ___ \|  _ < | |_) / ___ \|  _ <| |_| |
+#|____/_/   \_\_| \_\|____/_/   \_\_| \_\____/
+
+"""
+TableScheduler.py: Sceglie quale tavolo servire per primo.
+Al posto del conteggio cumulativo delle creazioni usa:
+  - un servizio recente con decadimento esponenziale (un vantaggio preso a inizio
+    serata si esaurisce in poche mezz'ore invece di pesare per tutta la notte);
+  - il margine rispetto all'obiettivo di latenza parlato -> canzone del tavolo,
+    calcolato dall'età della trascrizione più vecchia in attesa e dalla latenza
+    prevista di una generazione.
+Priorità più bassa = servito prima.
+Registra attese e latenze per tavolo: python TableScheduler.py
+"""
+
+import os
+import json
+import math
+import time
+from pathlib import Path
+from typing import Optional
+
+from filelock import FileLock, Timeout
+
+from KieLatency import percentile
+from QueueController import generation_latency
+
+try:
+    PROJECT_ROOT = Path(__file__).parent.resolve()
+except NameError:
+    PROJECT_ROOT = Path('.').resolve()
+
+# --- CONFIGURAZIONE ---
+TMP_DIR = PROJECT_ROOT / ".tmp_player"
+SCHEDULER_STATE_FILE = TMP_DIR / "scheduler_state.json"
+SCHEDULER_LOCK_FILE = TMP_DIR / "scheduler_state.json.lock"
+
+# Obiettivo di latenza parlato -> canzone; per un singolo tavolo: SPEECH_TO_SONG_SLO_SECONDS_<tavolo>
+SPEECH_TO_SONG_SLO_SECONDS = float(os.getenv("SPEECH_TO_SONG_SLO_SECONDS", "600"))
+# Dopo quanti minuti una canzone servita pesa la metà
+SCHEDULER_HALF_LIFE_MINUTES = float(os.getenv("SCHEDULER_HALF_LIFE_MINUTES", "30"))
+# Quante canzoni di servizio recente vale un intero SLO di margine
+SCHEDULER_SLACK_WEIGHT = float(os.getenv("SCHEDULER_SLACK_WEIGHT", "1"))
+SCHEDULER_MAX_SAMPLES = 200
+# Lo stato si riscrive al massimo ogni tanti secondi (e all'uscita), non a ogni canzone
+SCHEDULER_SAVE_INTERVAL = float(os.getenv("SCHEDULER_SAVE_INTERVAL", "30"))
+# Per quanti secondi si riusa la latenza prevista invece di rileggere queue_stats.json
+SCHEDULER_LATENCY_TTL = 10
+
+
+def table_slo(table: str) -> float:
+    return float(os.getenv(f"SPEECH_TO_SONG_SLO_SECONDS_{table}", SPEECH_TO_SONG_SLO_SECONDS))
+
+
+def transcript_stats(directory: Path) -> Optional[dict]:
+    """Trascrizioni in attesa in una cartella: numero, prima e ultima data di modifica, byte totali."""
+    times, size = [], 0
+    for path in directory.glob("*.txt"):
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            continue
+        times.append(stat.st_mtime)
+        size += stat.st_size
+    if not times:
+        return None
+    return {"count": len(times), "oldest": min(times), "newest": max(times), "bytes": size}
+
+
+def oldest_transcript_time(directory: Path) -> Optional[float]:
+    """Data di modifica della trascrizione più vecchia in una cartella (None se vuota)."""
+    stats = transcript_stats(directory)
+    return stats["oldest"] if stats else None
+
+
+class TableScheduler:
+    """
+    Stato in `.tmp_player/scheduler_state.json`:
+      service: tavolo -> [servizio decaduto, istante dell'ultimo aggiornamento]
+      waits:   tavolo -> attese (s) dalla trascrizione più vecchia all'avvio del job
+      latency: tavolo -> latenze (s) dalla trascrizione più vecchia alla canzone pronta
+    """
+
+    def __init__(self):
+        self.state = self._load()
+        self.dirty = False
+        self.saved_at = time.monotonic()
+        self.latency_cache: Optional[tuple[float, float]] = None # (latenza, istante della lettura)
+
+    def _load(self) -> dict:
+        try:
+            state = json.loads(SCHEDULER_STATE_FILE.read_text(encoding="utf-8"))
+        except (FileNotFoundError, json.JSONDecodeError):
+            state = {}
+        for key in ("service", "waits", "latency"):
+            state.setdefault(key, {})
+        return state
+
+    def flush(self, force: bool = False):
+        """Salva lo stato se modificato e se è passato SCHEDULER_SAVE_INTERVAL (subito con `force`)."""
+        if not self.dirty or (not force and time.monotonic() - self.saved_at < SCHEDULER_SAVE_INTERVAL):
+            return
+        TMP_DIR.mkdir(exist_ok=True)
+        try:
+            with FileLock(SCHEDULER_LOCK_FILE, timeout=2):
+                tmp_file = SCHEDULER_STATE_FILE.with_suffix(".tmp")
+                tmp_file.write_text(json.dumps(self.state), encoding="utf-8")
+                os.replace(tmp_file, SCHEDULER_STATE_FILE)
+            self.dirty = False
+            self.saved_at = time.monotonic()
+        except Timeout:
+            pass # Si riscrive al prossimo giro
+
+    def service(self, table: str, now: float) -> float:
+        """Servizio recente del tavolo, decaduto fino a `now`."""
+        value, updated = self.state["service"].get(table, (0.0, now))
+        half_life = SCHEDULER_HALF_LIFE_MINUTES * 60
+        return value * math.pow(0.5, (now - updated) / half_life) if half_life > 0 else value
+
+    def priority(self, table: str, oldest: float, now: float, latency: float) -> float:
+        """Servizio recente + margine normalizzato sullo SLO (negativo se lo SLO è già a rischio)."""
+        slo = table_slo(table)
+        slack = slo - (now - oldest) - latency
+        return self.service(table, now) + SCHEDULER_SLACK_WEIGHT * slack / slo
+
+    def latency(self) -> float:
+        """Latenza prevista di una generazione, riletta da disco al massimo ogni SCHEDULER_LATENCY_TTL."""
+        if self.latency_cache is None or time.monotonic() - self.latency_cache[1] >= SCHEDULER_LATENCY_TTL:
+            self.latency_cache = (generation_latency(), time.monotonic())
+        return self.latency_cache[0]
+
+    def pick(self, ready: dict[str, float], now: Optional[float] = None) -> Optional[str]:
+        """Il tavolo più urgente tra quelli con lavoro pronto (tavolo -> trascrizione più vecchia)."""
+        if not ready:
+            return None
+        now = time.time() if now is None else now
+        latency = self.latency()
+        return min(ready, key=lambda table: (self.priority(table, ready[table], now, latency), table))
+
+    def _append(self, key: str, table: str, value: float):
+        values = self.state[key].setdefault(table, [])
+        values.append(round(value, 1))
+        del values[:-SCHEDULER_MAX_SAMPLES]
+
+    def record_dispatch(self, table: str, oldest: float, now: Optional[float] = None):
+        """Un job del tavolo è partito: aumenta il servizio e registra l'attesa."""
+        now = time.time() if now is None else now
+        self.state["service"][table] = [self.service(table, now) + 1, now]
+        self._append("waits", table, now - oldest)
+        self.dirty = True
+        self.flush()
+
+    def record_completion(self, table: str, oldest: float, now: Optional[float] = None):
+        """Canzone pronta: registra la latenza parlato -> canzone."""
+        now = time.time() if now is None else now
+        self._append("latency", table, now - oldest)
+        self.dirty = True
+        self.flush()
+
+    def percentiles(self, key: str = "waits") -> dict[str, dict]:
+        """p50 / p90 per tavolo dell'attesa ("waits") o della latenza completa ("latency")."""
+        return {
+            table: {"n": len(values), "p50": percentile(values, 50), "p90": percentile(values, 90)}
+            for table, values in sorted(self.state[key].items()) if values
+        }
+
+
+if __name__ == "__main__":
+    scheduler = TableScheduler()
+    waits, latencies = scheduler.percentiles("waits"), scheduler.percentiles("latency")
+    print(f"{'tavolo':<8} {'servizio':>8} {'attesa p50':>11} {'p90':>6} {'latenza p50':>12} {'p90':>6} {'SLO':>6}")
+    for table in sorted(set(waits) | set(latencies) | set(scheduler.state["service"])):
+        w, l = waits.get(table, {}), latencies.get(table, {})
+        fmt = lambda v: f"{v:.0f}" if v is not None else "-"
+        print(f"{table:<8} {scheduler.service(table, time.time()):>8.2f} {fmt(w.get('p50')):>11} {fmt(w.get('p90')):>6} "
+              f"{fmt(l.get('p50')):>12} {fmt(l.get('p90')):>6} {table_slo(table):>6.0f}")
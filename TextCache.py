@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# ____    _    ____   ____    _    ____  ____
+#| __ )  / \  |  _ \ | __ )  / \  |  _ \|  _ \
+#|  _ \ / _ \ | |_) ||  _ \ / _ \ | |_) | | | |
+#| |_) / ___ \|  _ < | |_) / ___ \|  _ <| |_| |
+#|____/_/   \_\_| \_\|____/_/   \_\_| \_\____/
+
+"""
+TextCache.py: Cache su disco dei risultati testuali delle API (es. i riassunti
+delle singole trascrizioni), indicizzata per hash del contenuto e condivisa
+tra AudioWatchdog, Producer e GenerateSong.
+"""
+
+import os
+import json
+import time
+import hashlib
+from pathlib import Path
+from typing import Optional
+
+from filelock import FileLock, Timeout
+
+try:
+    PROJECT_ROOT = Path(__file__).parent.resolve()
+except NameError:
+    PROJECT_ROOT = Path('.').resolve()
+
+CACHE_DIR = PROJECT_ROOT / ".tmp_player" / "cache"
+
+
+def content_hash(*parts: str) -> str:
+    """Hash stabile di uno o più testi (modello, prompt, contenuto...)."""
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\x00")
+    return digest.hexdigest()
+
+
+class DiskCache:
+    """
+    Un file JSON per chiave dentro `.tmp_player/cache/<nome>`, con scritture atomiche.
+    Le voci più vecchie di `ttl_seconds` sono scadute; oltre `max_entries` si eliminano
+    quelle usate meno di recente (la data di modifica del file fa da orologio LRU).
+    Hit e miss sono contati in `metrics.json`, condiviso tra i processi.
+    """
+
+    def __init__(self, name: str, ttl_seconds: Optional[float] = None, max_entries: Optional[int] = None):
+        self.name = name
+        self.directory = CACHE_DIR / name
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.metrics_file = self.directory / "metrics.json"
+
+    def _path(self, key: str) -> Path:
+        return self.directory / f"{key}.json"
+
+    def entries(self) -> list[Path]:
+        return [p for p in self.directory.glob("*.json") if p != self.metrics_file]
+
+    def _count(self, metric: str):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        try:
+            with FileLock(str(self.metrics_file) + ".lock", timeout=2):
+                metrics = self.stats()
+                metrics[metric] = metrics.get(metric, 0) + 1
+                self.metrics_file.write_text(json.dumps(metrics), encoding="utf-8")
+        except Timeout:
+            pass # Le metriche non devono mai bloccare il chiamante
+
+    def stats(self) -> dict:
+        """Contatori hit / miss / expired / evicted accumulati finora."""
+        try:
+            return json.loads(self.metrics_file.read_text(encoding="utf-8"))
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def hit_rate(self) -> Optional[float]:
+        metrics = self.stats()
+        total = metrics.get("hit", 0) + metrics.get("miss", 0)
+        return metrics.get("hit", 0) / total if total else None
+
+    def get(self, key: str) -> Optional[dict]:
+        path = self._path(key)
+        try:
+            entry = json.loads(path.read_text(encoding="utf-8"))
+        except (FileNotFoundError, json.JSONDecodeError):
+            self._count("miss")
+            return None
+        if self.ttl_seconds is not None and time.time() - entry.get("cached_at", 0) > self.ttl_seconds:
+            path.unlink(missing_ok=True)
+            self._count("expired")
+            self._count("miss")
+            return None
+        try:
+            os.utime(path) # Segna la voce come usata di recente
+        except FileNotFoundError:
+            pass
+        self._count("hit")
+        return entry
+
+    def put(self, key: str, value: dict):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        tmp_path = self._path(key).with_suffix(f".{os.getpid()}.tmp")
+        tmp_path.write_text(json.dumps({**value, "cached_at": time.time()}, ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp_path, self._path(key))
+        self._evict()
+
+    def _evict(self):
+        if self.max_entries is None:
+            return
+        entries = self.entries()
+        if len(entries) <= self.max_entries:
+            return
+        def mtime(path: Path) -> float:
+            try:
+                return path.stat().st_mtime
+            except FileNotFoundError:
+                return 0.0
+        for path in sorted(entries, key=mtime)[:len(entries) - self.max_entries]:
+            path.unlink(missing_ok=True)
+            self._count("evicted")
+
+
+if __name__ == "__main__":
+    # Riepilogo delle cache: python TextCache.py
+    for cache_dir in sorted(CACHE_DIR.glob("*")) if CACHE_DIR.exists() else []:
+        cache = DiskCache(cache_dir.name)
+        rate = cache.hit_rate()
+        rate_str = f"{rate:.0%}" if rate is not None else "N/A"
+        print(f"{cache.name:<12} voci: {len(cache.entries()):<5} hit rate: {rate_str:<5} {cache.stats()}")
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# ____    _    ____   ____    _    ____  ____
+#| __ )  / \  |  _ \ | __ )  / \  |  _ \|  _ \
+#|  _ \ / _ \ | |_) ||  _ \ / _ \ | |_) | | | |
+#| |_) / ___ \|  _ < | |_) / ___ \|  _ <| |_| |
+#|____/_/   \_\_| \_\|____/_/   \_\_| \_\____/
+
+"""
+TranscriptSummaries.py: Riassunti incrementali delle singole trascrizioni.
+AudioWatchdog riassume ogni trascrizione appena la scrive, in background; al momento
+del job GenerateSong trova i riassunti già pronti in cache (per hash del contenuto)
+e li riduce entro un budget di token, senza rimandare l'intero batch al modello.
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from RateLimiter import call_with_retry
+from TextCache import DiskCache, content_hash
+
+# --- CONFIGURAZIONE (dal .env, già caricato dallo script chiamante) ---
+SUMMARY_MODEL = os.getenv("SUMMARY_MODEL", "gpt-3.5-turbo")
+SUMMARY_TEMPERATURE = float(os.getenv("TEMPERATURE_SUMMARY", "0.5"))
+SUMMARY_SYSTEM_PROMPT = os.getenv("SYSTEM_PROMPT", "Riassumi la conversazione seguente in modo conciso, catturandone l'argomento e l'umore.")
+# Lunghezza massima del riassunto di una singola trascrizione
+TRANSCRIPT_SUMMARY_MAX_TOKENS = int(os.getenv("TRANSCRIPT_SUMMARY_MAX_TOKENS", "300"))
+# Budget complessivo dei riassunti ridotti che arrivano al prompt delle lyrics
+SUMMARY_TOKEN_BUDGET = int(os.getenv("SUMMARY_TOKEN_BUDGET", "1500"))
+# Separatore con cui il Producer concatena le trascrizioni di un batch
+TRANSCRIPT_SEPARATOR = "\n---\n"
+
+SUMMARY_CACHE_TTL_HOURS = float(os.getenv("SUMMARY_CACHE_TTL_HOURS", "168"))
+SUMMARY_CACHE_MAX_ENTRIES = int(os.getenv("SUMMARY_CACHE_MAX_ENTRIES", "5000"))
+
+summary_cache = DiskCache("summaries", ttl_seconds=SUMMARY_CACHE_TTL_HOURS * 3600, max_entries=SUMMARY_CACHE_MAX_ENTRIES)
+
+
+def estimate_tokens(text: str) -> int:
+    """Stima grossolana dei token (circa 4 caratteri per token)."""
+    return len(text) // 4 + 1
+
+
+def summary_key(text: str) -> str:
+    """La chiave dipende anche da modello e prompt: cambiarli invalida la cache."""
+    return content_hash(SUMMARY_MODEL, SUMMARY_SYSTEM_PROMPT, str(TRANSCRIPT_SUMMARY_MAX_TOKENS), text.strip())
+
+
+def cached_summary(text: str) -> Optional[str]:
+    entry = summary_cache.get(summary_key(text))
+    return entry["summary"] if entry else None
+
+
+def summarize_transcript(client, text: str) -> str:
+    """Riassunto di una trascrizione: dalla cache se presente, altrimenti via OpenAI (e poi in cache)."""
+    summary = cached_summary(text)
+    if summary is not None:
+        return summary
+    response = call_with_retry(lambda: client.chat.completions.create(
+        model=SUMMARY_MODEL,
+        messages=[
+            {"role": "system", "content": SUMMARY_SYSTEM_PROMPT},
+            {"role": "user", "content": text}
+        ],
+        max_tokens=TRANSCRIPT_SUMMARY_MAX_TOKENS,
+        temperature=SUMMARY_TEMPERATURE
+    ), "openai", SUMMARY_MODEL)
+    summary = response.choices[0].message.content.strip()
+    summary_cache.put(summary_key(text), {"model": SUMMARY_MODEL, "summary": summary})
+    return summary
+
+
+def reduce_summaries(summaries: list[str], token_budget: int = SUMMARY_TOKEN_BUDGET) -> tuple[str, int]:
+    """
+    Unisce i riassunti (in ordine cronologico) entro il budget, tenendo i più recenti.
+    Ritorna (testo ridotto, numero di riassunti scartati).
+    """
+    kept, used = [], 0
+    for summary in reversed(summaries):
+        cost = estimate_tokens(summary)
+        if kept and used + cost > token_budget:
+            break
+        kept.append(summary)
+        used += cost
+    kept.reverse()
+    return "\n\n".join(kept), len(summaries) - len(kept)
+
+
+def summarize_batch(client, concatenated_text: str) -> tuple[str, int, int]:
+    """
+    Riassunto di un batch di trascrizioni concatenate dal Producer.
+    Solo quelle non ancora in cache vengono riassunte ora, in parallelo.
+    Ritorna (riassunto ridotto, riassunti trovati in cache, riassunti scartati dal budget).
+    """
+    transcripts = [t for t in concatenated_text.split(TRANSCRIPT_SEPARATOR) if t.strip()]
+    cached = [cached_summary(t) for t in transcripts]
+    hits = sum(summary is not None for summary in cached)
+    missing = [t for t, summary in zip(transcripts, cached) if summary is None]
+    if missing:
+        with ThreadPoolExecutor(max_workers=min(4, len(missing))) as executor:
+            fresh = iter(list(executor.map(lambda t: summarize_transcript(client, t), missing)))
+        cached = [summary if summary is not None else next(fresh) for summary in cached]
+    reduced, dropped = reduce_summaries(cached)
+    return reduced, hits, dropped
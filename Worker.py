@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# ____    _    ____   ____    _    ____  ____
+#| __ )  / \  |  _ \ | __ )  / \  |  _ \|  _ \
+#|  _ \ / _ \ | |_) ||  _ \ / _ \ | |_) | | | |
+#| |_) / ___ \|  _ < | |_) / ___ \|  _ <| |_| |
+#|____/_/   \_\_| \_\|____/_/   \_\_| \_\____/
+
+"""
+Worker.py: Esegue la fase di generazione per conto del broker (Broker.py), anche su
+un'altra macchina. Prende un job in prestito, lo passa al proprio GenerateSong (daemon
+o subprocess, secondo GENERATOR_MODE), rinnova il prestito con un heartbeat che porta
+con sé l'avanzamento (job.json) e inoltra al broker gli eventi e il risultato.
+
+Senza cartella SONGS condivisa con il Mac del player, WORKER_SEND_AUDIO=1 allega alle
+canzoni i file audio e i metadati (in base64): il Producer li salva nella sua SONGS.
+
+Avvio (anche più worker sulla stessa macchina):
+    python Worker.py [--broker HOST:PORTA] [--name NOME]
+Verifica locale di prestiti, heartbeat e riconsegna:
+    python Worker.py --selftest
+"""
+
+import os
+import sys
+import json
+import time
+import base64
+import shutil
+import socket
+import threading
+from pathlib import Path
+from typing import Callable
+
+# Producer imposta la cartella di lavoro e carica il .env prima dei moduli che lo leggono
+from Producer import GENERATOR_MODE, TMP_DIR, daemon_events, get_timestamp, subprocess_events
+from Broker import BROKER_HEARTBEAT_SECONDS, WORK_BROKER, BrokerClient, BrokerError
+from JobState import JOB_STATE_FILENAME, JobState
+
+from colorama import Fore, Style
+
+# --- CONFIGURAZIONE ---
+WORKER_JOBS_DIR = TMP_DIR / "worker_jobs"
+WORKER_SEND_AUDIO = os.getenv("WORKER_SEND_AUDIO", "0").strip().lower() in ("1", "true", "yes")
+WORKER_LEASE_WAIT = 20
+
+
+def local_generator_events(job_dir: Path, table: str, text: str, cancel: threading.Event = None):
+    """ Il generatore locale del worker: mai "broker", altrimenti il job tornerebbe in coda. """
+    if GENERATOR_MODE == "subprocess":
+        return subprocess_events(job_dir, table, text, cancel)
+    return daemon_events(job_dir, table, text, cancel)
+
+
+def attach_song_files(song_data: dict) -> dict:
+    """ Allega l'audio e i file di metadati con lo stesso nome (.style.txt, .lyrics.txt, ...). """
+    music_path = Path(song_data["path"])
+    files = {}
+    for path in sorted(music_path.parent.glob(f"{music_path.stem}.*")):
+        files[path.name] = base64.b64encode(path.read_bytes()).decode("ascii")
+    return {**song_data, "files": files}
+
+
+def read_job_state(job_dir: Path):
+    try:
+        return json.loads((job_dir / JOB_STATE_FILENAME).read_text(encoding="utf-8"))
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def heartbeat_loop(address: str, name: str, job_id: str, job_dir: Path, stop: threading.Event, lost: threading.Event):
+    """
+    Rinnova il prestito finché il job è in corso; con sé porta l'ultimo job.json. Un heartbeat
+    rifiutato imposta `lost`, che ferma subito il generatore (vedi kill_on_cancel in Producer.py).
+    """
+    client = BrokerClient(address) # Connessione propria: quella principale può essere occupata
+    while not stop.wait(BROKER_HEARTBEAT_SECONDS):
+        try:
+            if not client.call("heartbeat", id=job_id, worker=name, state=read_job_state(job_dir)).get("ok"):
+                lost.set()
+                break
+        except BrokerError:
+            continue # Broker momentaneamente giù: il prestito regge fino a BROKER_LEASE_SECONDS
+    client.close()
+
+
+def process_lease(client: BrokerClient, address: str, name: str, leased: dict,
+                  run_events: Callable = local_generator_events) -> bool:
+    """ Esegue un job preso in prestito e ne riporta eventi e risultato al broker. """
+    job = leased["job"]
+    job_dir = WORKER_JOBS_DIR / job["id"]
+    job_dir.mkdir(parents=True, exist_ok=True)
+    if leased.get("state"):
+        # Riconsegna: si riparte dall'avanzamento salvato dal worker precedente
+        JobState(job_dir).update(**leased["state"])
+
+    stop, lost = threading.Event(), threading.Event()
+    threading.Thread(target=heartbeat_loop, args=(address, name, job["id"], job_dir, stop, lost), daemon=True).start()
+    result = {"ok": False, "error": "nessun risultato dal generatore"}
+    events = run_events(job_dir, job["table"], job["text"], cancel=lost)
+    try:
+        for event in events:
+            if lost.is_set():
+                break # Job già riassegnato: inutile spendere altre chiamate API
+            kind = event.get("event")
+            if kind == "result":
+                result = event
+                continue
+            if kind == "stream":
+                continue
+            if kind == "song" and WORKER_SEND_AUDIO:
+                if event["data"].get("early"):
+                    continue # Il file anticipato è ancora in scrittura su questa macchina
+                event = {**event, "data": attach_song_files(event["data"])}
+            event.pop("id", None)
+            if not client.call("event", id=job["id"], worker=name, event=event).get("ok"):
+                lost.set()
+                break
+    except Exception as e:
+        result = {"ok": False, "error": f"errore nel worker {name}: {e}"}
+    finally:
+        stop.set()
+        events.close() # Ferma il generatore anche se interrotto a metà
+
+    if lost.is_set():
+        print(f"{Fore.YELLOW}{get_timestamp()} [{name}] Prestito perso per {job['id']}: il job è stato riassegnato.{Style.RESET_ALL}")
+        return False
+    client.call("complete", id=job["id"], worker=name, ok=bool(result.get("ok")), error=result.get("error"))
+    if result.get("ok"):
+        shutil.rmtree(job_dir, ignore_errors=True)
+    return bool(result.get("ok"))
+
+
+def work_loop(address: str, name: str, run_events: Callable = local_generator_events, stop: threading.Event = None):
+    """ Prende job dal broker uno alla volta, finché `stop` non viene impostato. """
+    client = BrokerClient(address)
+    stop = stop or threading.Event()
+    while not stop.is_set():
+        try:
+            leased = client.call("lease", worker=name, wait=WORKER_LEASE_WAIT)
+        except BrokerError as e:
+            print(f"{Fore.RED}{get_timestamp()} [{name}] {e}. Riprovo tra 5s.{Style.RESET_ALL}", file=sys.stderr)
+            stop.wait(5)
+            continue
+        if not leased.get("job"):
+            continue
+        job = leased["job"]
+        print(f"{Fore.CYAN}{get_timestamp()} [{name}] Job {job['id']} (tavolo {job['table']}, consegna {leased.get('attempt')}).{Style.RESET_ALL}")
+        try:
+            ok = process_lease(client, address, name, leased, run_events)
+        except BrokerError as e:
+            print(f"{Fore.RED}{get_timestamp()} [{name}] Broker perso durante il job: {e}{Style.RESET_ALL}", file=sys.stderr)
+            continue # Il prestito scadrà e il job verrà riconsegnato
+        color = Fore.GREEN if ok else Fore.RED
+        print(f"{color}{get_timestamp()} [{name}] Job {job['id']} {'completato' if ok else 'non riuscito'}.{Style.RESET_ALL}")
+    client.close()
+
+
+# --- VERIFICA LOCALE ---
+
+def _selftest() -> int:
+    """
+    Broker locale con prestiti da 1 secondo, tre worker in thread e un worker che
+    prende un job e sparisce: tutti i job devono concludersi, quello abbandonato
+    dopo la riconsegna e con l'avanzamento salvato dal primo tentativo.
+    """
+    import tempfile
+    from Broker import BrokerServer, WorkBroker
+    global WORKER_JOBS_DIR, BROKER_HEARTBEAT_SECONDS
+
+    BROKER_HEARTBEAT_SECONDS = 0.2
+    tmp = Path(tempfile.mkdtemp())
+    WORKER_JOBS_DIR = tmp / "jobs"
+
+    def fake_events(job_dir: Path, table: str, text: str, cancel: threading.Event = None):
+        state = JobState(job_dir)
+        yield {"event": "progress", "message": f"riprendo da {state.get('stage')}" if state.get("stage") else "nuovo"}
+        state.update(stage="submitted", task=f"task-{text}")
+        time.sleep(0.3)
+        yield {"event": "song", "data": {"path": f"/songs/{text}.mp3", "table": table, "task": state.get("task")}}
+        yield {"event": "result", "ok": True}
+
+    server = BrokerServer(("127.0.0.1", 0), WorkBroker(state_file=tmp / "broker.json", lease_seconds=1))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    address = f"127.0.0.1:{server.server_address[1]}"
+    producer = BrokerClient(address)
+
+    # Il worker "fantasma" prende il primo job, salva un avanzamento e non si fa più sentire
+    producer.call("submit", job={"id": "job-0", "table": "sala.1", "text": "0"})
+    ghost = BrokerClient(address)
+    ghost.call("lease", worker="fantasma", wait=1)
+    ghost.call("heartbeat", id="job-0", worker="fantasma", state={"stage": "submitted", "task": "task-0"})
+    for i in range(1, 6):
+        producer.call("submit", job={"id": f"job-{i}", "table": f"sala.{i}", "text": str(i)})
+
+    stop = threading.Event()
+    for n in range(3):
+        threading.Thread(target=work_loop, args=(address, f"w{n}", fake_events, stop), daemon=True).start()
+
+    failures = 0
+    for i in range(6):
+        events, cursor, deadline = [], {"after": 0}, time.monotonic() + 15
+        while not any(e["event"] == "result" for e in events) and time.monotonic() < deadline:
+            reply = producer.call("fetch", id=f"job-{i}", wait=2, **cursor)
+            events += reply["events"]
+            cursor = {"epoch": reply["epoch"], "attempt": reply["attempt"], "after": reply["next"]}
+        ok = any(e["event"] == "result" and e["ok"] for e in events)
+        songs = {e["data"]["path"] for e in events if e["event"] == "song"} # Come il Producer: una canzone per percorso
+        resumed = any(e["event"] == "progress" and "riprendo" in e["message"] for e in events)
+        if i == 0:
+            ok = ok and resumed # Riconsegnato ripartendo dall'avanzamento del fantasma
+        failures += not (ok and len(songs) == 1)
+        print(f"{'OK  ' if ok and len(songs) == 1 else 'FAIL'} job-{i}  eventi: {len(events)}  ripreso: {resumed}")
+    print(f"Worker visti dal broker: {sorted(producer.call('status')['workers'])}")
+    stop.set()
+    server.shutdown()
+    shutil.rmtree(tmp, ignore_errors=True)
+    return failures
+
+
+if __name__ == "__main__":
+    if "--selftest" in sys.argv:
+        sys.exit(1 if _selftest() else 0)
+    broker_address = sys.argv[sys.argv.index("--broker") + 1] if "--broker" in sys.argv else WORK_BROKER
+    worker_name = sys.argv[sys.argv.index("--name") + 1] if "--name" in sys.argv else f"{socket.gethostname()}-{os.getpid()}"
+    print(f"{Fore.BLUE}{Style.BRIGHT}Worker {worker_name} collegato al broker {broker_address}. CTRL+C per terminare.{Style.RESET_ALL}")
+    try:
+        work_loop(broker_address, worker_name)
+    except KeyboardInterrupt:
+        print(f"\n{Fore.YELLOW}{get_timestamp()} [{worker_name}] Worker terminato.{Style.RESET_ALL}")